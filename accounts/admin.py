@@ -1,7 +1,8 @@
 from django.contrib import admin
 
-from .models import CustomUser, Invitation, EmailVerification
+from .models import CustomUser, Invitation, EmailVerification, QueuedEmail
 
 admin.site.register(CustomUser)
 admin.site.register(Invitation)
 admin.site.register(EmailVerification)
+admin.site.register(QueuedEmail)
@@ -0,0 +1,90 @@
+"""Outgoing email queue.
+
+Views and receivers queue their emails with queue_email, in the same
+transaction as the object they are about. The send_queued_emails command
+sends them in batches over one SMTP connection, retries failed ones with an
+exponential backoff and records the delivery state on each QueuedEmail."""
+import datetime
+import smtplib
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .models import QueuedEmail
+
+
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 60  # seconds before the first retry, doubled for every next one
+
+
+def queue_email(subject, body, to, from_email=None):
+    """Queues a plain text email to the address to."""
+    return QueuedEmail.objects.create(
+        subject=subject, body=body, to=to,
+        from_email=from_email or settings.SERVER_EMAIL)
+
+
+def retry_delay(attempts):
+    return datetime.timedelta(seconds=RETRY_DELAY * 2**(attempts - 1))
+
+
+def send_queued_emails(batch_size=100, connection=None):
+    """Sends one batch of the queued emails that are due.
+
+    All the emails of the batch go over connection, which is left open for
+    the next batch; without one a connection is opened for this batch only.
+    The batch is locked while it is sent, an email is sent again only if
+    recording its delivery fails. Returns the number of emails handled."""
+    now = timezone.now()
+    with transaction.atomic():
+        emails = list(QueuedEmail.objects
+                      .select_for_update(skip_locked=True)
+                      .filter(status=QueuedEmail.QUEUED, next_attempt_at__lte=now)
+                      .order_by('next_attempt_at')[:batch_size])
+        if not emails:
+            return 0
+        own_connection = connection is None
+        if own_connection:
+            connection = get_connection()
+        try:
+            for email in emails:
+                _send(email, connection)
+        finally:
+            if own_connection:
+                _close(connection)
+        QueuedEmail.objects.bulk_update(
+            emails, ['status', 'attempts', 'next_attempt_at', 'sent_at', 'last_error', 'changed_at'])
+    return len(emails)
+
+
+def _send(email, connection):
+    message = EmailMultiAlternatives(
+        email.subject, email.body, email.from_email, [email.to], connection=connection)
+    email.attempts += 1
+    email.changed_at = timezone.now()
+    try:
+        # Does nothing if the connection is open already
+        connection.open()
+        if not connection.send_messages([message]):
+            raise smtplib.SMTPException("Not sent")
+    except Exception as e:
+        # The connection may be broken, the next email opens a new one
+        _close(connection)
+        email.last_error = "%s: %s" % (type(e).__name__, e)
+        if isinstance(e, smtplib.SMTPRecipientsRefused) or email.attempts >= MAX_ATTEMPTS:
+            email.status = QueuedEmail.FAILED
+        else:
+            email.next_attempt_at = email.changed_at + retry_delay(email.attempts)
+        return
+    email.status = QueuedEmail.SENT
+    email.sent_at = email.changed_at
+    email.last_error = ''
+
+
+def _close(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
@@ -0,0 +1,36 @@
+import time
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from accounts.mail_queue import send_queued_emails
+
+
+class Command(BaseCommand):
+    help = "Sends the queued emails over one connection, retrying failed ones later."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--forever', action='store_true',
+                            help="Keep polling the queue instead of exiting once it is empty.")
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help="Seconds to wait between polls when the queue is empty.")
+
+    def handle(self, *args, **options):
+        total = 0
+        connection = get_connection()
+        try:
+            while True:
+                count = send_queued_emails(batch_size=options['batch_size'], connection=connection)
+                total += count
+                if count:
+                    continue
+                # Mail servers drop idle clients, the connection is opened
+                # again for the next email
+                connection.close()
+                if not options['forever']:
+                    break
+                time.sleep(options['interval'])
+        finally:
+            connection.close()
+        self.stdout.write("Handled %s emails" % (total))
@@ -104,3 +104,35 @@ class PasswordResetRequest(models.Model):
 
     def get_verify_url(self):
         return reverse("password_forgotten", kwargs={"verification_code": self.verification_code})
+
+
+class QueuedEmail(models.Model):
+    """Outgoing email, sent in batches by accounts.mail_queue.send_queued_emails."""
+    QUEUED = 'queued'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    changed_at = models.DateTimeField(auto_now=True)
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.EmailField()
+    to = models.EmailField()
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, default=None)
+    last_error = models.TextField(default='', blank=True)
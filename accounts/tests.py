@@ -1,9 +1,18 @@
+import datetime
+import socketserver
+import threading
+from io import StringIO
+
 from django.contrib.auth.models import AnonymousUser
 from accounts.models import CustomUser
-from django.test import RequestFactory, TestCase
+from django.core import mail
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
 
 from .views import *
 from .models import *
+from .mail_queue import queue_email, send_queued_emails
 
 class BasicAccountsTest(TestCase):
     """Tests the basic functionality of the accounts app."""
@@ -49,10 +58,153 @@ class ReceiversAccountsTest(TestCase):
 
 
     def test_send_verification_email(self):
-        self.skipTest(reason="TODO")
-        self.assertTrue(False)
+        user = CustomUser.objects.create_user(
+            username='johndoe', email='j.doe@example.org', password='top_secret')
+        verification = EmailVerification.objects.get(user=user)
+        email = QueuedEmail.objects.get(to='j.doe@example.org')
+        self.assertIn(verification.get_verify_url(), email.body)
+        # Queued, not sent during the request
+        self.assertEqual(email.status, QueuedEmail.QUEUED)
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(send_queued_emails(), 3)
+        self.assertEqual(len(mail.outbox), 3)
+        email.refresh_from_db()
+        self.assertEqual(email.status, QueuedEmail.SENT)
+        self.assertEqual(email.attempts, 1)
+        self.assertIsNotNone(email.sent_at)
 
 
     def test_send_password_reset_email(self):
-        self.skipTest(reason="TODO")
-        self.assertTrue(False)
+        reset_request = PasswordResetRequest(user=self.user)
+        reset_request.save()
+        email = QueuedEmail.objects.get(subject__startswith='Reset password')
+        self.assertEqual(email.to, 'hi@seb.st')
+        self.assertIn(reset_request.get_verify_url(), email.body)
+        self.assertEqual(len(mail.outbox), 0)
+
+
+class SMTPServer:
+    """Local SMTP stand-in recording the messages it receives."""
+
+    def __init__(self, refused=(), failing_data=0):
+        server = self
+        self.connections = 0
+        self.messages = []
+        self.failing_data = failing_data
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode('ascii') + b'\r\n')
+
+            def handle(self):
+                server.connections += 1
+                recipients = []
+                self.reply('220 localhost')
+                for line in self.rfile:
+                    command = line.decode('ascii').strip()
+                    verb = command[:4].upper()
+                    if verb in ('HELO', 'EHLO', 'RSET', 'NOOP'):
+                        self.reply('250 OK')
+                    elif verb == 'MAIL':
+                        recipients = []
+                        self.reply('250 OK')
+                    elif verb == 'RCPT':
+                        address = command.split(':', 1)[1].strip().strip('<>')
+                        if address in refused:
+                            self.reply('550 No such user')
+                        else:
+                            recipients.append(address)
+                            self.reply('250 OK')
+                    elif verb == 'DATA':
+                        if server.failing_data:
+                            server.failing_data -= 1
+                            self.reply('451 Try again later')
+                            continue
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        data = b''.join(iter(self.rfile.readline, b'.\r\n'))
+                        server.messages.append((recipients, data))
+                        self.reply('250 OK')
+                    elif verb == 'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    else:
+                        self.reply('502 Not implemented')
+
+        self.smtpd = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.smtpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.smtpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def settings(self):
+        return override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.smtpd.server_address[1],
+            EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='',
+            EMAIL_USE_TLS=False, EMAIL_USE_SSL=False)
+
+    def close(self):
+        self.smtpd.shutdown()
+        self.smtpd.server_close()
+
+
+class MailQueueAccountsTest(TestCase):
+    """Queued emails are sent in batches over one connection and retried."""
+
+    def queue(self, count, to='reader%s@example.org'):
+        return [queue_email('Subject %s' % (i), 'Body %s' % (i), to % (i))
+                for i in range(count)]
+
+    def start_server(self, **kwargs):
+        server = SMTPServer(**kwargs)
+        self.addCleanup(server.close)
+        settings = server.settings()
+        settings.enable()
+        self.addCleanup(settings.disable)
+        return server
+
+    def test_one_connection_for_all_batches(self):
+        server = self.start_server()
+        self.queue(5)
+        call_command('send_queued_emails', batch_size=2, stdout=StringIO())
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(sorted(recipients[0] for recipients, data in server.messages),
+                         ['reader%s@example.org' % (i) for i in range(5)])
+        self.assertEqual(QueuedEmail.objects.filter(status=QueuedEmail.SENT).count(), 5)
+
+    def test_retry_with_backoff(self):
+        server = self.start_server(failing_data=1)
+        first, second = self.queue(2)
+        self.assertEqual(send_queued_emails(), 2)
+        failed = QueuedEmail.objects.get(status=QueuedEmail.QUEUED)
+        self.assertEqual(failed.attempts, 1)
+        self.assertIn('SMTPDataError', failed.last_error)
+        self.assertGreater(failed.next_attempt_at, timezone.now() + datetime.timedelta(seconds=50))
+        # The other email went out on a new connection
+        self.assertEqual(len(server.messages), 1)
+        self.assertEqual(server.connections, 2)
+
+        # Not due yet
+        self.assertEqual(send_queued_emails(), 0)
+        QueuedEmail.objects.filter(pk=failed.pk).update(next_attempt_at=timezone.now())
+        self.assertEqual(send_queued_emails(), 1)
+        failed.refresh_from_db()
+        self.assertEqual(failed.status, QueuedEmail.SENT)
+        self.assertEqual(failed.attempts, 2)
+        self.assertEqual(failed.last_error, '')
+        self.assertEqual(len(server.messages), 2)
+
+    def test_give_up(self):
+        self.start_server(refused=['reader0@example.org'], failing_data=1)
+        refused, unlucky = self.queue(2)
+        # The last attempt
+        QueuedEmail.objects.filter(pk=unlucky.pk).update(attempts=4)
+        self.assertEqual(send_queued_emails(), 2)
+        refused.refresh_from_db()
+        unlucky.refresh_from_db()
+        # Refused recipients are not retried
+        self.assertEqual(refused.status, QueuedEmail.FAILED)
+        self.assertEqual(refused.attempts, 1)
+        self.assertIn('SMTPRecipientsRefused', refused.last_error)
+        self.assertEqual(unlucky.status, QueuedEmail.FAILED)
+        self.assertEqual(unlucky.attempts, 5)
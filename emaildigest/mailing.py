@@ -1,16 +1,256 @@
+"""Digest generation and sending.
+
+The stories of a digest are ranked once, with the front page ranking as of
+the time the digest is made, and its body is rendered once. Only the
+unsubscribe link differs between recipients, it is substituted into the
+shared body for every subscription. Subscriptions are read in chunks of
+primary keys, the memory used does not grow with their number.
+
+Sending is split between processes by primary key range and recorded per
+subscription in DigestDelivery. create_and_send_digest sends the digest
+already made for the day and frequency if there is one, running it again
+after a crash resumes the sending."""
+import datetime
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django import db
 from django.conf import settings
-from .models import Subscription, EmailDigest
-
-def create_and_send_digest(frequency):
-    pass
-    # Get list of objects
-    stories = [] # TODO: Find from _font_page
-    # make templates and trigger sending
-    subscriptions = Subscription.objects.filter(is_active=True, frequency=frequency)
-    for subscription in subscriptions:
-        tpl = 'TODO: Here is your list' # TODO
-        subject = settings.SITE_NAME + " " + frequency + " Digest"
-        send_mail(subscription, tpl, subject)
-
-def send_mail(subscription, template, subject):
-    pass
\ No newline at end of file
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import F, Q
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone
+
+from news.ranking import rank_score
+from .models import Subscription, EmailDigest, DigestDelivery
+
+
+DAYS_BACK = {'daily': 1, 'weekly': 7}
+# Stands for the unsubscribe link in the shared body
+UNSUBSCRIBE_URL = '%%unsubscribe_url%%'
+
+
+def weekday(as_of):
+    return timezone.localtime(as_of).strftime('%a')
+
+
+def subscriptions_for(frequency, as_of):
+    """Active subscriptions that get the frequency digest made at as_of.
+
+    Weekly subscriptions get theirs on their weekly_weekday, the ones without
+    on settings.EMAIL_DIGEST_WEEKDAY. The subscription form does not ask for
+    a frequency, subscriptions without one get the weekly digest."""
+    subscriptions = Subscription.objects.filter(is_active=True, verfied_email__isnull=False)
+    if frequency == 'weekly':
+        subscriptions = subscriptions.filter(frequency__in=['weekly', ''])
+        day = weekday(as_of)
+        q = Q(weekly_weekday=day)
+        if day == settings.EMAIL_DIGEST_WEEKDAY:
+            q |= Q(weekly_weekday__isnull=True) | Q(weekly_weekday='')
+        subscriptions = subscriptions.filter(q)
+    else:
+        subscriptions = subscriptions.filter(frequency=frequency)
+    return subscriptions
+
+
+def digest_stories(frequency, as_of):
+    """Top stories of the window of frequency, as ranked on the front page at as_of."""
+    from news.views import _front_page
+    return list(_front_page(paging_size=settings.EMAIL_DIGEST_SIZE, as_of=as_of,
+                            days_back=DAYS_BACK[frequency]))
+
+
+def create_digest(frequency, as_of=None):
+    """The EmailDigest of frequency made at as_of with its stories, None if
+    nobody gets it or there is nothing to send."""
+    if as_of is None:
+        as_of = timezone.now()
+    if not subscriptions_for(frequency, as_of).exists():
+        return None
+    stories = digest_stories(frequency, as_of)
+    if not stories:
+        return None
+    digest = EmailDigest.objects.create(
+        frequency=frequency, weekly_weekday=weekday(as_of) if frequency == 'weekly' else None,
+        as_of=as_of)
+    digest.stories.set(stories)
+    return digest
+
+
+def day_digest(frequency, as_of):
+    """The frequency digest made on the day of as_of, None if there is none yet."""
+    day = timezone.localdate(as_of)
+    start_of_day = timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+    end_of_day = timezone.make_aware(datetime.datetime.combine(
+        day + datetime.timedelta(days=1), datetime.time.min))
+    return EmailDigest.objects.filter(
+        frequency=frequency, as_of__gte=start_of_day, as_of__lt=end_of_day).order_by('as_of').first()
+
+
+def digest_subject(digest):
+    return "%s %s Digest" % (settings.SITE_NAME, digest.frequency)
+
+
+def render_digest(digest, as_of):
+    """The body shared by all recipients of digest, with UNSUBSCRIBE_URL in
+    place of their unsubscribe link."""
+    # In the order of the front page at as_of
+    stories = sorted(digest.stories.select_related('user'), reverse=True,
+                     key=lambda story: rank_score(story.points, story.created_at, as_of))
+    return render_to_string('emaildigest/digest.txt', {
+        'digest': digest, 'stories': stories, 'SITE_URL': settings.SITE_URL,
+        'SITE_NAME': settings.SITE_NAME, 'unsubscribe_url': UNSUBSCRIBE_URL})
+
+
+def unsubscribe_url(subscription_id, digest):
+    return settings.SITE_URL + reverse(
+        'emaildigest_unsubscribe', kwargs={'subscription_id': subscription_id, 'digest_id': digest.pk})
+
+
+def digest_message(digest, subject, body, subscription_id, email, connection=None):
+    url = unsubscribe_url(subscription_id, digest)
+    return EmailMessage(subject, body.replace(UNSUBSCRIBE_URL, url), settings.SERVER_EMAIL,
+                        [email], connection=connection,
+                        headers={'List-Unsubscribe': '<%s>' % (url)})
+
+
+def iter_recipients(subscriptions, chunk_size):
+    """(pk, email) of subscriptions, in lists of at most chunk_size, in pk order."""
+    subscriptions = subscriptions.order_by('pk')
+    last_pk = None
+    while True:
+        chunk = subscriptions
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk.values_list('pk', 'verfied_email')[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1][0]
+
+
+def id_ranges(count):
+    """Splits the UUID primary keys into count ranges of (low, high), low
+    included and high excluded, None when open. uuid4 keys are uniformly
+    distributed, the ranges hold about the same number of subscriptions."""
+    bounds = [uuid.UUID(int=(i << 128) // count) for i in range(1, count)]
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def send_digest(digest, as_of=None, chunk_size=None, processes=None, rate=None, add_filter={}):
+    """Sends digest to the subscriptions it was not sent to yet.
+
+    The subscriptions are split by primary key range between processes, each
+    with its own connection. rate caps the messages per second of all
+    processes together. add_filter restricts the subscriptions further. Every
+    delivery is recorded in DigestDelivery as soon as the message is sent,
+    sending again after a crash skips them. Returns the number of emails
+    sent."""
+    if as_of is None:
+        as_of = digest.as_of or digest.created_at
+    if processes is None:
+        processes = settings.EMAIL_DIGEST_PROCESSES
+    if rate is None:
+        rate = settings.EMAIL_DIGEST_RATE
+    process_rate = rate / processes if rate else None
+    ranges = id_ranges(processes)
+    if processes == 1:
+        return send_partition(digest.pk, as_of, *ranges[0], chunk_size=chunk_size,
+                              rate=process_rate, add_filter=add_filter)
+    # The processes must not share the connections of this one
+    db.connections.close_all()
+    with ProcessPoolExecutor(max_workers=processes, initializer=django.setup) as pool:
+        futures = [pool.submit(send_partition, digest.pk, as_of, low, high,
+                               chunk_size=chunk_size, rate=process_rate, add_filter=add_filter)
+                   for low, high in ranges]
+        return sum(future.result() for future in futures)
+
+
+def send_partition(digest_id, as_of, low=None, high=None, chunk_size=None, rate=None, connection=None,
+                   add_filter={}):
+    """Sends digest_id to its subscriptions with low <= pk < high over one
+    connection, at most rate messages per second. Returns the number of
+    emails sent."""
+    if chunk_size is None:
+        chunk_size = settings.EMAIL_DIGEST_CHUNK_SIZE
+    digest = EmailDigest.objects.get(pk=digest_id)
+    subject = digest_subject(digest)
+    body = render_digest(digest, as_of)
+    subscriptions = subscriptions_for(digest.frequency, as_of).filter(**add_filter)
+    if low is not None:
+        subscriptions = subscriptions.filter(pk__gte=low)
+    if high is not None:
+        subscriptions = subscriptions.filter(pk__lt=high)
+    own_connection = connection is None
+    if own_connection:
+        connection = get_connection()
+    interval = 1 / rate if rate else 0
+    next_send_at = time.monotonic()
+    sent = 0
+    try:
+        for chunk in iter_recipients(subscriptions, chunk_size):
+            previous = dict(DigestDelivery.objects
+                            .filter(digest=digest, subscription_id__in=[pk for pk, email in chunk])
+                            .values_list('subscription_id', 'status'))
+            for pk, email in chunk:
+                if previous.get(pk) == DigestDelivery.SENT:
+                    continue
+                delay = next_send_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_send_at = max(next_send_at, time.monotonic()) + interval
+                error = _send(connection, digest_message(digest, subject, body, pk, email, connection=connection))
+                _record(digest, pk, error, retry=pk in previous)
+                sent += not error
+    finally:
+        if own_connection:
+            _close(connection)
+    return sent
+
+
+def _send(connection, message):
+    """Sends message, returns the error or '' on success."""
+    try:
+        # Does nothing if the connection is open already
+        connection.open()
+        if not connection.send_messages([message]):
+            return "Not sent"
+    except Exception as e:
+        # The connection may be broken, the next message opens a new one
+        _close(connection)
+        return "%s: %s" % (type(e).__name__, e)
+    return ''
+
+
+def _close(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+def _record(digest, subscription_id, error, retry):
+    status = DigestDelivery.FAILED if error else DigestDelivery.SENT
+    if retry:
+        DigestDelivery.objects.filter(digest=digest, subscription_id=subscription_id).update(
+            status=status, last_error=error, attempts=F('attempts') + 1, changed_at=timezone.now())
+    else:
+        DigestDelivery.objects.create(digest=digest, subscription_id=subscription_id,
+                                      status=status, last_error=error)
+
+
+def create_and_send_digest(frequency, as_of=None, chunk_size=None, processes=None, rate=None):
+    """Makes the frequency digest and sends it. The digest made earlier on
+    the same day is sent again instead, to the subscriptions it did not
+    reach. Returns the digest and the number of emails sent."""
+    if as_of is None:
+        as_of = timezone.now()
+    digest = day_digest(frequency, as_of)
+    if digest is None:
+        digest = create_digest(frequency, as_of=as_of)
+        if digest is None:
+            return None, 0
+    return digest, send_digest(digest, chunk_size=chunk_size, processes=processes, rate=rate)
@@ -0,0 +1,104 @@
+import socketserver
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from accounts.models import CustomUser
+from emaildigest.mailing import send_digest
+from emaildigest.models import EmailDigest, Subscription
+from news.models import Story
+
+
+class SMTPSink:
+    """Local SMTP server accepting and dropping every message, after latency
+    seconds per message."""
+
+    def __init__(self, latency=0):
+        sink = self
+        self.messages = 0
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line + b'\r\n')
+
+            def handle(self):
+                self.reply(b'220 localhost')
+                for line in self.rfile:
+                    verb = line[:4].upper()
+                    if verb == b'DATA':
+                        self.reply(b'354 End data with <CR><LF>.<CR><LF>')
+                        for data in self.rfile:
+                            if data == b'.\r\n':
+                                break
+                        time.sleep(latency)
+                        sink.messages += 1
+                        self.reply(b'250 OK')
+                    elif verb == b'QUIT':
+                        self.reply(b'221 Bye')
+                        return
+                    else:
+                        self.reply(b'250 OK')
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def settings(self):
+        return override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.server.server_address[1],
+            EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='', EMAIL_USE_TLS=False, EMAIL_USE_SSL=False)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Command(BaseCommand):
+    help = "Measures the digest sends/sec against a local SMTP sink. The processes need committed rows, the benchmark data is deleted afterwards."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscriptions', type=int, default=2000)
+        parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+        parser.add_argument('--rate', type=float, default=None)
+        parser.add_argument('--latency', type=float, default=0.002,
+                            help="Seconds the sink takes to accept a message.")
+
+    def handle(self, *args, **options):
+        sink = SMTPSink(latency=options['latency'])
+        # The processes only see committed rows: the benchmark sends its own
+        # digests to its own subscriptions and deletes them afterwards
+        user = CustomUser.objects.create(username='benchmark-digest')
+        self.digests = []
+        self.marker = 'benchmark-digest-%s-' % (uuid.uuid4().hex)
+        try:
+            with sink.settings():
+                self._benchmark(user, options)
+        finally:
+            EmailDigest.objects.filter(pk__in=[digest.pk for digest in self.digests]).delete()
+            Subscription.objects.filter(verfied_email__startswith=self.marker).delete()
+            user.delete()
+            sink.close()
+
+    def _benchmark(self, user, options):
+        story = Story(user=user, title='benchmark', product_title='benchmark',
+                      original_url='https://example.org/digest',
+                      product_url='https://example.com/digest')
+        story.save()
+        Subscription.objects.bulk_create([
+            Subscription(frequency='daily', verfied_email='%s%s@example.org' % (self.marker, i),
+                         is_active=True)
+            for i in range(options['subscriptions'])], batch_size=1000)
+        for processes in options['processes']:
+            digest = EmailDigest.objects.create(frequency='daily')
+            self.digests.append(digest)
+            digest.stories.set([story])
+            start = time.perf_counter()
+            sent = send_digest(digest, processes=processes, rate=options['rate'],
+                               add_filter={'verfied_email__startswith': self.marker})
+            elapsed = time.perf_counter() - start
+            self.stdout.write("%s processes: %s emails in %.2fs, %8.1f sends/sec" % (
+                processes, sent, elapsed, sent/elapsed))
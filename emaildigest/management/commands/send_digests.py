@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from emaildigest.mailing import create_and_send_digest, send_digest
+from emaildigest.models import EmailDigest
+
+
+class Command(BaseCommand):
+    help = "Makes the daily or weekly digest and sends it to the active subscriptions. Run the weekly one every day, subscriptions get it on their weekday. Running it again on the same day resumes the digest of the day."
+
+    def add_arguments(self, parser):
+        parser.add_argument('frequency', nargs='?', choices=['daily', 'weekly'])
+        parser.add_argument('--resume', metavar='DIGEST_ID',
+                            help="Sends an existing digest to the subscriptions it did not reach yet.")
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help="Subscriptions read and sent at a time.")
+        parser.add_argument('--processes', type=int, default=None,
+                            help="Processes sending in parallel, EMAIL_DIGEST_PROCESSES by default.")
+        parser.add_argument('--rate', type=float, default=None,
+                            help="Messages per second of all processes together, EMAIL_DIGEST_RATE by default.")
+
+    def handle(self, *args, **options):
+        sending = {'chunk_size': options['chunk_size'], 'processes': options['processes'],
+                   'rate': options['rate']}
+        if options['resume']:
+            try:
+                digest = EmailDigest.objects.get(pk=options['resume'])
+            except (EmailDigest.DoesNotExist, ValueError):
+                raise CommandError("No digest %s" % (options['resume']))
+            sent = send_digest(digest, **sending)
+        elif options['frequency']:
+            digest, sent = create_and_send_digest(options['frequency'], **sending)
+            if digest is None:
+                self.stdout.write("No %s digest to send" % (options['frequency']))
+                return
+        else:
+            raise CommandError("Give a frequency or --resume")
+        self.stdout.write("Sent digest %s with %s stories to %s subscriptions" % (
+            digest.pk, digest.stories.count(), sent))
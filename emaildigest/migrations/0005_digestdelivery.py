@@ -0,0 +1,32 @@
+# Generated by Django 3.1 on 2026-10-18 12:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emaildigest', '0004_auto_20190926_2118'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DigestDelivery',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('changed_at', models.DateTimeField(auto_now=True)),
+                ('status', models.CharField(choices=[('sent', 'Sent'), ('failed', 'Failed')], max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=1)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('digest', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='emaildigest.emaildigest')),
+                ('subscription', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='emaildigest.subscription')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='digestdelivery',
+            constraint=models.UniqueConstraint(fields=('digest', 'subscription'), name='emaildigest_digestdelivery_unique_digest_subscription'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1 on 2026-10-18 13:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emaildigest', '0005_digestdelivery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emaildigest',
+            name='as_of',
+            field=models.DateTimeField(db_index=True, editable=False, null=True),
+        ),
+    ]
@@ -15,6 +15,9 @@ class EmailDigest(models.Model):
                                                                                      ('Fri', 'Fri'),
                                                                                      ('Sat', 'Sat')))
     stories = models.ManyToManyField('news.Story')
+    # Time the stories were ranked at, the digest of a day is resumed by
+    # sending it again
+    as_of = models.DateTimeField(null=True, db_index=True, editable=False)
 
 class Subscription(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -49,4 +52,29 @@ class UnSubscription(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     changed_at = models.DateTimeField(auto_now=True)
     subscription = models.ForeignKey(Subscription, on_delete=models.CASCADE)
-    from_digest = models.ForeignKey(EmailDigest, on_delete=models.CASCADE, null=True)
\ No newline at end of file
+    from_digest = models.ForeignKey(EmailDigest, on_delete=models.CASCADE, null=True)
+
+class DigestDelivery(models.Model):
+    """Delivery of a digest to one subscription, a resumed sending skips the
+    subscriptions it was sent to already."""
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['digest', 'subscription'],
+                                    name='emaildigest_digestdelivery_unique_digest_subscription'),
+        ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    changed_at = models.DateTimeField(auto_now=True)
+    digest = models.ForeignKey(EmailDigest, on_delete=models.CASCADE)
+    subscription = models.ForeignKey(Subscription, on_delete=models.CASCADE)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES)
+    attempts = models.PositiveIntegerField(default=1)
+    last_error = models.TextField(default='', blank=True)
@@ -1,10 +1,29 @@
+import datetime
+from io import StringIO
+from unittest import mock
+
 from django.contrib.auth.models import AnonymousUser
 from accounts.models import CustomUser
-from django.test import RequestFactory, TestCase
+import multiprocessing
+import os
+import re
+import shutil
+import smtplib
+import tempfile
+import time
+
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from news.models import Item, Story
 
 from .views import *
 from .models import *
 from .forms import *
+from . import mailing
 
 class BasicEmailDigestTest(TestCase):
     """Tests the basic functionality of the emaildigest app."""
@@ -145,6 +164,255 @@ class BasicEmailDigestTest(TestCase):
 
 
 
+# A Monday
+AS_OF = timezone.make_aware(datetime.datetime(2020, 11, 9, 8, 0))
+
+
+@override_settings(EMAIL_DIGEST_WEEKDAY='Mon')
+class DigestEmailDigestTest(TestCase):
+    """Digests are ranked and rendered once and sent to every subscription."""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='sebst', email='hi@seb.st', password='top_secret')
+
+    def _story(self, title, points, hours_ago):
+        story = Story(original_url="https://example.org/%s" % (title),
+                      product_url="https://example.com/%s" % (title),
+                      title=title, product_title="Product", user=self.user)
+        story.save()
+        Item.objects.filter(pk=story.pk).update(
+            points=points, created_at=AS_OF - datetime.timedelta(hours=hours_ago))
+        return story
+
+    def _subscription(self, email, frequency='daily', weekly_weekday=None, is_active=True):
+        return Subscription.objects.create(frequency=frequency, weekly_weekday=weekly_weekday,
+                                           verfied_email=email, is_active=is_active)
+
+    def test_daily_digest(self):
+        self._story('recent', 5, 3)
+        self._story('hot', 50, 10)
+        self._story('old', 500, 30)
+        subscriptions = [self._subscription('reader%s@example.org' % (i)) for i in range(5)]
+        self._subscription('inactive@example.org', is_active=False)
+        self._subscription('weekly@example.org', frequency='weekly')
+
+        with mock.patch('emaildigest.mailing.render_to_string', wraps=mailing.render_to_string) as render:
+            digest, sent = mailing.create_and_send_digest('daily', as_of=AS_OF, chunk_size=2)
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(sent, 5)
+        self.assertEqual(EmailDigest.objects.get(), digest)
+        self.assertEqual(sorted(story.title for story in digest.stories.all()), ['hot', 'recent'])
+
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         sorted(subscription.verfied_email for subscription in subscriptions))
+        for message in mail.outbox:
+            subscription = Subscription.objects.get(verfied_email=message.to[0])
+            url = mailing.unsubscribe_url(subscription.pk, digest)
+            self.assertIn(url, message.body)
+            self.assertEqual(message.extra_headers['List-Unsubscribe'], '<%s>' % (url))
+            self.assertNotIn(mailing.UNSUBSCRIBE_URL, message.body)
+            # Front page order
+            self.assertLess(message.body.index('hot'), message.body.index('recent'))
+            self.assertNotIn('old', message.body)
+
+    def test_weekly_digest_on_weekday(self):
+        self._story('story', 5, 30)
+        self._subscription('default@example.org', frequency='weekly')
+        self._subscription('monday@example.org', frequency='weekly', weekly_weekday='Mon')
+        self._subscription('tuesday@example.org', frequency='weekly', weekly_weekday='Tue')
+        self._subscription('unset@example.org', frequency='')
+
+        digest, sent = mailing.create_and_send_digest('weekly', as_of=AS_OF)
+        self.assertEqual(digest.weekly_weekday, 'Mon')
+        self.assertEqual(digest.stories.get().title, 'story')
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         ['default@example.org', 'monday@example.org', 'unset@example.org'])
+
+        mail.outbox = []
+        digest, sent = mailing.create_and_send_digest('weekly', as_of=AS_OF + datetime.timedelta(days=1))
+        self.assertEqual([message.to[0] for message in mail.outbox], ['tuesday@example.org'])
+
+    def test_run_again_after_a_crash(self):
+        self._story('story', 5, 3)
+        subscriptions = [self._subscription('reader%s@example.org' % (i)) for i in range(5)]
+        send = mailing._send
+
+        def crash(connection, message):
+            if len(mail.outbox) == 2:
+                raise RuntimeError("crash")
+            return send(connection, message)
+
+        with mock.patch('emaildigest.mailing._send', side_effect=crash):
+            with self.assertRaises(RuntimeError):
+                mailing.create_and_send_digest('daily', as_of=AS_OF, chunk_size=2)
+        self.assertEqual(len(mail.outbox), 2)
+
+        # Later on the same day the digest of the day is resumed
+        digest, sent = mailing.create_and_send_digest('daily', as_of=AS_OF + datetime.timedelta(hours=2))
+        self.assertEqual(EmailDigest.objects.get(), digest)
+        self.assertEqual(digest.as_of, AS_OF)
+        self.assertEqual(sent, 3)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         sorted(subscription.verfied_email for subscription in subscriptions))
+
+        # The next day gets its own digest
+        next_digest, sent = mailing.create_and_send_digest('daily', as_of=AS_OF + datetime.timedelta(hours=20))
+        self.assertNotEqual(next_digest, digest)
+        self.assertEqual(sent, 5)
+
+    def test_nothing_to_send(self):
+        self._story('story', 5, 3)
+        self.assertEqual(mailing.create_and_send_digest('daily', as_of=AS_OF), (None, 0))
+        self._subscription('reader@example.org')
+        self.assertEqual(mailing.create_and_send_digest('daily', as_of=AS_OF + datetime.timedelta(days=2)), (None, 0))
+        self.assertFalse(EmailDigest.objects.exists())
+
+    def test_recipients_in_chunks(self):
+        for i in range(7):
+            self._subscription('reader%s@example.org' % (i))
+        chunks = list(mailing.iter_recipients(mailing.subscriptions_for('daily', AS_OF), 3))
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 1])
+        self.assertEqual(len({pk for chunk in chunks for pk, email in chunk}), 7)
+
+    def test_command(self):
+        self._story('story', 5, 1)
+        self._subscription('reader@example.org')
+        Item.objects.update(created_at=timezone.now())
+        out = StringIO()
+        call_command('send_digests', 'daily', stdout=out)
+        self.assertIn('to 1 subscriptions', out.getvalue())
+        self.assertEqual(len(mail.outbox), 1)
+
+
+
+class RefusingEmailBackend(EmailBackend):
+    """Refuses the addresses starting with refused."""
+
+    def send_messages(self, messages):
+        for message in messages:
+            if message.to[0].startswith('refused'):
+                raise smtplib.SMTPRecipientsRefused({message.to[0]: (550, b'No such user')})
+        return super().send_messages(messages)
+
+
+class DigestDeliveryEmailDigestTest(TestCase):
+    """Deliveries are recorded per subscription and sending can be resumed."""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='sebst', email='hi@seb.st', password='top_secret')
+        story = Story(original_url="https://example.org/story", product_url="https://example.com/story",
+                      title="Story", product_title="Product", user=self.user)
+        story.save()
+        self.subscriptions = [
+            Subscription.objects.create(frequency='daily', verfied_email='reader%s@example.org' % (i),
+                                        is_active=True)
+            for i in range(10)]
+        self.digest = mailing.create_digest('daily')
+
+    def test_resume(self):
+        done, failed = self.subscriptions[:3], self.subscriptions[3]
+        for subscription in done:
+            DigestDelivery.objects.create(digest=self.digest, subscription=subscription,
+                                          status=DigestDelivery.SENT)
+        DigestDelivery.objects.create(digest=self.digest, subscription=failed,
+                                      status=DigestDelivery.FAILED, last_error='SMTPServerDisconnected')
+        self.assertEqual(mailing.send_digest(self.digest, chunk_size=4), 7)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         sorted(subscription.verfied_email for subscription in self.subscriptions[3:]))
+        self.assertEqual(DigestDelivery.objects.filter(status=DigestDelivery.SENT).count(), 10)
+        retried = DigestDelivery.objects.get(subscription=failed)
+        self.assertEqual(retried.attempts, 2)
+        self.assertEqual(retried.last_error, '')
+
+        # Nothing left
+        mail.outbox = []
+        out = StringIO()
+        call_command('send_digests', resume=str(self.digest.pk), stdout=out)
+        self.assertIn('to 0 subscriptions', out.getvalue())
+        self.assertEqual(mail.outbox, [])
+
+    @override_settings(EMAIL_BACKEND='emaildigest.tests.RefusingEmailBackend')
+    def test_failures_are_recorded(self):
+        refused = Subscription.objects.create(frequency='daily', verfied_email='refused@example.org',
+                                              is_active=True)
+        self.assertEqual(mailing.send_digest(self.digest), 10)
+        delivery = DigestDelivery.objects.get(subscription=refused)
+        self.assertEqual(delivery.status, DigestDelivery.FAILED)
+        self.assertIn('SMTPRecipientsRefused', delivery.last_error)
+        self.assertEqual(len(mail.outbox), 10)
+
+    def test_partitions(self):
+        ranges = mailing.id_ranges(4)
+        self.assertEqual(len(ranges), 4)
+        self.assertEqual((ranges[0][0], ranges[-1][1]), (None, None))
+        sent = sum(mailing.send_partition(self.digest.pk, self.digest.created_at, low, high)
+                   for low, high in ranges)
+        self.assertEqual(sent, 10)
+        self.assertEqual(len({message.to[0] for message in mail.outbox}), 10)
+
+    def test_add_filter(self):
+        self.assertEqual(mailing.send_digest(
+            self.digest, add_filter={'verfied_email': 'reader0@example.org'}), 1)
+        self.assertEqual([message.to[0] for message in mail.outbox], ['reader0@example.org'])
+        self.assertEqual(DigestDelivery.objects.get().subscription, self.subscriptions[0])
+
+    def test_rate(self):
+        start = time.monotonic()
+        mailing.send_partition(self.digest.pk, self.digest.created_at, rate=100)
+        # Nine intervals between ten messages
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertEqual(len(mail.outbox), 10)
+
+
+class ReceiversEmailDigestTest(TestCase):
+
+    def test_lower_email_addresses(self):
+        from django.db.models.signals import pre_save
+        from .receivers import lower_email_addresses
+        self.assertEqual(pre_save._live_receivers(Subscription), [])
+        for model in (UserSubscription, AnonymousSubscription):
+            self.assertIn(lower_email_addresses, pre_save._live_receivers(model))
+        subscription = AnonymousSubscription.objects.create(email='Hi@Seb.St', verfied_email='Hi@Seb.St')
+        subscription = AnonymousSubscription.objects.get(pk=subscription.pk)
+        self.assertEqual((subscription.email, subscription.verfied_email), ('hi@seb.st', 'hi@seb.st'))
+
+
+class ProcessesEmailDigestTest(TransactionTestCase):
+    """Sending split between processes, which need committed rows."""
+
+    def setUp(self):
+        from django.db import connection
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db() \
+                and multiprocessing.get_start_method() != 'fork':
+            self.skipTest("Only forked processes see an in-memory database")
+        user = CustomUser.objects.create_user(
+            username='sebst', email='hi@seb.st', password='top_secret')
+        story = Story(original_url="https://example.org/story", product_url="https://example.com/story",
+                      title="Story", product_title="Product", user=user)
+        story.save()
+        self.emails = ['reader%s@example.org' % (i) for i in range(10)]
+        for email in self.emails:
+            Subscription.objects.create(frequency='daily', verfied_email=email, is_active=True)
+        self.digest = mailing.create_digest('daily')
+        self.mail_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.mail_dir)
+
+    def test_processes(self):
+        # The outbox of the test runner stays in the processes, they write
+        # their messages to files
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.filebased.EmailBackend',
+                               EMAIL_FILE_PATH=self.mail_dir):
+            self.assertEqual(mailing.send_digest(self.digest, processes=3), 10)
+        recipients = []
+        for name in os.listdir(self.mail_dir):
+            with open(os.path.join(self.mail_dir, name)) as f:
+                recipients += re.findall(r'^To: (.*)$', f.read(), re.M)
+        self.assertEqual(sorted(recipients), sorted(self.emails))
+
+
+
 # class ReceiversEmailDigestTest(TestCase):
 #     """Tests the basic receivers functionality of the emaildigest app."""
 #     def setUp(self):
@@ -36,7 +36,7 @@ def subscribe(request):
 def unsubscribe(request, subscription_id=None, digest_id=None):
     if 'done' in request.GET.keys():
         email = request.GET.get('email', None)
-        suscription = request.GET.get('subscription', None)
+        subscription = request.GET.get('subscription', None)
         return render(request, 'emaildigest/unsubscribe_done.html', {'email': email, 'subscription': subscription, 'prevent_footer_subscription_form': True})
     if subscription_id is None and digest_id is None:
         form = UnsunscribeForm(request.POST or None)
@@ -57,7 +57,7 @@ def unsubscribe(request, subscription_id=None, digest_id=None):
         elif request.method=="POST":
             unsubscription = UnSubscription(subscription=subscription, from_digest=digest)
             unsubscription.save()
-            return HttpResponseRedirect(reverse('emaildigest_unsubscribe') + "?done&subscription="+subscription_id)
+            return HttpResponseRedirect(reverse('emaildigest_unsubscribe') + "?done&subscription="+str(subscription_id))
         else:
             return HttpResponseRedirect(reverse('emaildigest_unsubscribe'))
     else:
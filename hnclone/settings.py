@@ -130,6 +130,30 @@ else:
     }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # URL -> title of submitted links, see news.titles
+    'titles': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('TITLE_CACHE_DIR', os.path.join(BASE_DIR, 'title_cache')),
+        'TIMEOUT': 7*24*60*60,  # one week
+    },
+    # Rendered HTML of comment subtrees, see news.comment_tree. A fragment
+    # per comment, the default limit of 300 entries is too small.
+    'comments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'comments',
+        'TIMEOUT': 60*60,  # one hour
+        'OPTIONS': {'MAX_ENTRIES': 50000},
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -182,6 +206,52 @@ INTERNAL_IPS = [
 
 PAGING_SIZE = 30
 
+# Ranked listings (index, show, ask) are served from a snapshot of the top
+# stories, rebuilt when it expires. The snapshot must be the same for all
+# the web processes, or the pages of a listing served by different ones could
+# disagree: it is stored in the database (news.PublishedSnapshot), not in a
+# per-process cache. The rerank_stories command publishes a new one.
+FRONT_PAGE_SNAPSHOT_SIZE = 10*PAGING_SIZE
+FRONT_PAGE_SNAPSHOT_TIMEOUT = 60  # one minute
+
+# The record_front_page command keeps the top stories of every ranked listing
+# in the FrontPageSnapshot table, at most once per interval, for /front.
+FRONT_PAGE_HISTORY_SIZE = 3*PAGING_SIZE
+FRONT_PAGE_HISTORY_INTERVAL = 60*60  # one hour, in seconds
+
+# Pages of the newest listing are cached per filter, see news.listing_cache.
+# New stories invalidate them right away, points and comment counts shown on
+# the page may be this old.
+NEWEST_CACHE_TIMEOUT = 30  # seconds
+
+# Length of the top sites and top products pages, see news.domains
+TOP_DOMAINS_SIZE = 100
+
+# When True, votes are queued by the views and applied in batches by the
+# flush_votes command instead of being written during the request.
+VOTE_QUEUE = (os.getenv("VOTE_QUEUE") == 'True')
+
+# When True, the side effects of new stories, comments and votes (self
+# upvotes, counters, karma, scores) are recorded in the DomainEvent outbox and
+# applied in batches by the process_events command instead of during the
+# request, see news.events.
+DOMAIN_EVENTS_ASYNC = (os.getenv("DOMAIN_EVENTS_ASYNC") == 'True')
+
+# Email digests, see emaildigest.mailing. Weekly subscriptions without a
+# weekday get their digest on EMAIL_DIGEST_WEEKDAY.
+EMAIL_DIGEST_SIZE = 10
+EMAIL_DIGEST_CHUNK_SIZE = 1000
+EMAIL_DIGEST_WEEKDAY = 'Mon'
+# Processes sending a digest, each with its own connection, and the cap on
+# the messages per second of all of them together (None for no cap).
+EMAIL_DIGEST_PROCESSES = int(os.getenv("EMAIL_DIGEST_PROCESSES", 1))
+EMAIL_DIGEST_RATE = float(os.getenv("EMAIL_DIGEST_RATE", 0)) or None
+
+# Titles of submitted links are fetched in background threads after the
+# submission, see news.titles.
+TITLE_FETCH_ASYNC = True
+TITLE_FETCH_WORKERS = 4
+
 
 HTML_MINIFY = True
 
@@ -201,6 +271,8 @@ GOOGLE_ANALYTICS_ID = os.getenv("GOOGLE_ANALYTICS_ID")
 
 
 # Email
+# Emails are queued in accounts.QueuedEmail and sent by the send_queued_emails
+# command, see accounts.mail_queue.
 if 'hackergrows.com' in os.getenv('ALLOWED_HOSTS'):
     EMAIL_BACKEND = os.getenv("EMAIL_BACKEND")
     EMAIL_HOST = os.getenv("EMAIL_HOST")
@@ -0,0 +1,103 @@
+import re
+
+from django.contrib.humanize.templatetags.humanize import naturaltime
+from django.core.cache import caches
+from django.middleware.csrf import get_token
+from django.template.defaultfilters import pluralize
+from django.template.loader import get_template
+from django.urls import reverse
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+
+from .models import Comment
+
+
+INDENT = 30  # pixels per level of nesting
+
+# Marks the parts of a cached comment that depend on the request or on time,
+# filled in on every render. Comment text is escaped, it cannot contain them.
+_PLACEHOLDER = re.compile(r'<!--comment-(arrows|points|age|owner)-([0-9a-f]{32})-->')
+
+
+def load_comment_tree(item):
+    """Comments below item, loaded with their users in one query.
+
+    Top level comments are the roots of their own trees, so a story gets all
+    the comments pointing to it and a comment its descendants. They are
+    returned flat in display (tree_id, lft) order. Each comment gets depth
+    (0 for direct replies to item), indent and its replies, so the page
+    renders without more queries."""
+    if getattr(item, 'is_story', False):
+        comments = Comment.objects.filter(to_story=item)
+        root_level = 0
+    else:
+        comments = Comment.objects.filter(
+            tree_id=item.tree_id, lft__gt=item.lft, rght__lt=item.rght)
+        root_level = item.level + 1
+    comments = list(comments.select_related('user').order_by('tree_id', 'lft'))
+    by_pk = {}
+    for comment in comments:
+        comment.depth = comment.level - root_level
+        comment.indent = comment.depth * INDENT
+        comment.replies = []
+        if comment.parent_id in by_pk:
+            by_pk[comment.parent_id].replies.append(comment)
+        by_pk[comment.pk] = comment
+    return comments
+
+
+def placeholder(kind, comment):
+    return mark_safe('<!--comment-%s-%s-->' % (kind, comment.pk.hex))
+
+
+def _fragment_key(comment):
+    # render_version changes with the comment and with anything below it,
+    # depth because the indentation is part of the HTML
+    return "news-comment-%s-%s-%s" % (comment.pk.hex, comment.render_version, comment.depth)
+
+
+def _render_siblings(comments, template):
+    keys = [_fragment_key(comment) for comment in comments]
+    cached = caches['comments'].get_many(keys)
+    fragments = []
+    for key, comment in zip(keys, comments):
+        fragment = cached.get(key)
+        if fragment is None:
+            fragment = template.render({'node': comment}) + \
+                _render_siblings(comment.replies, template)
+            caches['comments'].set(key, fragment)
+        fragments.append(fragment)
+    return ''.join(fragments)
+
+
+def render_comment_tree(comments, request, voted_item_ids=None):
+    """HTML of comments loaded by load_comment_tree.
+
+    The HTML of every subtree is cached under the version of its root, a
+    change deep in a thread re-renders only the comments on its path. Vote
+    arrows, points, age and owner links are filled in afterwards."""
+    from .templatetags.news_extra import user_arrows
+    roots = [comment for comment in comments if comment.depth == 0]
+    html = _render_siblings(roots, get_template('news/_comment.html'))
+
+    by_pk = {comment.pk.hex: comment for comment in comments}
+    user = request.user
+    arrows_template = get_template('news/_comment_arrows.html')
+    csrf_token = get_token(request)
+
+    def fill(match):
+        kind, comment = match.group(1), by_pk[match.group(2)]
+        if kind == 'arrows':
+            return arrows_template.render({
+                'node': comment, 'csrf_token': csrf_token,
+                'assignment_options': user_arrows(user, comment, voted_item_ids)})
+        if kind == 'points':
+            return "%s point%s" % (comment.points, pluralize(comment.points))
+        if kind == 'age':
+            return str(naturaltime(comment.created_at))
+        if comment.num_comments == 0 and user.pk == comment.user_id:
+            return format_html('| <a href="{}">edit</a> | <a href="{}">delete</a>',
+                               reverse('edit', kwargs={'pk': comment.pk}),
+                               reverse('delete', kwargs={'pk': comment.pk}))
+        return ''
+    return mark_safe(_PLACEHOLDER.sub(fill, html))
@@ -0,0 +1,78 @@
+"""Per-domain story counts and points, see DomainStats.
+
+Kept up to date incrementally: a story counts for its site and its product
+domain when it is submitted, and votes on it add to their points. Deleted
+stories are subtracted again. rebuild_domain_stats recomputes everything."""
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Max, Q, Sum
+
+from .models import DomainStats, Story
+
+
+def _domains_q(site, product):
+    q = Q(pk__in=[])
+    if site:
+        q |= Q(kind=DomainStats.SITE, domain=site)
+    if product:
+        q |= Q(kind=DomainStats.PRODUCT, domain=product)
+    return q
+
+
+def count_story(story):
+    """Adds a new story to the stats of its domains."""
+    for kind, domain in ((DomainStats.SITE, story.original_url_domain),
+                         (DomainStats.PRODUCT, story.product_url_domain)):
+        if not domain:
+            continue
+        stats = DomainStats.objects.filter(kind=kind, domain=domain)
+        if stats.update(story_count=F('story_count') + 1, last_seen_at=story.submitted_at):
+            continue
+        try:
+            with transaction.atomic():
+                DomainStats.objects.create(kind=kind, domain=domain, story_count=1,
+                                           last_seen_at=story.submitted_at)
+        except IntegrityError:
+            # Created by a concurrent submission meanwhile
+            stats.update(story_count=F('story_count') + 1, last_seen_at=story.submitted_at)
+
+
+def uncount_story(story):
+    """Removes a story about to be deleted, and its points, from the stats of its domains.
+
+    The votes on the story are deleted along with it, before or after the
+    story row. Their points must not be subtracted a second time, so the
+    domains of the row are cleared first."""
+    points = Story.objects.filter(pk=story.pk).values_list('points', flat=True).first()
+    if points is None:
+        return
+    DomainStats.objects.filter(
+        _domains_q(story.original_url_domain, story.product_url_domain)
+    ).update(story_count=F('story_count') - 1, total_points=F('total_points') - points)
+    Story.objects.filter(pk=story.pk).update(original_url_domain=None, product_url_domain=None)
+
+
+def add_points(site, product, points):
+    if points:
+        DomainStats.objects.filter(_domains_q(site, product)).update(
+            total_points=F('total_points') + points)
+
+
+def rebuild_domain_stats():
+    """Recomputes all the stats from the stories."""
+    DomainStats.objects.all().delete()
+    rows = []
+    for kind, field in ((DomainStats.SITE, 'original_url_domain'),
+                        (DomainStats.PRODUCT, 'product_url_domain')):
+        domains = Story.objects.exclude(**{field + '__isnull': True}).exclude(**{field: ''}) \
+            .values(field).order_by(field) \
+            .annotate(story_count=Count('pk'), total_points=Sum('points'), last_seen_at=Max('submitted_at'))
+        rows += [DomainStats(kind=kind, domain=row[field], story_count=row['story_count'],
+                             total_points=row['total_points'], last_seen_at=row['last_seen_at'])
+                 for row in domains.iterator()]
+    DomainStats.objects.bulk_create(rows, batch_size=500)
+    return len(rows)
+
+
+def top_domains(kind, order='story_count', limit=None):
+    """DomainStats of kind, the largest first. Served by the (kind, -order) indexes."""
+    return DomainStats.objects.filter(kind=kind, story_count__gt=0).order_by('-' + order, 'domain')[:limit]
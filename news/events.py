@@ -0,0 +1,129 @@
+"""Side effects of new stories, comments and votes, applied in batches.
+
+The receivers of Story, Comment and Vote only publish a DomainEvent. Its
+effects, the self upvote of new items, item counters, scores, karma, domain
+stats and the upvote index, are applied by apply_events, for a whole batch
+of events in one pass. With DOMAIN_EVENTS_ASYNC the event is stored in the
+outbox in the transaction of the write and processed later by
+process_events, otherwise it is applied right away."""
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from accounts.models import CustomUser
+from .domains import count_story, add_points
+from .models import DomainEvent, Item, Story, Vote
+from .ranking import rescore_stories
+from .upvotes import record_upvotes, forget_upvote
+
+
+def publish(kind, item_id, user_id, value=0):
+    event = DomainEvent(kind=kind, item_id=item_id, user_id=user_id, value=value)
+    if settings.DOMAIN_EVENTS_ASYNC:
+        event.save()
+    else:
+        apply_events([event])
+    return event
+
+
+def process_events(batch_size=500):
+    """Applies one batch of events from the outbox.
+
+    The effects are written and the events deleted in one transaction, a
+    batch that fails is retried as a whole and applied once. Returns the
+    number of events handled."""
+    with transaction.atomic():
+        events = list(DomainEvent.objects
+                      .select_for_update(skip_locked=True)
+                      .order_by('created_at', 'pk')[:batch_size])
+        if not events:
+            return 0
+        apply_events(events)
+        DomainEvent.objects.filter(pk__in=[event.pk for event in events]).delete()
+    return len(events)
+
+
+def apply_events(events):
+    """Applies the effects of events, in one pass for all of them."""
+    created = {event.item_id: event for event in events
+               if event.kind in (DomainEvent.STORY_SUBMITTED, DomainEvent.COMMENT_ADDED)}
+    changes = []
+    if created:
+        # Items deleted meanwhile get nothing
+        existing = set(Item.objects.filter(pk__in=list(created)).values_list('pk', flat=True))
+        stories = Story.objects.filter(pk__in=[pk for pk, event in created.items()
+                                               if event.kind == DomainEvent.STORY_SUBMITTED])
+        stories = list(stories.only('pk', 'user', 'duplicate_of', 'original_url_domain',
+                                    'product_url_domain', 'submitted_at'))
+        for story in stories:
+            # Before the self upvote, which adds to the points of the domains
+            count_story(story)
+        voted = set(Vote.objects.filter(item_id__in=existing).values_list('item_id', 'user_id'))
+        self_votes = [Vote(item_id=pk, user_id=created[pk].user_id, vote=1) for pk in existing
+                      if (pk, created[pk].user_id) not in voted]
+        # No receivers, counted below with the other votes
+        Vote.objects.bulk_create(self_votes)
+        changes += [(vote.item_id, vote.user_id, vote.vote, 1) for vote in self_votes]
+        for story in stories:
+            if story.duplicate_of_id is not None:
+                # Submitting a link again counts as an upvote of the original,
+                # published as an event of its own
+                Vote(item_id=story.duplicate_of_id, vote=1, user_id=story.user_id).save_if_new()
+    for event in events:
+        if event.kind == DomainEvent.VOTE_CAST:
+            changes.append((event.item_id, event.user_id, event.value, 1))
+        elif event.kind == DomainEvent.VOTE_RETRACTED:
+            changes.append((event.item_id, event.user_id, event.value, -1))
+    apply_votes(changes)
+
+
+def apply_votes(changes):
+    """Applies votes cast (sign=1) and retracted (sign=-1), given as
+    (item_id, user_id, vote, sign).
+
+    One UPDATE per item and per user, counters are added to with x = x + n,
+    so concurrent batches are not lost. Retracting the self upvote of an
+    item changes nothing, and users get no karma for their own items."""
+    if not changes:
+        return
+    authors = dict(Item.objects.filter(
+        pk__in={change[0] for change in changes}).values_list('pk', 'user_id'))
+    items = defaultdict(lambda: {'points': 0, 'upvotes': 0, 'downvotes': 0})
+    karma = defaultdict(int)
+    # Last state of the (user, item) pairs in the upvote index, a vote may
+    # be cast and retracted within the same batch
+    upvotes = {}
+    for item_id, user_id, vote, sign in changes:
+        if item_id not in authors:
+            continue
+        own = authors[item_id] == user_id
+        if sign < 0:
+            upvotes[(user_id, item_id)] = None
+            if own:
+                continue
+        elif vote > 0:
+            upvotes[(user_id, item_id)] = Vote(item_id=item_id, user_id=user_id, vote=vote)
+        counters = items[item_id]
+        counters['points'] += sign*vote
+        if vote > 0:
+            counters['upvotes'] += sign*vote
+        else:
+            counters['downvotes'] += sign*(-1)*vote
+        if not own:
+            karma[authors[item_id]] += sign*vote
+    for item_id, counters in items.items():
+        Item.objects.filter(pk=item_id).update(
+            **{name: F(name) + value for name, value in counters.items() if value})
+    for user_id, value in karma.items():
+        if value:
+            CustomUser.objects.filter(pk=user_id).update(karma=F('karma') + value)
+    stories = Story.objects.filter(pk__in=list(items))
+    rescore_stories(stories)
+    for pk, site, product in stories.values_list('pk', 'original_url_domain', 'product_url_domain'):
+        add_points(site, product, items[pk]['points'])
+    for (user_id, item_id), vote in upvotes.items():
+        if vote is None:
+            forget_upvote(Vote(item_id=item_id, user_id=user_id))
+    record_upvotes([vote for vote in upvotes.values() if vote is not None])
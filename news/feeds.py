@@ -1,6 +1,7 @@
 from django.contrib.syndication.views import Feed
 from .models import Story
-from .views import _newest, _front_page
+from .views import _newest
+from .snapshots import front_page_stories
 
 from django.conf import settings
 
@@ -38,4 +39,4 @@ class FrontPageFeed(NewestFeed):
     description = "Front Page stories"
 
     def items(self):
-        return _front_page(30, 0)
\ No newline at end of file
+        return front_page_stories('index', page=0, paging_size=30)
\ No newline at end of file
@@ -0,0 +1,53 @@
+"""Canonical form of submitted URLs, to find duplicate submissions.
+
+Two stories are duplicates when their links point to the same discussion
+and the same product after normalize_url. The fingerprint of the pair is
+stored on the original story, with a unique index."""
+import hashlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+# Query parameters added by newsletters, social networks and ad trackers.
+# Not ref, it selects the branch or tag on GitHub and the like.
+TRACKING_PARAMETERS = {
+    'fbclid', 'gclid', 'dclid', 'msclkid', 'igshid', 'mc_cid', 'mc_eid',
+    'ref_src', 'ref_url', 'source', 'share',
+}
+TRACKING_PREFIXES = ('utm_',)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def _is_tracking(name):
+    name = name.lower()
+    return name in TRACKING_PARAMETERS or name.startswith(TRACKING_PREFIXES)
+
+
+def normalize_url(url):
+    """url with lower case scheme and host, without www., default port,
+    fragment, tracking parameters and trailing slash, and with the other
+    parameters sorted. http and https are the same page."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    if scheme == 'http':
+        scheme = 'https'
+    host = (parts.hostname or '').rstrip('.')
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and port != DEFAULT_PORTS.get(parts.scheme.lower()):
+        host = '%s:%s' % (host, port)
+    path = parts.path.rstrip('/')
+    query = urlencode(sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                             if not _is_tracking(name)))
+    return urlunsplit((scheme, host, path, query, ''))
+
+
+def url_fingerprint(original_url, product_url):
+    """Hex digest identifying the pair of links of a story, None without both links."""
+    if not original_url or not product_url:
+        return None
+    pair = "%s\n%s" % (normalize_url(original_url), normalize_url(product_url))
+    return hashlib.sha1(pair.encode('utf-8')).hexdigest()
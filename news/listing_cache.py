@@ -0,0 +1,85 @@
+"""Cache of listing pages, keyed by the filters of the listing.
+
+Every filter value (a site, a submitter, ...) has a generation counter in the
+cache, and the key of a page contains the generations of all the filters it
+uses. A new story bumps the generations of the unfiltered pages and of its
+own filter values, which invalidates exactly the pages it may appear on. Private filters, whose pages
+only their owner may see, are keyed by the user."""
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+
+# Filters of a page that only the user named by the value may see
+PRIVATE_FILTERS = {'upvoted_by'}
+# Scope of the generation of the unfiltered pages
+ALL = ('all', '')
+
+
+def _generation_key(listing, name, value):
+    digest = hashlib.sha1(("%s\n%s\n%s" % (listing, name, value)).encode('utf-8')).hexdigest()
+    return "news-listing-gen-%s" % (digest)
+
+
+def _new_generation():
+    # Never reuses the value of an evicted counter, pages cached under it
+    # may still be around
+    return time.time_ns()
+
+
+def _generations(listing, scopes):
+    keys = [_generation_key(listing, name, value) for name, value in scopes]
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            cache.add(key, _new_generation(), timeout=None)
+            generations[key] = cache.get(key)
+    return [generations[key] for key in keys]
+
+
+def page_key(listing, filters, page=0, after=None):
+    """Cache key of a page of listing, filters maps filter names to values.
+
+    The filters are put in canonical order, so the order of the query string
+    does not matter."""
+    scopes = sorted((name, str(value)) for name, value in filters.items()) or [ALL]
+    canonical = repr((listing, scopes, page, after, _generations(listing, scopes)))
+    private = sorted(str(value) for name, value in filters.items() if name in PRIVATE_FILTERS)
+    return "news-listing-%s%s-%s" % (
+        listing, ''.join('-user-%s' % (value) for value in private),
+        hashlib.sha1(canonical.encode('utf-8')).hexdigest())
+
+
+def cached_page(listing, filters, compute, page=0, after=None, timeout=None):
+    """Returns compute() through the cache, see page_key."""
+    key = page_key(listing, filters, page=page, after=after)
+    return cache.get_or_set(key, compute, timeout=timeout)
+
+
+def _bump(listing, scopes):
+    for name, value in scopes:
+        key = _generation_key(listing, name, str(value))
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_generation(), timeout=None)
+
+
+def invalidate(listing, filters):
+    """Drops the cached pages of listing whose filters include one of the
+    given filter values, for instance all pages a new story appears on.
+
+    Done again after the commit, a page computed before it from the old rows
+    would stay in the cache otherwise."""
+    scopes = [ALL] + [(name, value) for name, value in filters.items()]
+    _bump(listing, scopes)
+    transaction.on_commit(lambda: _bump(listing, scopes))
+
+
+def invalidate_private(listing, name, value):
+    """Drops the cached pages of listing filtered by the private filter name=value."""
+    scopes = [(name, value)]
+    _bump(listing, scopes)
+    transaction.on_commit(lambda: _bump(listing, scopes))
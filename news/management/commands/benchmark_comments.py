@@ -0,0 +1,120 @@
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import F, Max
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from accounts.models import CustomUser
+from news.markdown import RENDERER_VERSION, render_markdown
+from news.models import Item, Story, Comment
+from news.views import item
+
+
+class Rollback(Exception):
+    pass
+
+
+def build_thread(story, count, reply_ratio=0.8, seed=0):
+    """Adds count comments to story without going through save().
+
+    Saving comments one by one moves the trees and runs the receivers, which
+    takes minutes for a large thread. The tree fields are computed here and
+    the rows written with bulk inserts instead. Top level comments are the
+    roots of their own trees, as in the item view."""
+    rnd = random.Random(seed)
+    children = {}
+    roots = []
+    parents = {}
+    for i in range(count):
+        pk = uuid.uuid4()
+        if roots and rnd.random() < reply_ratio:
+            parents[pk] = rnd.choice(list(parents))
+            children[parents[pk]].append(pk)
+        else:
+            parents[pk] = None
+            roots.append(pk)
+        children[pk] = []
+
+    tree = {}
+    next_tree_id = (Item.objects.aggregate(Max('tree_id'))['tree_id__max'] or 0) + 1
+    for tree_id, root in enumerate(roots, start=next_tree_id):
+        # Iterative depth-first numbering, threads can be deep
+        counter = 1
+        tree[root] = [tree_id, counter, None, 0]
+        stack = [(root, iter(children[root]))]
+        while stack:
+            node, rest = stack[-1]
+            child = next(rest, None)
+            counter += 1
+            if child is None:
+                tree[node][2] = counter
+                stack.pop()
+            else:
+                tree[child] = [tree_id, counter, None, tree[node][3] + 1]
+                stack.append((child, iter(children[child])))
+
+    Item.objects.bulk_create([
+        Item(id=pk, user_id=story.user_id, parent_id=parents[pk], points=1, upvotes=1,
+             num_comments=(tree[pk][2] - tree[pk][1] - 1) // 2,
+             tree_id=tree[pk][0], lft=tree[pk][1], rght=tree[pk][2], level=tree[pk][3])
+        for pk in parents], batch_size=500)
+    # bulk_create() refuses multi-table inheritance, the comment rows are
+    # inserted directly
+    fields = Comment._meta.local_concrete_fields
+    comments = []
+    for i, pk in enumerate(parents):
+        text = "Comment number %s with *some* markdown" % (i)
+        comments.append(Comment(item_ptr_id=pk, to_story_id=story.pk, text=text,
+                                text_html=render_markdown(text),
+                                text_html_version=RENDERER_VERSION))
+    with connection.cursor() as cursor:
+        cursor.executemany("INSERT INTO %s (%s) VALUES (%s)" % (
+            connection.ops.quote_name(Comment._meta.db_table),
+            ', '.join(connection.ops.quote_name(field.column) for field in fields),
+            ', '.join(['%s'] * len(fields))),
+            [[field.get_db_prep_save(getattr(comment, field.attname), connection) for field in fields]
+             for comment in comments])
+    Item.objects.filter(pk=story.pk).update(num_comments=F('num_comments') + count)
+    story.refresh_from_db()
+    return story
+
+
+class Command(BaseCommand):
+    help = "Measures the queries and the time needed to render the item page of a large thread. Everything is rolled back afterwards."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--comments', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self._benchmark(options['comments'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def _benchmark(self, count):
+        user = CustomUser.objects.create(username='benchmark-reader')
+        story = Story(user=user, title='benchmark', product_title='benchmark',
+                      original_url='https://example.org/thread',
+                      product_url='https://example.com/thread')
+        story.save()
+        build_thread(story, count)
+        factory = RequestFactory()
+        for run in ('cold', 'warm', 'one new reply'):
+            if run == 'one new reply':
+                parent = Comment.objects.filter(to_story=story).order_by('-level').first()
+                Comment(user=user, to_story=story, parent=parent, text='A new reply').save()
+            request = factory.get(story.get_absolute_url())
+            request.user = user
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                response = item(request, story.pk)
+                elapsed = time.perf_counter() - start
+            assert response.status_code == 200, response.status_code
+            self.stdout.write("%s: %s comments rendered in %.3fs with %s queries" % (
+                run, Comment.objects.filter(to_story=story).count(), elapsed, len(queries)))
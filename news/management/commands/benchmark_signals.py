@@ -0,0 +1,30 @@
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db.models.signals import pre_save, post_save
+
+
+class Command(BaseCommand):
+    help = "Lists the pre_save and post_save receivers run per save of every model, and times the dispatch for the models without any, without touching the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sends', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        count = options['sends']
+        for model in apps.get_models():
+            receivers = len(pre_save._live_receivers(model)) + len(post_save._live_receivers(model))
+            if receivers:
+                # Running them needs real rows
+                self.stdout.write("%-32s %3s receivers" % (model._meta.label, receivers))
+                continue
+            instance = model()
+            start = time.perf_counter()
+            for i in range(count):
+                pre_save.send(sender=model, instance=instance, raw=False, using='default', update_fields=None)
+                post_save.send(sender=model, instance=instance, created=False, raw=False,
+                               using='default', update_fields=None)
+            elapsed = time.perf_counter() - start
+            self.stdout.write("%-32s %3s receivers %8.2f us/save" % (
+                model._meta.label, receivers, elapsed / count * 1e6))
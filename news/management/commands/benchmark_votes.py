@@ -0,0 +1,66 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory, override_settings
+
+from accounts.models import CustomUser
+from news.models import Story
+from news.views import _vote
+from news.vote_queue import flush_votes
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Compares votes/sec of the synchronous and the queued vote path. Everything is rolled back afterwards."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--votes', type=int, default=500)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self._benchmark(options['votes'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def _benchmark(self, count):
+        factory = RequestFactory()
+        author = CustomUser.objects.create(username='benchmark-author')
+        voters = [CustomUser.objects.create(username='benchmark-voter-%s' % (i))
+                  for i in range(count)]
+        stories = []
+        for name in ('sync', 'queued'):
+            story = Story(user=author, title=name, product_title=name,
+                          original_url='https://example.org/%s' % (name),
+                          product_url='https://example.com/%s' % (name))
+            story.save()
+            stories.append(story)
+
+        def cast(story):
+            for voter in voters:
+                request = factory.post('/item/%s/upvote' % (story.pk))
+                request.user = voter
+                _vote(request, story.pk, vote=1)
+
+        start = time.perf_counter()
+        cast(stories[0])
+        sync = time.perf_counter() - start
+
+        with override_settings(VOTE_QUEUE=True):
+            start = time.perf_counter()
+            cast(stories[1])
+            enqueued = time.perf_counter() - start
+            while flush_votes():
+                pass
+            queued = time.perf_counter() - start
+
+        for story in stories:
+            story.refresh_from_db()
+        self.stdout.write("synchronous: %8.1f votes/sec (%s points)" % (count/sync, stories[0].points))
+        self.stdout.write("queued:      %8.1f votes/sec accepted by the view" % (count/enqueued))
+        self.stdout.write("queued:      %8.1f votes/sec including the flush (%s points)" % (count/queued, stories[1].points))
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from news.events import process_events
+
+
+class Command(BaseCommand):
+    help = "Applies the domain events recorded in the outbox when DOMAIN_EVENTS_ASYNC is enabled."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--forever', action='store_true',
+                            help="Keep polling the outbox instead of exiting once it is empty.")
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help="Seconds to wait between polls when the outbox is empty.")
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            count = process_events(batch_size=options['batch_size'])
+            total += count
+            if count:
+                continue
+            if not options['forever']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write("Processed %s events" % (total))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from news.domains import rebuild_domain_stats
+
+
+class Command(BaseCommand):
+    help = "Recomputes the story counts and points of all domains from the stories. They are maintained incrementally, run it after bulk changes made without the receivers."
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = rebuild_domain_stats()
+        self.stdout.write("Rebuilt the stats of %s domains" % (count))
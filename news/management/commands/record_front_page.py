@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from news.snapshots import record_snapshot, snapshot_due
+
+
+class Command(BaseCommand):
+    help = "Records the top stories of the ranked listings for the /front archive. Does nothing if the last record is more recent than FRONT_PAGE_HISTORY_INTERVAL, run it e.g. every few minutes from cron."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help="Record even if the last record is recent.")
+        parser.add_argument('--as-of',
+                            help="Record the front page as it looked at this ISO datetime, to fill the archive.")
+
+    def handle(self, *args, **options):
+        as_of = None
+        if options['as_of']:
+            as_of = parse_datetime(options['as_of'])
+            if as_of is None:
+                raise CommandError("Invalid datetime %r" % (options['as_of']))
+            if timezone.is_naive(as_of):
+                as_of = timezone.make_aware(as_of)
+        elif not options['force'] and not snapshot_due():
+            self.stdout.write("Last record is recent, nothing to do")
+            return
+        snapshots = record_snapshot(as_of=as_of)
+        self.stdout.write("Recorded %s listings at %s" % (len(snapshots), snapshots[0].taken_at))
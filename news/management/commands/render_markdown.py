@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from news.markdown import RENDERER_VERSION, render_text_html
+from news.models import Story, Comment
+
+
+class Command(BaseCommand):
+    help = "Renders the markdown of stories and comments into their stored text_html, in batches. By default only the items rendered by an older renderer version."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help="Render every item, not only the outdated ones.")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        for name, model in (('stories', Story), ('comments', Comment)):
+            items = model.objects.all()
+            if not options['all']:
+                items = items.filter(text_html_version__lt=RENDERER_VERSION)
+            count = render_text_html(items, batch_size=options['batch_size'])
+            self.stdout.write("Rendered %s %s" % (count, name))
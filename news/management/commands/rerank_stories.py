@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from news.models import Story
+from news.ranking import rescore_stories, stories_to_rescore
+from news.snapshots import build_snapshot, publish_snapshot, published_snapshot
+
+
+class Command(BaseCommand):
+    help = "Refreshes the stored rank_score of the stories that can still move on the front page and publishes a new front page snapshot. Run it periodically, e.g. every minute from cron."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help="Rescore every story, not only the ones that can still reach a listing of the published snapshot.")
+
+    def handle(self, *args, **options):
+        stories = Story.objects.filter(duplicate_of__isnull=True)
+        if not options['all']:
+            stories = stories_to_rescore(stories, published_snapshot())
+        count = rescore_stories(stories)
+        self.stdout.write("Rescored %s stories" % (count))
+        snapshot = publish_snapshot(build_snapshot())
+        self.stdout.write("Published front page snapshot %s" % (snapshot['version']))
@@ -0,0 +1,56 @@
+import mistune
+from django.db.models import F
+
+
+# Stored with every rendered text. Bump it when MarkdownRenderer changes and
+# run the render_markdown command to regenerate the stored HTML.
+RENDERER_VERSION = 1
+
+
+class MarkdownRenderer(mistune.Renderer):
+
+    @classmethod
+    def setup(cls):
+        renderer = cls(escape=True, hard_wrap=True)
+        return mistune.Markdown(renderer=renderer)
+
+    def header(self, text, level, raw=None):
+        level = min(level + 2, 6)
+        return super().header(text, level, raw)
+
+
+markdown = MarkdownRenderer.setup()
+
+
+def render_markdown(text):
+    return markdown(text or '')
+
+
+def render_text_html(queryset, batch_size=500):
+    """Renders and stores text_html for every story or comment in queryset.
+
+    The render_version of the threads of the rendered items is bumped, their
+    cached comment fragments hold the old HTML. Returns the number of
+    rendered items."""
+    count = 0
+    batch = []
+    for item in queryset.only('pk', 'text', 'tree_id').iterator(chunk_size=batch_size):
+        item.text_html = render_markdown(item.text)
+        item.text_html_version = RENDERER_VERSION
+        batch.append(item)
+        if len(batch) >= batch_size:
+            count += _store_html(queryset.model, batch)
+            batch = []
+    count += _store_html(queryset.model, batch)
+    return count
+
+
+def _store_html(model, items):
+    from .models import Item
+    if items:
+        model.objects.bulk_update(items, ['text_html', 'text_html_version'])
+        # A fragment holds the HTML of its replies too, every comment of the
+        # thread gets a new fragment key
+        Item.objects.filter(tree_id__in={item.tree_id for item in items}).update(
+            render_version=F('render_version') + 1)
+    return len(items)
@@ -0,0 +1,46 @@
+# Generated by Django 3.1 on 2026-10-18 11:54
+
+import datetime
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+# The formula of news.ranking.rank_score as of this migration
+GRAVITY = 1.8
+AGE_OFFSET_HOURS = 2.1
+DENOMINATOR_EPSILON = 0.001
+
+
+def score_stories(apps, schema_editor):
+    Story = apps.get_model('news', 'Story')
+    now = timezone.now()
+    batch = []
+    for story in Story.objects.filter(duplicate_of__isnull=True).only('pk', 'points', 'created_at').iterator():
+        age_hours = (now - story.created_at) / datetime.timedelta(hours=1)
+        story.rank_score = (story.points - 1) / ((age_hours + AGE_OFFSET_HOURS) ** GRAVITY + DENOMINATOR_EPSILON)
+        batch.append(story)
+        if len(batch) >= 500:
+            Story.objects.bulk_update(batch, ['rank_score'])
+            batch = []
+    Story.objects.bulk_update(batch, ['rank_score'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0017_auto_20201107_1410'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='rank_score',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(fields=['-rank_score'], name='news_story_rank_sc_7346f4_idx'),
+        ),
+        migrations.RunPython(score_stories, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.1 on 2026-10-18 12:02
+
+from django.db import migrations, models
+from django.db.models import Count, Sum, Q
+
+
+def remove_duplicate_votes(apps, schema_editor):
+    """Keeps the first vote of every (user, item) pair and recounts the
+    points of the items that had duplicates."""
+    Vote = apps.get_model('news', 'Vote')
+    Item = apps.get_model('news', 'Item')
+    duplicates = Vote.objects.values('user', 'item').annotate(
+        n=Count('id')).filter(n__gt=1).order_by()
+    items = set()
+    for pair in duplicates:
+        votes = Vote.objects.filter(user=pair['user'], item=pair['item'])\
+            .order_by('created_at', 'id').values_list('id', flat=True)
+        Vote.objects.filter(pk__in=list(votes)[1:]).delete()
+        items.add(pair['item'])
+    for item_id in items:
+        counts = Vote.objects.filter(item=item_id).aggregate(
+            points=Sum('vote'),
+            upvotes=Sum('vote', filter=Q(vote__gt=0)),
+            downvotes=Sum('vote', filter=Q(vote__lt=0)))
+        Item.objects.filter(pk=item_id).update(
+            points=counts['points'] or 0,
+            upvotes=counts['upvotes'] or 0,
+            downvotes=-(counts['downvotes'] or 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0019_queuedvote'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_votes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='vote',
+            constraint=models.UniqueConstraint(fields=('user', 'item'), name='news_vote_unique_user_item'),
+        ),
+    ]
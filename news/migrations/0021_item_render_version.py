@@ -0,0 +1,18 @@
+# Generated by Django 3.1 on 2026-10-18 12:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0020_vote_unique_user_item'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='render_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
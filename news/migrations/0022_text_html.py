@@ -0,0 +1,61 @@
+# Generated by Django 3.1 on 2026-10-18 12:16
+
+import mistune
+from django.db import migrations, models
+
+
+# news.markdown as of this migration
+RENDERER_VERSION = 1
+
+
+class MarkdownRenderer(mistune.Renderer):
+
+    def header(self, text, level, raw=None):
+        level = min(level + 2, 6)
+        return super().header(text, level, raw)
+
+
+def render_texts(apps, schema_editor):
+    markdown = mistune.Markdown(renderer=MarkdownRenderer(escape=True, hard_wrap=True))
+    for name in ('Story', 'Comment'):
+        model = apps.get_model('news', name)
+        batch = []
+        for item in model.objects.only('pk', 'text').iterator():
+            item.text_html = markdown(item.text or '')
+            item.text_html_version = RENDERER_VERSION
+            batch.append(item)
+            if len(batch) >= 500:
+                model.objects.bulk_update(batch, ['text_html', 'text_html_version'])
+                batch = []
+        model.objects.bulk_update(batch, ['text_html', 'text_html_version'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0021_item_render_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='text_html',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='text_html_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='story',
+            name='text_html',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='story',
+            name='text_html_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(render_texts, migrations.RunPython.noop),
+    ]
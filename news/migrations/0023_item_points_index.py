@@ -0,0 +1,17 @@
+# Generated by Django 3.1 on 2026-10-18 12:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0022_text_html'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['points', 'created_at'], name='news_item_points_d03885_idx'),
+        ),
+    ]
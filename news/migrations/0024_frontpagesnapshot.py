@@ -0,0 +1,26 @@
+# Generated by Django 3.1 on 2026-10-18 12:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0023_item_points_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FrontPageSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('taken_at', models.DateTimeField()),
+                ('listing', models.CharField(max_length=16)),
+                ('story_ids', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='frontpagesnapshot',
+            index=models.Index(fields=['listing', 'taken_at'], name='news_frontp_listing_1fc64a_idx'),
+        ),
+    ]
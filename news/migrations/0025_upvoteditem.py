@@ -0,0 +1,49 @@
+# Generated by Django 3.1 on 2026-10-18 12:26
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import F
+
+
+def fill_upvoted_items(apps, schema_editor):
+    Vote = apps.get_model('news', 'Vote')
+    Story = apps.get_model('news', 'Story')
+    UpvotedItem = apps.get_model('news', 'UpvotedItem')
+    story_ids = set(Story.objects.values_list('pk', flat=True))
+    votes = Vote.objects.filter(vote__gt=0, item__parent=None).exclude(
+        user=F('item__user')).values_list('user_id', 'item_id', 'item__created_at')
+    UpvotedItem.objects.bulk_create([
+        UpvotedItem(user_id=user_id, item_id=item_id, is_story=item_id in story_ids,
+                    item_created_at=created_at)
+        for user_id, item_id, created_at in votes.iterator()], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('news', '0024_frontpagesnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UpvotedItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_story', models.BooleanField()),
+                ('item_created_at', models.DateTimeField()),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='news.item')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='upvoteditem',
+            index=models.Index(fields=['user', 'is_story', 'item_created_at', 'item'], name='news_upvote_user_id_5539d3_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='upvoteditem',
+            constraint=models.UniqueConstraint(fields=('user', 'item'), name='news_upvoteditem_unique_user_item'),
+        ),
+        migrations.RunPython(fill_upvoted_items, migrations.RunPython.noop),
+    ]
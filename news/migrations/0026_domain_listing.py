@@ -0,0 +1,92 @@
+# Generated by Django 3.1 on 2026-10-18 12:33
+
+from django.db import migrations, models
+import django.utils.timezone
+from django.db.models import Count, Max, OuterRef, Subquery, Sum
+
+
+def fill_submitted_at_and_stats(apps, schema_editor):
+    Item = apps.get_model('news', 'Item')
+    Story = apps.get_model('news', 'Story')
+    DomainStats = apps.get_model('news', 'DomainStats')
+    Story.objects.update(submitted_at=Subquery(
+        Item.objects.filter(pk=OuterRef('pk')).values('created_at')))
+    rows = []
+    for kind, field in (('site', 'original_url_domain'), ('product', 'product_url_domain')):
+        domains = Story.objects.exclude(**{field + '__isnull': True}).exclude(**{field: ''}) \
+            .values(field).order_by(field) \
+            .annotate(story_count=Count('pk'), total_points=Sum('points'), last_seen_at=Max('submitted_at'))
+        rows += [DomainStats(kind=kind, domain=row[field], story_count=row['story_count'],
+                             total_points=row['total_points'], last_seen_at=row['last_seen_at'])
+                 for row in domains.iterator()]
+    DomainStats.objects.bulk_create(rows, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0025_upvoteditem'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DomainStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('site', 'site'), ('product', 'product')], max_length=16)),
+                ('domain', models.CharField(max_length=255)),
+                ('story_count', models.PositiveIntegerField(default=0)),
+                ('total_points', models.IntegerField(default=0)),
+                ('last_seen_at', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name_plural': 'domain stats',
+            },
+        ),
+        migrations.AddField(
+            model_name='story',
+            name='submitted_at',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='item',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='story',
+            name='original_url_domain',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='story',
+            name='product_url_domain',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.RunPython(fill_submitted_at_and_stats, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='story',
+            name='submitted_at',
+            field=models.DateTimeField(editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(fields=['original_url_domain', 'submitted_at', 'item_ptr'], name='news_story_origina_879784_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(fields=['product_url_domain', 'submitted_at', 'item_ptr'], name='news_story_product_ab9281_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='domainstats',
+            index=models.Index(fields=['kind', '-story_count'], name='news_domain_kind_407f52_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='domainstats',
+            index=models.Index(fields=['kind', '-total_points'], name='news_domain_kind_969453_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='domainstats',
+            constraint=models.UniqueConstraint(fields=('kind', 'domain'), name='news_domainstats_unique_kind_domain'),
+        ),
+    ]
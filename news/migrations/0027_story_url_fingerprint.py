@@ -0,0 +1,77 @@
+# Generated by Django 3.1 on 2026-10-18 12:36
+
+import hashlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from django.db import migrations, models
+
+
+# news.fingerprints as of this migration
+TRACKING_PARAMETERS = {
+    'fbclid', 'gclid', 'dclid', 'msclkid', 'igshid', 'mc_cid', 'mc_eid',
+    'ref_src', 'ref_url', 'source', 'share',
+}
+TRACKING_PREFIXES = ('utm_',)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def _is_tracking(name):
+    name = name.lower()
+    return name in TRACKING_PARAMETERS or name.startswith(TRACKING_PREFIXES)
+
+
+def normalize_url(url):
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    if scheme == 'http':
+        scheme = 'https'
+    host = (parts.hostname or '').rstrip('.')
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and port != DEFAULT_PORTS.get(parts.scheme.lower()):
+        host = '%s:%s' % (host, port)
+    path = parts.path.rstrip('/')
+    query = urlencode(sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                             if not _is_tracking(name)))
+    return urlunsplit((scheme, host, path, query, ''))
+
+
+def url_fingerprint(original_url, product_url):
+    if not original_url or not product_url:
+        return None
+    pair = "%s\n%s" % (normalize_url(original_url), normalize_url(product_url))
+    return hashlib.sha1(pair.encode('utf-8')).hexdigest()
+
+
+def fill_fingerprints(apps, schema_editor):
+    # The oldest of the stories with the same links is the original one,
+    # the others keep no fingerprint
+    Story = apps.get_model('news', 'Story')
+    seen = set()
+    stories = Story.objects.filter(duplicate_of__isnull=True).order_by('submitted_at', 'pk')
+    for pk, original_url, product_url in stories.values_list('pk', 'original_url', 'product_url').iterator():
+        fingerprint = url_fingerprint(original_url, product_url)
+        if fingerprint is None or fingerprint in seen:
+            continue
+        seen.add(fingerprint)
+        Story.objects.filter(pk=pk).update(url_fingerprint=fingerprint)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0026_domain_listing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='url_fingerprint',
+            field=models.CharField(editable=False, max_length=40, null=True, unique=True),
+        ),
+        migrations.RunPython(fill_fingerprints, migrations.RunPython.noop),
+    ]
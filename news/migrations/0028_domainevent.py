@@ -0,0 +1,24 @@
+# Generated by Django 3.1 on 2026-10-18 12:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0027_story_url_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DomainEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('kind', models.CharField(choices=[('story_submitted', 'story submitted'), ('comment_added', 'comment added'), ('vote_cast', 'vote cast'), ('vote_retracted', 'vote retracted')], max_length=32)),
+                ('item_id', models.UUIDField()),
+                ('user_id', models.UUIDField()),
+                ('value', models.SmallIntegerField(default=0)),
+            ],
+        ),
+    ]
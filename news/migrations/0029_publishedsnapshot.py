@@ -0,0 +1,23 @@
+# Generated by Django 3.1 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0028_domainevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PublishedSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.CharField(max_length=32, unique=True)),
+                ('built_at', models.DateTimeField(db_index=True)),
+                ('size', models.PositiveIntegerField()),
+                ('listings', models.TextField()),
+            ],
+        ),
+    ]
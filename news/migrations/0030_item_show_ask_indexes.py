@@ -0,0 +1,21 @@
+# Generated by Django 3.1 on 2026-10-18 13:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0029_publishedsnapshot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(condition=models.Q(is_show=True), fields=['is_show'], name='news_item_is_show_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(condition=models.Q(is_ask=True), fields=['is_ask'], name='news_item_is_ask_idx'),
+        ),
+    ]
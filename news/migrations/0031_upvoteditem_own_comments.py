@@ -0,0 +1,29 @@
+# Generated by Django 3.1 on 2026-10-18 13:55
+
+from django.db import migrations
+from django.db.models import F
+
+
+def add_own_comments(apps, schema_editor):
+    # comments?upvoted_by= lists the user's own comments, 0025 left out the
+    # self upvotes of all items
+    Vote = apps.get_model('news', 'Vote')
+    Comment = apps.get_model('news', 'Comment')
+    UpvotedItem = apps.get_model('news', 'UpvotedItem')
+    comment_ids = Comment.objects.filter(parent=None).values('pk')
+    votes = Vote.objects.filter(vote__gt=0, item__in=comment_ids, user=F('item__user')) \
+        .values_list('user_id', 'item_id', 'item__created_at')
+    UpvotedItem.objects.bulk_create([
+        UpvotedItem(user_id=user_id, item_id=item_id, is_story=False, item_created_at=created_at)
+        for user_id, item_id, created_at in votes.iterator()], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0030_item_show_ask_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_own_comments, migrations.RunPython.noop),
+    ]
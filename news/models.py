@@ -2,7 +2,8 @@ import uuid
 
 from accounts.models import CustomUser
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.utils import timezone
 from mptt.models import MPTTModel, TreeForeignKey
 from django.urls import reverse
 
@@ -12,15 +13,22 @@ from urllib.parse import urlparse
 class Item(MPTTModel):
     class Meta:
         indexes = [
-            #models.Index(fields=['points', 'created_at']),
+            # Max(points) bounds the candidate window of ranking, see news.ranking
+            models.Index(fields=['points', 'created_at']),
             models.Index(fields=['created_at', 'points']),
             models.Index(fields=['created_at', 'id']),
             models.Index(fields=['id', 'created_at']),
+            # The Show and Ask listings of the front page snapshot, see
+            # news.snapshots.build_snapshot
+            models.Index(fields=['is_show'], condition=models.Q(is_show=True), name='news_item_is_show_idx'),
+            models.Index(fields=['is_ask'], condition=models.Q(is_ask=True), name='news_item_is_ask_idx'),
         ]
         # ordering = ['-created_at']
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Set on creation, not by the save like auto_now_add, so that Story can
+    # copy it before the rows are written
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     changed_at = models.DateTimeField(auto_now=True)
     upvotes = models.PositiveIntegerField(default=0, editable=False)
     downvotes = models.PositiveIntegerField(default=0, editable=False)
@@ -32,27 +40,37 @@ class Item(MPTTModel):
 
     is_ask = models.BooleanField(default=False)
     is_show = models.BooleanField(default=False)
+    # Bumped when the item or a comment below it changes, keys the cached
+    # HTML of comment subtrees
+    render_version = models.PositiveIntegerField(default=0, editable=False)
 
     def get_absolute_url(self):
         return reverse("item", kwargs={"pk": self.pk})
 
-    def can_be_upvoted_by(self, user):
+    def _voted_by(self, user, voted_item_ids=None):
+        # voted_item_ids is the set of items the user voted on, fetched once
+        # per page by the views. Without it, ask the database.
+        if voted_item_ids is not None:
+            return self.pk in voted_item_ids
+        return Vote.objects.filter(user=user, item=self).count() > 0
+
+    def can_be_upvoted_by(self, user, voted_item_ids=None):
         if not user.is_authenticated:
             return False
-        if user == self.user:
+        if user.pk == self.user_id:
             return False
-        if Vote.objects.filter(user=user, item=self).count():
+        if self._voted_by(user, voted_item_ids):
             return False
         return True
 
-    def can_be_downvoted_by(self, user):
+    def can_be_downvoted_by(self, user, voted_item_ids=None):
         if not user.is_authenticated:
             return False
-        if user == self.user:
+        if user.pk == self.user_id:
             return False
         else:
             if user.karma > 1:
-                if not Vote.objects.filter(user=user, item=self).count():
+                if not self._voted_by(user, voted_item_ids):
                     return True
         return False
 
@@ -69,6 +87,10 @@ class Story(Item):
             models.Index(fields=['original_url_domain',
                                  'product_url_domain',
                                  'duplicate_of']),
+            models.Index(fields=['-rank_score']),
+            # newest?site= and newest?product=, see views._newest
+            models.Index(fields=['original_url_domain', 'submitted_at', 'item_ptr']),
+            models.Index(fields=['product_url_domain', 'submitted_at', 'item_ptr']),
         ]
     is_story = True
 
@@ -79,12 +101,23 @@ class Story(Item):
     product_url = models.URLField(blank=True)
     product_title = models.CharField(max_length=255, blank=True)
     text = models.TextField(null=True, blank=True)
+    # text rendered by news.markdown on save
+    text_html = models.TextField(blank=True, default='', editable=False)
+    text_html_version = models.PositiveSmallIntegerField(default=0, editable=False)
     duplicate_of = models.ForeignKey(
         'Story', on_delete=models.CASCADE, null=True, blank=True)
     original_url_domain = models.CharField(
-        max_length=255, null=True, blank=True, db_index=True)
+        max_length=255, null=True, blank=True)
     product_url_domain = models.CharField(
-        max_length=255, null=True, blank=True, db_index=True)
+        max_length=255, null=True, blank=True)
+    # Copy of created_at, which lives in the Item table and cannot be part
+    # of an index with the domains
+    submitted_at = models.DateTimeField(editable=False)
+    # news.fingerprints.url_fingerprint of the links, only set on stories
+    # that are not duplicates
+    url_fingerprint = models.CharField(max_length=40, null=True, unique=True, editable=False)
+    # Hotness score, refreshed on votes and by the rerank_stories command
+    rank_score = models.FloatField(default=0, editable=False)
 
     def __str__(self):
         return self.title + ' - ' + self.product_title
@@ -94,7 +127,7 @@ class Story(Item):
     #     o = urlparse(self.url)
     #     return o.hostname
 
-    def can_be_downvoted_by(self, user):
+    def can_be_downvoted_by(self, user, voted_item_ids=None):
         return False
 
     # def Kcomments(self):
@@ -109,6 +142,9 @@ class Comment(Item):
     is_comment = True
 
     text = models.TextField()
+    # text rendered by news.markdown on save
+    text_html = models.TextField(blank=True, default='', editable=False)
+    text_html_version = models.PositiveSmallIntegerField(default=0, editable=False)
     to_story = models.ForeignKey(
         Story, on_delete=models.CASCADE, related_name="comments")
 
@@ -123,6 +159,12 @@ class Comment(Item):
 
 
 class Vote(models.Model):
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'item'],
+                                    name='news_vote_unique_user_item'),
+        ]
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     changed_at = models.DateTimeField(auto_now=True)
@@ -130,3 +172,119 @@ class Vote(models.Model):
     # vote = None # -1 | 0 | 1 --> BooleanField(default=None, null=True)??
     vote = models.SmallIntegerField(default=1)
     user = models.ForeignKey(to=CustomUser, on_delete=models.CASCADE)
+
+    def save_if_new(self):
+        """Inserts the vote unless the user already voted on the item.
+
+        The unique (user, item) constraint decides, there is no lookup
+        before the insert. Returns True if the vote was inserted."""
+        try:
+            with transaction.atomic():
+                self.save(force_insert=True)
+        except IntegrityError:
+            return False
+        return True
+
+
+class QueuedVote(models.Model):
+    """A vote accepted by the view but not yet applied, see news.vote_queue."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    vote = models.SmallIntegerField(default=1)
+    user = models.ForeignKey(to=CustomUser, on_delete=models.CASCADE)
+
+
+class DomainEvent(models.Model):
+    """A write whose side effects are still to be applied, see news.events.
+
+    Plain IDs instead of foreign keys, the item or the vote may be gone by
+    the time the event is processed."""
+    STORY_SUBMITTED = 'story_submitted'
+    COMMENT_ADDED = 'comment_added'
+    VOTE_CAST = 'vote_cast'
+    VOTE_RETRACTED = 'vote_retracted'
+    KINDS = [(STORY_SUBMITTED, 'story submitted'), (COMMENT_ADDED, 'comment added'),
+             (VOTE_CAST, 'vote cast'), (VOTE_RETRACTED, 'vote retracted')]
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    kind = models.CharField(max_length=32, choices=KINDS)
+    item_id = models.UUIDField()
+    user_id = models.UUIDField()
+    # The vote of VOTE_CAST and VOTE_RETRACTED
+    value = models.SmallIntegerField(default=0)
+
+
+class PublishedSnapshot(models.Model):
+    """The snapshot the ranked listings are served from, see
+    news.snapshots.publish_snapshot. The latest one is current, it is shared
+    by every web process."""
+    version = models.CharField(max_length=32, unique=True)
+    built_at = models.DateTimeField(db_index=True)
+    size = models.PositiveIntegerField()
+    # {listing: [hex ID, ...]} as JSON, in rank order
+    listings = models.TextField()
+
+
+class FrontPageSnapshot(models.Model):
+    """Top story IDs of a listing at taken_at, see news.snapshots.record_snapshot."""
+    class Meta:
+        indexes = [
+            models.Index(fields=['listing', 'taken_at']),
+        ]
+
+    taken_at = models.DateTimeField()
+    listing = models.CharField(max_length=16)
+    # Comma separated hex IDs, in rank order
+    story_ids = models.TextField(blank=True)
+
+    @property
+    def ids(self):
+        return [uuid.UUID(pk) for pk in self.story_ids.split(',') if pk]
+
+
+class UpvotedItem(models.Model):
+    """Stories and top level comments upvoted by a user, excluding their own.
+
+    Mirrors the upvotes in Vote, kept up to date by news.upvotes. The
+    upvoted_by listings page through it by (user, is_story, item_created_at)."""
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'item'],
+                                    name='news_upvoteditem_unique_user_item'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'is_story', 'item_created_at', 'item']),
+        ]
+
+    user = models.ForeignKey(to=CustomUser, on_delete=models.CASCADE)
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    is_story = models.BooleanField()
+    # The listings are ordered by the creation of the item, not of the vote
+    item_created_at = models.DateTimeField()
+
+
+class DomainStats(models.Model):
+    """Stories submitted with links to a domain, as site or as product.
+
+    Maintained along with the stories and their votes by news.domains."""
+    SITE = 'site'
+    PRODUCT = 'product'
+    KINDS = [(SITE, 'site'), (PRODUCT, 'product')]
+
+    class Meta:
+        verbose_name_plural = 'domain stats'
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'domain'],
+                                    name='news_domainstats_unique_kind_domain'),
+        ]
+        indexes = [
+            models.Index(fields=['kind', '-story_count']),
+            models.Index(fields=['kind', '-total_points']),
+        ]
+
+    kind = models.CharField(max_length=16, choices=KINDS)
+    domain = models.CharField(max_length=255)
+    story_count = models.PositiveIntegerField(default=0)
+    total_points = models.IntegerField(default=0)
+    last_seen_at = models.DateTimeField()
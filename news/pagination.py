@@ -0,0 +1,40 @@
+import base64
+import uuid
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+def encode_cursor(created_at, pk):
+    """Opaque cursor pointing right after the item with created_at and pk."""
+    raw = "%s,%s" % (created_at.isoformat(), pk.hex)
+    return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(value):
+    """Returns (created_at, pk) of a cursor, raises ValueError if it is malformed."""
+    try:
+        padded = value + '=' * (-len(value) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode('ascii')).decode('ascii')
+        created_at, pk = raw.split(',')
+        created_at = parse_datetime(created_at)
+        pk = uuid.UUID(pk)
+    except (TypeError, UnicodeError, base64.binascii.Error) as e:
+        raise ValueError("Invalid cursor %r" % (value)) from e
+    if created_at is None:
+        raise ValueError("Invalid cursor %r" % (value))
+    return created_at, pk
+
+
+def item_cursor(item):
+    return encode_cursor(item.created_at, item.pk)
+
+
+def after_cursor(queryset, cursor, descending=True, field='created_at', pk_field='pk'):
+    """Keyset filter on (field, pk_field) for a queryset ordered by the same columns.
+
+    Served by the (created_at, id) index on Item."""
+    value, pk = cursor
+    if descending:
+        return queryset.filter(Q(**{field + '__lt': value}) | Q(**{field: value, pk_field + '__lt': pk}))
+    return queryset.filter(Q(**{field + '__gt': value}) | Q(**{field: value, pk_field + '__gt': pk}))
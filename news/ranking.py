@@ -0,0 +1,360 @@
+import datetime
+import heapq
+import math
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, ExpressionWrapper, F, FloatField, Q, Value, When, fields
+from django.db.models.functions import Extract, Power, Sqrt
+from django.utils import timezone
+
+try:
+    import numpy
+except ImportError:  # optional, the Python path is used without it
+    numpy = None
+
+
+# (P-1) / (T+2)^G, see
+# https://medium.com/hacking-and-gonzo/how-hacker-news-ranking-algorithm-works-1d9b0cf2c08d
+GRAVITY = 1.8
+AGE_OFFSET_HOURS = 2.1
+DENOMINATOR_EPSILON = 0.001
+
+# The periodic job only rescores the stories that can still reach a listing
+# of the front page snapshot: the ones whose stored score is above
+# RESCORE_MARGIN times the lowest score of the listing. A score only decays
+# with age, the stored score of the others is above their real one and keeps
+# them behind the listing anyway. They are rescored again once the listing
+# decays down to them, and by a new vote. Pages deeper than the snapshot
+# order them by their last stored score.
+RESCORE_MARGIN = 0.5
+# Used without a snapshot, and for the listings that hold all their stories
+RESCORE_FLOOR = 1e-5
+
+
+def rank_score(points, created_at, now=None):
+    """Hotness score of a story, same formula as the one used in _front_page."""
+    if now is None:
+        now = timezone.now()
+    age_hours = (now - created_at) / datetime.timedelta(hours=1)
+    return (points - 1) / ((age_hours + AGE_OFFSET_HOURS) ** GRAVITY + DENOMINATOR_EPSILON)
+
+
+def rescore_cutoff(queryset, ids, size):
+    """Stored score below which the stories of a snapshot listing of at most
+    size ids cannot reach it."""
+    if len(ids) < size:
+        # Every story of the listing is on it
+        return RESCORE_FLOOR
+    lowest = queryset.model.objects.filter(pk=ids[-1]).values_list('rank_score', flat=True).first()
+    if lowest is None:
+        return RESCORE_FLOOR
+    return max(lowest * RESCORE_MARGIN, RESCORE_FLOOR)
+
+
+def stories_to_rescore(queryset, snapshot=None):
+    """Restricts queryset to the stories whose stored score can still change
+    their position on a listing page of snapshot, the published front page
+    snapshot. Without one, to the stories above RESCORE_FLOOR."""
+    from .snapshots import LISTINGS
+    queryset = queryset.filter(duplicate_of__isnull=True, rank_score__gt=RESCORE_FLOOR)
+    if snapshot is None:
+        return queryset
+    q = Q()
+    for name, add_filter in LISTINGS.items():
+        cutoff = rescore_cutoff(queryset, snapshot['listings'][name], snapshot['size'])
+        q |= Q(rank_score__gt=cutoff, **add_filter)
+    return queryset.filter(q)
+
+
+def rescore_stories(queryset, now=None, batch_size=500):
+    """Recomputes and stores rank_score for every story in queryset.
+
+    Returns the number of rescored stories."""
+    if now is None:
+        now = timezone.now()
+    count = 0
+    batch = []
+    for story in queryset.only('pk', 'points', 'created_at', 'rank_score').iterator(chunk_size=batch_size):
+        story.rank_score = rank_score(story.points, story.created_at, now)
+        batch.append(story)
+        if len(batch) >= batch_size:
+            count += _store_scores(queryset.model, batch)
+            batch = []
+    count += _store_scores(queryset.model, batch)
+    return count
+
+
+def _store_scores(model, stories):
+    if stories:
+        model.objects.bulk_update(stories, ['rank_score'])
+    return len(stories)
+
+
+def update_story_score(item_pk, points, created_at):
+    """Stores the current score of a story after its points changed."""
+    from .models import Story
+    Story.objects.filter(pk=item_pk).update(
+        rank_score=rank_score(points, created_at))
+
+
+# Ranking engine
+#
+# A strategy scores stories from points, age and vote counts. It can do so in
+# SQL, which ranks without loading the candidates, or in Python over the
+# candidate rows, vectorized with NumPy when it is installed. rank() picks the
+# fastest path the backend supports.
+
+SQL, NUMPY, PYTHON = 'sql', 'numpy', 'python'
+
+_HOUR_IN_MICROSECONDS = 60*60*1000000.0
+
+
+def age_hours_expression(now):
+    """Age of an item in hours at now as an SQL expression, None on backends
+    without support for it."""
+    now_value = Value(now, output_field=fields.DateTimeField())
+    if connection.vendor == 'postgresql':
+        age = ExpressionWrapper(now_value - F('created_at'), output_field=fields.DurationField())
+        return ExpressionWrapper(Extract(age, 'epoch') / 3600.0, output_field=FloatField())
+    if connection.vendor in ('sqlite', 'mysql'):
+        # The difference of two datetimes is in microseconds on these backends
+        age = ExpressionWrapper(now_value - F('created_at'), output_field=FloatField())
+        return ExpressionWrapper(age / Value(_HOUR_IN_MICROSECONDS), output_field=FloatField())
+    return None
+
+
+class _Math:
+    """The subset of NumPy used by the formulas, over plain floats."""
+    sqrt = staticmethod(math.sqrt)
+    maximum = staticmethod(max)
+
+
+class Strategy:
+    """Scores stories, the higher the better.
+
+    formula() is written once for both floats and NumPy arrays, m is the
+    module providing sqrt and maximum. expression() is the same formula in
+    SQL, or None if it cannot be computed by the backend. decays is True if
+    a score only falls with age."""
+    name = None
+    decays = False
+
+    def formula(self, m, points, age_hours, upvotes, downvotes):
+        raise NotImplementedError
+
+    def expression(self, now):
+        return None
+
+    def max_age_hours(self, max_points, min_score):
+        """Age after which no story with at most max_points reaches min_score,
+        None if there is no such age."""
+        return None
+
+    def score(self, story, now=None):
+        if now is None:
+            now = timezone.now()
+        return self.formula(_Math, story.points, _age_hours(story.created_at, now),
+                            story.upvotes, story.downvotes)
+
+    def score_many(self, columns, now, path=PYTHON):
+        """Scores of the candidate rows, columns maps names to lists of values."""
+        ages = [_age_hours(created_at, now) for created_at in columns['created_at']]
+        if path == NUMPY:
+            return self.formula(numpy, numpy.array(columns['points'], dtype=float), numpy.array(ages),
+                                numpy.array(columns['upvotes'], dtype=float),
+                                numpy.array(columns['downvotes'], dtype=float)).tolist()
+        return [self.formula(_Math, *row) for row in zip(
+            columns['points'], ages, columns['upvotes'], columns['downvotes'])]
+
+
+def _age_hours(created_at, now):
+    return (now - created_at) / datetime.timedelta(hours=1)
+
+
+class HackerNewsGravity(Strategy):
+    """(P-1) / (T+2)^G, the stored rank_score."""
+    name = 'gravity'
+    decays = True
+
+    def __init__(self, gravity=GRAVITY):
+        self.gravity = gravity
+
+    def formula(self, m, points, age_hours, upvotes, downvotes):
+        return (points - 1) / ((age_hours + AGE_OFFSET_HOURS) ** self.gravity + DENOMINATOR_EPSILON)
+
+    def max_age_hours(self, max_points, min_score):
+        if min_score <= 0 or max_points <= 1:
+            return None
+        return max((max_points - 1) / min_score - DENOMINATOR_EPSILON, 0) ** (1 / self.gravity) - AGE_OFFSET_HOURS
+
+    def expression(self, now):
+        age = age_hours_expression(now)
+        if age is None:
+            return None
+        return ExpressionWrapper(
+            (F('points') - 1) / (Power(age + AGE_OFFSET_HOURS, self.gravity) + DENOMINATOR_EPSILON),
+            output_field=FloatField())
+
+
+class TimeDecay(Strategy):
+    """(P-1) halved every half_life_hours."""
+    name = 'decay'
+    decays = True
+
+    def __init__(self, half_life_hours=24):
+        self.half_life_hours = half_life_hours
+
+    def formula(self, m, points, age_hours, upvotes, downvotes):
+        return (points - 1) * 0.5 ** (age_hours / self.half_life_hours)
+
+    def max_age_hours(self, max_points, min_score):
+        if min_score <= 0 or max_points <= 1:
+            return None
+        return self.half_life_hours * math.log2((max_points - 1) / min_score)
+
+    def expression(self, now):
+        age = age_hours_expression(now)
+        if age is None:
+            return None
+        return ExpressionWrapper(
+            (F('points') - 1) * Power(0.5, age / float(self.half_life_hours)),
+            output_field=FloatField())
+
+
+class WilsonScore(Strategy):
+    """Lower bound of the Wilson confidence interval of the share of upvotes,
+    does not depend on age."""
+    name = 'wilson'
+
+    def __init__(self, z=1.96):
+        self.z = z
+
+    def formula(self, m, points, age_hours, upvotes, downvotes):
+        # Without votes the bound is 0, as with n = 1 and no upvotes
+        n = m.maximum(upvotes + downvotes, 1)
+        phat = upvotes / n
+        z2 = self.z * self.z
+        return (phat + z2 / (2 * n) - self.z * m.sqrt((phat * (1 - phat) + z2 / (4 * n)) / n)) / (1 + z2 / n)
+
+    def expression(self, now):
+        if connection.vendor not in ('postgresql', 'sqlite', 'mysql'):
+            return None
+        n = ExpressionWrapper(F('upvotes') + F('downvotes') + 0.0, output_field=FloatField())
+        phat = ExpressionWrapper(F('upvotes') / n, output_field=FloatField())
+        z2 = self.z * self.z
+        bound = ExpressionWrapper(
+            (phat + z2 / (2 * n) - self.z * Sqrt((phat * (1 - phat) + z2 / (4 * n)) / n)) / (1 + z2 / n),
+            output_field=FloatField())
+        return Case(When(upvotes=0, downvotes=0, then=Value(0.0)), default=bound, output_field=FloatField())
+
+
+STRATEGIES = {strategy.name: strategy for strategy in (HackerNewsGravity(), TimeDecay(), WilsonScore())}
+
+
+def best_path(strategy, now=None):
+    if strategy.expression(now or timezone.now()) is not None:
+        return SQL
+    if numpy is not None:
+        return NUMPY
+    return PYTHON
+
+
+def rank(queryset, strategy='gravity', now=None, offset=0, limit=settings.PAGING_SIZE, path=None):
+    """Stories of queryset in [offset, offset + limit) ordered by strategy.
+
+    Ties are broken by newest first. path forces SQL, NUMPY or PYTHON,
+    by default the fastest one available is used. Returns a list."""
+    if isinstance(strategy, str):
+        strategy = STRATEGIES[strategy]
+    if now is None:
+        now = timezone.now()
+    if path is None:
+        path = best_path(strategy, now)
+    if path == SQL:
+        return list(queryset.annotate(score=strategy.expression(now))
+                    .order_by('-score', '-created_at', '-pk')[offset:offset + limit])
+
+    names = ['pk', 'points', 'created_at', 'upvotes', 'downvotes']
+    rows = list(queryset.values_list(*names))
+    if not rows:
+        return []
+    columns = dict(zip(names, zip(*rows)))
+    scores = strategy.score_many(columns, now, path=path)
+    top = heapq.nlargest(offset + limit, range(len(rows)), key=lambda i: (
+        scores[i], columns['created_at'][i], columns['pk'][i]))[offset:]
+    pks = [columns['pk'][i] for i in top]
+    stories = queryset.in_bulk(pks)
+    return [stories[pk] for pk in pks]
+
+
+# Candidate window
+#
+# Under gravity and decay a score only falls with age, and no story scores
+# more than a fresh one with the most points. Once the stories of the last
+# window hours fill the page, the score of the last one of them tells how old
+# a story may be and still make it: older stories are never looked at.
+#
+# A last score of 0 (one point stories) gives no age limit, but only the
+# older stories with more than one point score above 0, the ones with one
+# point lose the tie to the newer ones. They are ranked apart, through the
+# (points, created_at) index, and merged in.
+
+INITIAL_WINDOW_HOURS = 48
+# Added to the computed age limit against rounding errors
+WINDOW_MARGIN_HOURS = 1/60
+
+
+def _order_key(strategy, now):
+    # Same order as rank(), with the score computed by the SQL path if any
+    def key(story):
+        score = getattr(story, 'score', None)
+        if score is None:
+            score = strategy.score(story, now)
+        return (score, story.created_at, story.pk)
+    return key
+
+
+def rank_recent(queryset, strategy='gravity', now=None, offset=0, limit=settings.PAGING_SIZE, path=None):
+    """Same as rank(), ranking only the stories recent enough to make it
+    into [offset, offset + limit).
+
+    The window starts at INITIAL_WINDOW_HOURS, it is widened while it holds
+    fewer stories than needed and then to the age limit derived from the
+    most points among the older stories. Strategies whose scores do not
+    fall with age rank the whole queryset, so do the others when the last
+    score is negative, which takes stories below one point."""
+    if isinstance(strategy, str):
+        strategy = STRATEGIES[strategy]
+    if now is None:
+        now = timezone.now()
+    if not strategy.decays:
+        return rank(queryset, strategy, now=now, offset=offset, limit=limit, path=path)
+    needed = offset + limit
+    key = _order_key(strategy, now)
+    window = INITIAL_WINDOW_HOURS
+    while True:
+        since = now - datetime.timedelta(hours=window)
+        ranked = rank(queryset.filter(created_at__gte=since), strategy, now=now,
+                      offset=0, limit=needed, path=path)
+        older = queryset.filter(created_at__lt=since)
+        if len(ranked) < needed:
+            if not older.exists():
+                return ranked[offset:]
+            window *= 4
+            continue
+        min_score = key(ranked[-1])[0]
+        if min_score < 0:
+            return rank(queryset, strategy, now=now, offset=offset, limit=limit, path=path)
+        if min_score == 0:
+            better = rank_recent(older.filter(points__gt=1), strategy, now=now,
+                                 offset=0, limit=needed, path=path)
+            return sorted(ranked + better, key=key, reverse=True)[offset:needed]
+        max_points = older.order_by('-points').values_list('points', flat=True).first()
+        max_age = None if max_points is None else strategy.max_age_hours(max_points, min_score)
+        if max_age is None or max_age <= window:
+            # No older story reaches the last score
+            return ranked[offset:]
+        # The last story can only get better in the wider window, this is
+        # the last round
+        window = max_age + WINDOW_MARGIN_HOURS
@@ -1,173 +1,195 @@
 # from django.core.signals import request_finished
-from django.db.models.signals import pre_save, post_save, post_delete
+from django.db.models import F, Q
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
 
+from django.conf import settings
+
 from urllib.parse import urlparse
-from urllib.request import Request, urlopen
-import re
-from bs4 import BeautifulSoup
 
-from .models import Item, Vote, Comment, Story
+from .models import Item, Vote, Comment, Story, DomainEvent
+from .markdown import RENDERER_VERSION, render_markdown
+from .titles import cached_title, get_title, fetch_later, show_and_ask_flags
+from .listing_cache import invalidate
+from .domains import uncount_story
+from .events import publish
+from .fingerprints import url_fingerprint
 
 
-@receiver(pre_save)
-def mark_show_and_ask(sender, instance, **kwargs):
-    if isinstance(instance, Story):
-        if instance.title.lower().startswith('ask'):
-            instance.is_ask = True
-        if instance.title.lower().startswith('show'):
-            instance.is_show = True
-
-
-@receiver(post_save)
-def create_self_upvote_for_submission(sender, instance, created, **kwargs):
-    if created and isinstance(instance, Item):
-        vote = Vote(item=instance, user=instance.user)
-        vote.save()
-
-
-@receiver(post_save)
-def check_for_duplicates(sender, instance, created, **kwargs):
-    if created and isinstance(instance, Story):
-        story = instance
-        if story.original_url and story.product_url and story.duplicate_of is None:
-            other_stories = Story.objects.filter(original_url=story.original_url,
-                                                 product_url=story.product_url).exclude(pk=story.pk).order_by('-changed_at')
-            c = other_stories.count()
-            if c > 0:
-                new_vote = Vote(item=other_stories[0], vote=1, user=story.user)
-                new_vote.save()
-                story.duplicate_of = other_stories[0]
-                story.save()
-
-
-@receiver(post_save)
-def update_votes_count_on_submission(sender, instance, created, **kwargs):
-    if created and isinstance(instance, Vote):
-        vote = instance
-        item = instance.item
-        other_votes = Vote.objects.filter(
-            item=vote.item, user=vote.user, vote=vote.vote).exclude(pk=vote.pk)
-        if other_votes.count():
-            return
-        if instance.vote > 0:
-            item.upvotes += instance.vote
-        else:
-            item.downvotes += (-1)*instance.vote
-        item.points += instance.vote
-        item.save()
+# Model signals are sent with the concrete class as sender: saving a Story
+# does not notify the receivers of Item. Receivers meant for every item are
+# connected to each of these.
+ITEM_MODELS = (Story, Comment)
 
 
-@receiver(post_save)
-def update_user_karma_on_vote(sender, instance, created, **kwargs):
-    if created and isinstance(instance, Vote):
-        vote = instance
-        other_votes = Vote.objects.filter(
-            item=vote.item, user=vote.user, vote=vote.vote).exclude(pk=vote.pk)
-        if other_votes.count():
-            return
-        item = instance.item
-        if item.user != instance.user:
-            item.user.karma += instance.vote
-            item.user.save()
+def receiver_for(signal, senders):
+    """Like @receiver, but connects the function once for each of senders."""
+    def connect(func):
+        for sender in senders:
+            signal.connect(func, sender=sender)
+        return func
+    return connect
+
+
+@receiver(pre_save, sender=Story)
+def mark_show_and_ask(sender, instance, **kwargs):
+    for flag, value in show_and_ask_flags(instance.title).items():
+        setattr(instance, flag, value)
+
+
+@receiver_for(post_save, ITEM_MODELS)
+def publish_item_created(sender, instance, created, **kwargs):
+    # The self upvote and, for stories, the domain stats and the upvote of
+    # the original of duplicates, see news.events
+    if created:
+        kind = DomainEvent.STORY_SUBMITTED if sender is Story else DomainEvent.COMMENT_ADDED
+        publish(kind, instance.pk, instance.user_id)
+
+
+@receiver(pre_save, sender=Story)
+def check_for_duplicates(sender, instance, **kwargs):
+    if instance.duplicate_of_id is not None:
+        return
+    fingerprint = url_fingerprint(instance.original_url, instance.product_url)
+    if not instance._state.adding:
+        # The links may have been edited, the story stays an original but
+        # gives up a fingerprint that another story holds already
+        if fingerprint != instance.url_fingerprint:
+            taken = fingerprint is not None and Story.objects.filter(
+                url_fingerprint=fingerprint).exclude(pk=instance.pk).exists()
+            instance.url_fingerprint = None if taken else fingerprint
+        return
+    if fingerprint is None:
+        return
+    original = Story.objects.filter(url_fingerprint=fingerprint).values_list('pk', flat=True).first()
+    if original is None:
+        instance.url_fingerprint = fingerprint
+    else:
+        instance.duplicate_of_id = original
+        # Set by an insert that lost the race to the original, see
+        # news.views.submit
+        instance.url_fingerprint = None
+
+
+@receiver(post_save, sender=Vote)
+def publish_vote_cast(sender, instance, created, **kwargs):
+    if created:
+        # A user has at most one vote per item, enforced by the database
+        publish(DomainEvent.VOTE_CAST, instance.item_id, instance.user_id, instance.vote)
+
+
+def _ancestors_q(instance):
+    """Ancestors of a comment by their MPTT bounds, in a single predicate.
+
+    Matches both before and after MPTT closed the gap of the deleted subtree
+    of the comment: an ancestor always starts before the node and ends at or
+    after its lft. Not for the replies deleted with it, the rows after the
+    gap have moved past their bounds."""
+    return Q(tree_id=instance.tree_id, lft__lt=instance.lft, rght__gte=instance.lft)
 
 
 def _recount_comments(instance, val=1):
     assert isinstance(instance, Comment)
-    instance.to_story.num_comments += val
-    instance.to_story.save()
-    parent = instance.parent
-    while parent is not None:
-        parent.num_comments += val
-        parent.save()
-        parent = parent.parent
+    # The ancestors' subtrees changed, their cached HTML is stale
+    Item.objects.filter(
+        Q(pk=instance.to_story_id) | _ancestors_q(instance)
+    ).update(num_comments=F('num_comments') + val,
+             render_version=F('render_version') + 1)
 
 
-@receiver(post_save)
+@receiver(post_save, sender=Comment)
 def update_comments_count_on_submission(sender, instance, created, **kwargs):
-    if created and isinstance(instance, Comment):
+    if created:
         _recount_comments(instance, 1)
 
 
-@receiver(post_delete)
+@receiver(post_delete, sender=Comment)
 def update_comments_count_on_deletion(sender, instance, **kwargs):
-    if isinstance(instance, Comment):
-        _recount_comments(instance, -1)
-
-
-@receiver(post_delete)
-def update_item_votes_on_unvote(sender, instance, **kwargs):
-    if isinstance(instance, Vote):
-        vote = instance
-        item = vote.item
-        if vote.user == item.user:
-            return
-        item.points -= vote.vote
-        if vote.vote > 0:
-            item.upvotes -= abs(vote.vote)
-        else:
-            item.downvotes -= abs(vote.vote)
-        item.save()
+    # The replies are deleted with the comment, the whole subtree is
+    # uncounted once from its root. The comment rows are all deleted before
+    # post_delete is sent, a reply's parent is gone already.
+    if instance.parent_id is not None and not Comment.objects.filter(pk=instance.parent_id).exists():
+        return
+    _recount_comments(instance, -1 - instance.get_descendant_count())
+
+
+@receiver(post_save, sender=Comment)
+def bump_render_version_on_edit(sender, instance, created, **kwargs):
+    if not created:
+        Item.objects.filter(
+            Q(pk=instance.pk) | _ancestors_q(instance)
+        ).update(render_version=F('render_version') + 1)
+
+
+@receiver(post_delete, sender=Vote)
+def publish_vote_retracted(sender, instance, **kwargs):
+    publish(DomainEvent.VOTE_RETRACTED, instance.item_id, instance.user_id, instance.vote)
 
 
-@receiver(post_delete)
-def update_user_karma_on_unvote(sender, instance, **kwargs):
-    if isinstance(instance, Vote):
-        vote = instance
-        item = vote.item
-        if vote.user == item.user:
-            return
-        item.user.karma -= vote.vote
-        item.user.save()
+@receiver_for(pre_save, ITEM_MODELS)
+def render_text_html(sender, instance, update_fields=None, **kwargs):
+    # Skipped by partial saves that do not write text_html. MPTT lists every
+    # field in update_fields when saving an existing node.
+    if update_fields is None or 'text_html' in update_fields:
+        instance.text_html = render_markdown(instance.text)
+        instance.text_html_version = RENDERER_VERSION
 
 
-@receiver(pre_save)
+@receiver(pre_save, sender=Story)
 def add_domain_to_link_stories(sender, instance, **kwargs):
-    if isinstance(instance, Story):
-        if not instance.original_url_domain:
-            o = urlparse(instance.original_url)
-            instance.original_url_domain = o.hostname.lower()
+    if not instance.original_url_domain:
+        o = urlparse(instance.original_url)
+        instance.original_url_domain = o.hostname.lower()
 
-        if not instance.product_url_domain:
-            o = urlparse(instance.product_url)
-            instance.product_url_domain = o.hostname.lower()
+    if not instance.product_url_domain:
+        o = urlparse(instance.product_url)
+        instance.product_url_domain = o.hostname.lower()
 
+    if instance.submitted_at is None:
+        instance.submitted_at = instance.created_at
 
-@receiver(pre_save)
+
+@receiver(pre_delete, sender=Story)
+def remove_story_from_domain_stats(sender, instance, **kwargs):
+    uncount_story(instance)
+
+
+@receiver(pre_save, sender=Story)
 def add_title(sender, instance, **kwargs):
-    if isinstance(instance, Story):
-        if not instance.title:
-            instance.title = _get_title(url=instance.original_url,
-                                        back_up_title=instance.original_url)
-        if not instance.product_title:
-            instance.product_title = _get_title(url=instance.product_url,
-                                                back_up_title=instance.product_url)
-
-
-def _get_title(url, back_up_title):
-    try:
-        req = Request(url)
-        req.add_header('User-Agent', 'Hackergrows')
-        req.add_header('Access-Control-Allow-Origin', '*')
-        req.add_header('Access-Control-Allow-Methods', 'GET')
-        req.add_header('Access-Control-Allow-Headers', 'Content-Type')
-        req.add_header('Access-Control-Max-Age', '3600')
-        webpage = urlopen(req, timeout=4).read()
-
-        retitle = re.compile(
-            "<title[^>]*>(.*?)</title>", re.IGNORECASE | re.DOTALL)
-
-        match = retitle.search(webpage.decode('utf-8', errors='ignore'))
-        if match:
-            title = match.group(1).strip()
-            # Parse HTML like &amp;
-            soup = BeautifulSoup(title, 'html.parser')
-            # Avoid to parse back again &, <, and >
-            return soup.prettify(formatter=None)
+    instance._pending_titles = []
+    for field, url in (('title', instance.original_url), ('product_title', instance.product_url)):
+        if getattr(instance, field):
+            continue
+        if settings.TITLE_FETCH_ASYNC:
+            title = cached_title(url)
+            if title is None:
+                # The URL is the title until the background fetch is done
+                instance._pending_titles.append((field, url))
+            setattr(instance, field, title or url)
         else:
-            return back_up_title
-    except Exception as e:
-        print("Exception: {}".format(type(e).__name__))
-        print("Exception message: {}".format(e))
-        print(url)
-        return back_up_title
+            setattr(instance, field, get_title(url, back_up_title=url))
+    for flag, value in show_and_ask_flags(instance.title).items():
+        setattr(instance, flag, value)
+
+
+def _newest_filters(story):
+    # The filters of the newest listing the story matches, see views.newest
+    return {'submitted_by': story.user_id, 'site': story.original_url_domain,
+            'product': story.product_url_domain}
+
+
+@receiver(post_save, sender=Story)
+def invalidate_newest_on_story_change(sender, instance, **kwargs):
+    invalidate('newest', _newest_filters(instance))
+
+
+@receiver(post_delete, sender=Story)
+def invalidate_newest_on_story_deletion(sender, instance, **kwargs):
+    invalidate('newest', _newest_filters(instance))
+
+
+@receiver(post_save, sender=Story)
+def fetch_pending_titles(sender, instance, **kwargs):
+    for field, url in getattr(instance, '_pending_titles', []):
+        fetch_later(instance.pk, field, url, placeholder=url)
+    instance._pending_titles = []
@@ -0,0 +1,146 @@
+import datetime
+import json
+import uuid
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Story, FrontPageSnapshot, PublishedSnapshot
+
+
+# Listings served from the front page snapshot, with the filter selecting
+# their stories out of the ranked front page.
+LISTINGS = {
+    'index': {},
+    'show': {'is_show': True},
+    'ask': {'is_ask': True},
+}
+
+# The current snapshot parsed by this process, by version
+_parsed = {}
+
+
+def build_snapshot(size=None):
+    """Computes the top story IDs of every listing, with one query per
+    listing reading at most size stories through the rank_score index, or
+    the is_show and is_ask indexes for the rare Show and Ask stories."""
+    if size is None:
+        size = settings.FRONT_PAGE_SNAPSHOT_SIZE
+    listings = {
+        name: list(Story.objects
+                   .filter(duplicate_of__isnull=True, rank_score__gte=0, **add_filter)
+                   .order_by('-rank_score')
+                   .values_list('pk', flat=True)[:size])
+        for name, add_filter in LISTINGS.items()}
+    return {
+        'version': uuid.uuid4().hex,
+        'built_at': timezone.now(),
+        'size': size,
+        'listings': listings,
+    }
+
+
+def publish_snapshot(snapshot):
+    """Stores the snapshot in PublishedSnapshot, where it replaces the current
+    one for every process.
+
+    The snapshot is inserted as one row, readers either see the previous or
+    the new snapshot, never a mix of both."""
+    published = PublishedSnapshot.objects.create(
+        version=snapshot['version'], built_at=snapshot['built_at'], size=snapshot['size'],
+        listings=json.dumps({name: [pk.hex for pk in ids]
+                             for name, ids in snapshot['listings'].items()}))
+    PublishedSnapshot.objects.filter(built_at__lt=published.built_at).delete()
+    return snapshot
+
+
+def _load(published):
+    return {
+        'version': published.version,
+        'built_at': published.built_at,
+        'size': published.size,
+        'listings': {name: [uuid.UUID(pk) for pk in ids]
+                     for name, ids in json.loads(published.listings).items()},
+    }
+
+
+def _parse(version):
+    snapshot = _parsed.get(version)
+    if snapshot is None:
+        published = PublishedSnapshot.objects.filter(version=version).first()
+        if published is None:
+            # Replaced meanwhile
+            return None
+        snapshot = _load(published)
+        _parsed.clear()
+        _parsed[snapshot['version']] = snapshot
+    return snapshot
+
+
+def published_snapshot():
+    """The current snapshot however old it is, None if none was published."""
+    version = PublishedSnapshot.objects.order_by('-built_at').values_list('version', flat=True).first()
+    if version is None:
+        return None
+    return _parse(version) or published_snapshot()
+
+
+def get_snapshot(now=None):
+    """The current snapshot, a new one is built and published if it is older
+    than FRONT_PAGE_SNAPSHOT_TIMEOUT."""
+    now = now or timezone.now()
+    current = PublishedSnapshot.objects.order_by('-built_at').values_list('version', 'built_at').first()
+    if current is None or current[1] < now - datetime.timedelta(seconds=settings.FRONT_PAGE_SNAPSHOT_TIMEOUT):
+        return publish_snapshot(build_snapshot())
+    return _parse(current[0]) or get_snapshot(now)
+
+
+def front_page_stories(listing, page=0, paging_size=settings.PAGING_SIZE):
+    """Returns one page of a ranked listing, sliced from the current snapshot."""
+    from .views import _front_page
+    snapshot = get_snapshot()
+    ids = snapshot['listings'][listing]
+    start = page*paging_size
+    if start >= snapshot['size']:
+        # Deeper than the snapshot goes, rank on the fly.
+        return list(_front_page(paging_size=paging_size, page=page, add_filter=LISTINGS[listing]))
+    ids = ids[start:start+paging_size]
+    stories = Story.objects.select_related('user').in_bulk(ids)
+    return [stories[pk] for pk in ids if pk in stories]
+
+
+def record_snapshot(now=None, size=None, as_of=None):
+    """Stores the top story IDs of every listing in FrontPageSnapshot.
+
+    Ranks by the stored score, or, given as_of, as the front page looked then
+    (with the current points). Returns the snapshots."""
+    if size is None:
+        size = settings.FRONT_PAGE_HISTORY_SIZE
+    if as_of is None:
+        taken_at = now or timezone.now()
+        listings = build_snapshot(size)['listings']
+    else:
+        from .views import _front_page
+        taken_at = as_of
+        listings = {name: [story.pk for story in _front_page(paging_size=size, add_filter=add_filter, as_of=as_of)]
+                    for name, add_filter in LISTINGS.items()}
+    return FrontPageSnapshot.objects.bulk_create([
+        FrontPageSnapshot(taken_at=taken_at, listing=name,
+                          story_ids=','.join(pk.hex for pk in ids))
+        for name, ids in listings.items()])
+
+
+def snapshot_due(now=None):
+    """True if the last recorded snapshot is older than FRONT_PAGE_HISTORY_INTERVAL."""
+    now = now or timezone.now()
+    return not FrontPageSnapshot.objects.filter(
+        listing='index', taken_at__gt=now - datetime.timedelta(seconds=settings.FRONT_PAGE_HISTORY_INTERVAL)).exists()
+
+
+def historical_snapshot(listing, before, since=None):
+    """The last snapshot of listing taken before the given time, and not
+    before since if given. None if there is none."""
+    snapshots = FrontPageSnapshot.objects.filter(listing=listing, taken_at__lt=before)
+    if since is not None:
+        snapshots = snapshots.filter(taken_at__gte=since)
+    return snapshots.order_by('-taken_at').first()
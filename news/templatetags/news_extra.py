@@ -1,7 +1,6 @@
 from django import template
-from django.utils.safestring import mark_safe
 
-import mistune
+from ..comment_tree import placeholder, render_comment_tree
 
 register = template.Library()
 
@@ -9,6 +8,7 @@ register = template.Library()
 def news_item(context, item, **kwargs):
     kwargs['item'] = item
     kwargs['request_user'] = context['user']
+    kwargs['voted_item_ids'] = context.get('voted_item_ids')
     return kwargs
 
 @register.inclusion_tag('news/_link_user_tag.html')
@@ -18,24 +18,39 @@ def link_user(user):
     }
 
 @register.simple_tag
-def user_arrows(user, item):
-    if user == item.user:
+def user_arrows(user, item, voted_item_ids=None):
+    if user.pk == item.user_id:
         return ['star']
     else:
         res = []
-        if item.can_be_upvoted_by(user=user):
+        if item.can_be_upvoted_by(user=user, voted_item_ids=voted_item_ids):
             res.append('up')
-        if item.can_be_downvoted_by(user=user):
+        if item.can_be_downvoted_by(user=user, voted_item_ids=voted_item_ids):
             res.append('down')
         return res
 
 
+@register.simple_tag(takes_context=True)
+def comment_tree(context, comments):
+    return render_comment_tree(comments, context.request, context.get('voted_item_ids'))
+
+
+@register.simple_tag
+def comment_placeholder(kind, comment):
+    return placeholder(kind, comment)
+
+
 @register.inclusion_tag('news/_more_link_tag.html', takes_context=True)
 def more_link(context):
     request = context.request
     page = int(request.GET.get('p', 0))
     query_dict = request.GET.copy()
     query_dict['p'] = page + 1
+    # Listings paginated by created_at hand over a keyset cursor, the page
+    # number is kept for the rank numbers only.
+    next_cursor = context.get('next_cursor')
+    if next_cursor:
+        query_dict['after'] = next_cursor
     _more_link=request.path_info + '?' + query_dict.urlencode()
     return {'more_link': _more_link}
 
@@ -48,22 +63,3 @@ def item_content(**kwargs):
 @register.inclusion_tag('news/_item_control_tag.html')
 def item_control(**kwargs):
     return kwargs
-
-
-class MarkdownRenderer(mistune.Renderer):
-
-    @classmethod
-    def setup(cls):
-        renderer = cls(escape=True, hard_wrap=True)
-        return mistune.Markdown(renderer=renderer)
-
-    def header(self, text, level, raw=None):
-        level = min(level + 2, 6)
-        return super().header(text, level, raw)
-
-
-markdown = MarkdownRenderer.setup()
-
-@register.filter
-def comment_markdown(value):
-    return mark_safe(markdown(value))
@@ -1,8 +1,13 @@
 from django.contrib.auth.models import AnonymousUser
 from accounts.models import CustomUser
-from django.test import RequestFactory, TestCase
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.core.cache import cache
+from io import StringIO
+import time
 
 from .views import *
+from .views import _front_page
+from .pagination import decode_cursor
 from .models import *
 
 
@@ -16,6 +21,8 @@ class BasicNewsTest(TestCase):
             username='test', email='hi@hackergrows.com', password='top_secret')
         self.other_user = CustomUser.objects.create_user(
             username='bla1', email='two@hackergrows.com', password='top_secret')
+        # Cached listings must not leak between tests.
+        cache.clear()
 
     def test_submit_get(self):
         """The submit form is displayed."""
@@ -498,8 +505,9 @@ class ReceiversNewsTest(TestCase):
 
         self.assertEqual(Vote.objects.filter(item=story).count(), 1)
 
+        # The author upvoted the story on submission already
         vote = Vote(user=self.user, vote=1, item=story)
-        vote.save()
+        self.assertFalse(vote.save_if_new())
         story = Story.objects.get(pk=story.pk)
 
         self.assertEqual(story.upvotes, 1)
@@ -582,8 +590,9 @@ class ReceiversNewsTest(TestCase):
 
         self.assertEqual(Vote.objects.filter(item=story).count(), 1)
 
+        # The author upvoted the story on submission already
         vote = Vote(user=self.user, vote=1, item=story)
-        vote.save()
+        self.assertFalse(vote.save_if_new())
         story = Story.objects.get(pk=story.pk)
 
         self.assertEqual(story.upvotes, 1)
@@ -632,3 +641,1606 @@ class ReceiversNewsTest(TestCase):
 
         item = Story.objects.get(pk=item.pk)
         self.assertEqual(item.original_url_domain, 'hackergrows.com')
+
+
+class RankingNewsTest(TestCase):
+    """Tests the stored front page score."""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='test', email='hi@hackergrows.com', password='top_secret')
+
+    def _story(self, points, hours_ago):
+        story = Story(original_url="https://hackergrows.com/%s" % (points),
+                      product_url="https://hackergrows.com/p/%s/%s" % (points, hours_ago),
+                      title="Story", product_title="Product", user=self.user)
+        story.save()
+        Item.objects.filter(pk=story.pk).update(
+            points=points, created_at=timezone.now() - datetime.timedelta(hours=hours_ago))
+        return story
+
+    def test_rerank_matches_formula(self):
+        from django.core.management import call_command
+        from .ranking import rank_score
+        for points, hours_ago in [(2, 1), (10, 5), (50, 30), (3, 0.2), (1, 2), (100, 200), (7, 12)]:
+            self._story(points, hours_ago)
+        call_command('rerank_stories', '--all', stdout=StringIO())
+        now = timezone.now()
+
+        stored = list(_front_page())
+        expected = sorted(Story.objects.filter(points__gte=1),
+                          key=lambda s: rank_score(s.points, s.created_at, now), reverse=True)
+        self.assertEqual([s.pk for s in stored], [s.pk for s in expected])
+        for story in stored:
+            self.assertAlmostEqual(story.rank_score, rank_score(
+                story.points, story.created_at, now), delta=1e-4)
+
+    def test_vote_rescores_story(self):
+        story = self._story(1, 3)
+        Vote(item=story, user=CustomUser.objects.create_user(
+            username='voter', email='v@hackergrows.com', password='top_secret')).save()
+        story = Story.objects.get(pk=story.pk)
+        self.assertEqual(story.points, 2)
+        self.assertGreater(story.rank_score, 0)
+
+    def test_old_stories_are_not_rescored(self):
+        from .ranking import stories_to_rescore, RESCORE_FLOOR
+        fresh = self._story(10, 1)
+        old = self._story(2, 24*365)
+        Story.objects.filter(pk=fresh.pk).update(rank_score=1)
+        Story.objects.filter(pk=old.pk).update(rank_score=RESCORE_FLOOR/2)
+        self.assertEqual(list(stories_to_rescore(Story.objects.all())), [fresh])
+
+    def test_rescore_cutoff_follows_the_snapshot(self):
+        from .ranking import stories_to_rescore
+        from .snapshots import build_snapshot
+        stories = [self._story(points, 1) for points in (4, 3, 2, 1)]
+        Story.objects.filter(pk=stories[3].pk).update(is_show=True)
+        for story, score in zip(stories, (10, 8, 3, 1)):
+            Story.objects.filter(pk=story.pk).update(rank_score=score)
+        snapshot = build_snapshot(size=2)
+        # Index ends at 8: 3 is below half of it. The only Show story is on
+        # its listing however low it scores.
+        self.assertEqual(set(stories_to_rescore(Story.objects.all(), snapshot)),
+                         {stories[0], stories[1], stories[3]})
+        self.assertEqual(len(stories_to_rescore(Story.objects.all())), 4)
+
+
+class SnapshotNewsTest(TestCase):
+    """Tests the front page snapshots."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user(
+            username='test', email='hi@hackergrows.com', password='top_secret')
+        self.stories = []
+        for i in range(6):
+            title = "Show HG: %s" % (i) if i % 2 else "Story %s" % (i)
+            story = Story(original_url="https://hackergrows.com/%s" % (i),
+                          product_url="https://hackergrows.com/p/%s" % (i),
+                          title=title, product_title="Product", user=self.user)
+            story.save()
+            Story.objects.filter(pk=story.pk).update(rank_score=10 - i)
+            self.stories.append(story)
+
+    def test_pages_are_sliced_from_one_snapshot(self):
+        from .snapshots import build_snapshot, publish_snapshot, front_page_stories
+        publish_snapshot(build_snapshot(size=6))
+        first = front_page_stories('index', page=0, paging_size=3)
+        # Reverse the ranking after page 1 was served
+        for i, story in enumerate(self.stories):
+            Story.objects.filter(pk=story.pk).update(rank_score=i)
+        second = front_page_stories('index', page=1, paging_size=3)
+        pks = [s.pk for s in first + second]
+        self.assertEqual(pks, [s.pk for s in self.stories])
+
+    def test_listings_are_filtered(self):
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+        from .snapshots import build_snapshot
+        with CaptureQueriesContext(connection) as context:
+            snapshot = build_snapshot(size=6)
+        # One bounded query per listing, not a walk over all the stories
+        self.assertEqual(len(context.captured_queries), 3)
+        for query in context.captured_queries:
+            self.assertIn('LIMIT 6', query['sql'])
+        self.assertEqual(snapshot['listings']['show'], [
+                         s.pk for s in self.stories if s.is_show])
+        self.assertEqual(snapshot['listings']['ask'], [])
+
+    def test_publish_swaps_pointer(self):
+        from .snapshots import build_snapshot, publish_snapshot, get_snapshot
+        old = publish_snapshot(build_snapshot(size=6))
+        self.assertEqual(get_snapshot()['version'], old['version'])
+        new = publish_snapshot(build_snapshot(size=6))
+        self.assertNotEqual(old['version'], new['version'])
+        self.assertEqual(get_snapshot()['version'], new['version'])
+
+    def test_snapshot_is_shared(self):
+        from django.core.management import call_command
+        from . import snapshots
+        call_command('rerank_stories', stdout=StringIO())
+        published = PublishedSnapshot.objects.get()
+        # A web process that never built or published a snapshot
+        snapshots._parsed.clear()
+        snapshot = snapshots.get_snapshot()
+        self.assertEqual(snapshot['version'], published.version)
+        self.assertEqual(snapshot['listings']['index'][:6], [s.pk for s in self.stories])
+        self.assertEqual(PublishedSnapshot.objects.count(), 1)
+
+        # Expired, a new one replaces it
+        later = timezone.now() + datetime.timedelta(seconds=settings.FRONT_PAGE_SNAPSHOT_TIMEOUT + 1)
+        self.assertNotEqual(snapshots.get_snapshot(now=later)['version'], published.version)
+        self.assertFalse(PublishedSnapshot.objects.filter(pk=published.pk).exists())
+
+    def test_deeper_pages_fall_back_to_ranking(self):
+        from .snapshots import build_snapshot, publish_snapshot, front_page_stories
+        publish_snapshot(build_snapshot(size=2))
+        stories = front_page_stories('index', page=1, paging_size=2)
+        self.assertEqual([s.pk for s in stories], [s.pk for s in self.stories[2:4]])
+
+
+class PaginationNewsTest(TestCase):
+    """Tests the keyset pagination of the newest, comments and threads listings."""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = CustomUser.objects.create_user(
+            username='test', email='hi@hackergrows.com', password='top_secret')
+        self.stories = []
+        created_at = timezone.now()
+        # Stories 1 and 2 share a timestamp to exercise the id tie-breaker
+        for i, minutes_ago in enumerate([0, 1, 1, 2, 3]):
+            story = Story(original_url="https://hackergrows.com/%s" % (i),
+                          product_url="https://hackergrows.com/p/%s" % (i),
+                          title="Story %s" % (i), product_title="Product", user=self.user)
+            story.save()
+            Item.objects.filter(pk=story.pk).update(
+                created_at=created_at - datetime.timedelta(minutes=minutes_ago))
+            self.stories.append(story)
+
+    def test_cursor_roundtrip(self):
+        from .pagination import encode_cursor, decode_cursor
+        story = Story.objects.get(pk=self.stories[0].pk)
+        self.assertEqual(decode_cursor(encode_cursor(story.created_at, story.pk)),
+                         (story.created_at, story.pk))
+        with self.assertRaises(ValueError):
+            decode_cursor('not a cursor')
+
+    def test_cursor_pages_match_offset_pages(self):
+        from .views import _newest, _next_cursor
+        by_offset = [s.pk for p in range(3) for s in _newest(paging_size=2, page=p)]
+        by_cursor = []
+        after = None
+        for p in range(3):
+            stories = _newest(paging_size=2, after=after)
+            by_cursor += [s.pk for s in stories]
+            after = decode_cursor(_next_cursor(stories))
+        self.assertEqual(len(set(by_cursor)), 5)
+        self.assertEqual(by_cursor, by_offset)
+
+    def test_newest_emits_cursor(self):
+        request = self.factory.get('/newest')
+        request.user = self.user
+        response = newest(request)
+        self.assertContains(response, 'after=')
+
+        request = self.factory.get('/newest', {'after': 'garbage'})
+        request.user = self.user
+        with self.assertRaises(Http404):
+            newest(request)
+
+    def test_comments_and_threads_accept_cursor(self):
+        from .pagination import item_cursor
+        comment = Comment(to_story=self.stories[0], text="first", user=self.user)
+        comment.save()
+        later = Comment(to_story=self.stories[0], text="second", user=self.user)
+        later.save()
+        comment = Comment.objects.get(pk=comment.pk)
+
+        request = self.factory.get('/comments', {'after': item_cursor(comment)})
+        request.user = self.user
+        response = comments(request)
+        self.assertContains(response, 'second')
+        self.assertNotContains(response, 'first')
+
+        request = self.factory.get('/threads', {'after': item_cursor(comment)})
+        request.user = self.user
+        response = threads(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, 'second')
+
+
+class ConcurrentVotesNewsTest(TransactionTestCase):
+    """Votes cast in parallel must all be counted."""
+
+    def test_parallel_votes_are_counted_exactly(self):
+        import threading
+        from django.db import connection, transaction, OperationalError
+        author = CustomUser.objects.create_user(
+            username='author', email='a@hackergrows.com', password='top_secret')
+        voters = [CustomUser.objects.create_user(
+            username='voter%s' % (i), email='v%s@hackergrows.com' % (i), password='top_secret') for i in range(12)]
+        story = Story(original_url="https://hackergrows.com", product_url="https://hackergrows.com/p",
+                      title="Story", product_title="Product", user=author)
+        story.save()
+        barrier = threading.Barrier(len(voters))
+        errors = []
+
+        def vote(user):
+            try:
+                # Every request loads the item before anybody has voted
+                item = Item.objects.get(pk=story.pk)
+                barrier.wait()
+                while True:
+                    try:
+                        with transaction.atomic():
+                            Vote(item=item, user=user, vote=1).save()
+                        break
+                    except OperationalError:
+                        # SQLite allows one writer at a time, retry the whole vote
+                        continue
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=vote, args=(user,)) for user in voters]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        story = Story.objects.get(pk=story.pk)
+        self.assertEqual(story.points, len(voters) + 1)
+        self.assertEqual(story.upvotes, len(voters) + 1)
+        self.assertEqual(CustomUser.objects.get(pk=author.pk).karma, len(voters))
+
+
+class CommentCountNewsTest(TestCase):
+    """Tests the comment counters of stories and ancestor comments."""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='test', email='hi@hackergrows.com', password='top_secret')
+        self.story = Story(original_url="https://hackergrows.com", product_url="https://hackergrows.com/p",
+                           title="Story", product_title="Product", user=self.user)
+        self.story.save()
+
+    def _thread(self, depth):
+        parent = None
+        comments = []
+        for i in range(depth):
+            parent = Comment(to_story=self.story, text="...",
+                             user=self.user, parent=parent)
+            parent.save()
+            comments.append(parent)
+        return comments
+
+    def test_ancestors_are_counted(self):
+        comments = self._thread(4)
+        self.assertEqual(Story.objects.get(pk=self.story.pk).num_comments, 4)
+        self.assertEqual([Comment.objects.get(pk=c.pk).num_comments for c in comments],
+                         [3, 2, 1, 0])
+
+        comments[-1].delete()
+        self.assertEqual(Story.objects.get(pk=self.story.pk).num_comments, 3)
+        self.assertEqual([Comment.objects.get(pk=c.pk).num_comments for c in comments[:-1]],
+                         [2, 1, 0])
+
+    def _reply(self, parent):
+        comment = Comment(to_story=self.story, text="...", user=self.user, parent=parent)
+        comment.save()
+        return comment
+
+    def test_deleting_a_comment_with_replies(self):
+        # a
+        # +- b           deleted with its replies
+        # |  +- b1
+        # |     +- b11
+        # +- c           later leaf sibling
+        # +- d
+        #    +- d1
+        a = self._reply(None)
+        b = self._reply(a)
+        b1 = self._reply(b)
+        self._reply(b1)
+        c = self._reply(a)
+        d = self._reply(a)
+        d1 = self._reply(d)
+
+        Comment.objects.get(pk=b.pk).delete()
+        self.assertEqual(Story.objects.get(pk=self.story.pk).num_comments, 4)
+        self.assertEqual([Comment.objects.get(pk=comment.pk).num_comments for comment in (a, c, d, d1)],
+                         [3, 0, 1, 0])
+
+        # As item_delete does
+        Item.objects.get(pk=d.pk).delete()
+        self.assertEqual(Story.objects.get(pk=self.story.pk).num_comments, 2)
+        self.assertEqual([Comment.objects.get(pk=comment.pk).num_comments for comment in (a, c)], [1, 0])
+
+    def test_query_count_does_not_depend_on_depth(self):
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+        from .receivers import _recount_comments
+
+        def queries(comment):
+            comment = Comment.objects.get(pk=comment.pk)
+            with CaptureQueriesContext(connection) as context:
+                _recount_comments(comment, 1)
+            return len(context.captured_queries)
+
+        shallow = self._thread(1)[-1]
+        deep = self._thread(20)[-1]
+        self.assertEqual(queries(shallow), 1)
+        self.assertEqual(queries(deep), 1)
+
+
+@override_settings(VOTE_QUEUE=True)
+class VoteQueueNewsTest(TestCase):
+    """Tests the queued vote path."""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.author = CustomUser.objects.create_user(
+            username='author', email='a@hackergrows.com', password='top_secret')
+        self.user = CustomUser.objects.create_user(
+            username='test', email='hi@hackergrows.com', password='top_secret')
+        self.story = Story(original_url="https://hackergrows.com", product_url="https://hackergrows.com/p",
+                           title="Story", product_title="Product", user=self.author)
+        self.story.save()
+
+    def _vote(self, user, vote=1):
+        from .views import _vote
+        request = self.factory.post('/item/%s/upvote' % (self.story.pk))
+        request.user = user
+        return _vote(request, self.story.pk, vote=vote)
+
+    def test_votes_are_applied_on_flush(self):
+        from .vote_queue import flush_votes
+        response = self._vote(self.user)
+        self.assertContains(response, 'OK')
+        # A second click before the flush must not count twice
+        self._vote(self.user)
+        self.assertEqual(Story.objects.get(pk=self.story.pk).points, 1)
+
+        self.assertEqual(flush_votes(), 2)
+        story = Story.objects.get(pk=self.story.pk)
+        self.assertEqual(story.points, 2)
+        self.assertEqual(story.upvotes, 2)
+        self.assertGreaterEqual(story.rank_score, 0)
+        self.assertEqual(CustomUser.objects.get(pk=self.author.pk).karma, 1)
+        self.assertEqual(Vote.objects.filter(item=self.story, user=self.user).count(), 1)
+        self.assertEqual(QueuedVote.objects.count(), 0)
+
+    def test_rules_are_enforced(self):
+        from .vote_queue import enqueue_vote, flush_votes
+        self.assertEqual(self._vote(self.author).status_code, 403)
+        self.assertEqual(self._vote(self.user, vote=-1).status_code, 403)
+        # Queued by other means, the flush still rejects them
+        enqueue_vote(self.story, self.author, 1)
+        enqueue_vote(self.story, self.user, -1)
+        flush_votes()
+        story = Story.objects.get(pk=self.story.pk)
+        self.assertEqual(story.points, 1)
+        self.assertEqual(story.downvotes, 0)
+
+    def test_synchronous_vote_before_flush(self):
+        from unittest import mock
+        from . import vote_queue
+        self._vote(self.user)
+        accepted_votes = vote_queue._accepted_votes
+
+        def vote_meanwhile(queued, authors):
+            votes = accepted_votes(queued, authors)
+            # Cast on the synchronous path after the flush checked the votes
+            with override_settings(VOTE_QUEUE=False):
+                self._vote(self.user)
+            return votes
+
+        with mock.patch.object(vote_queue, '_accepted_votes', vote_meanwhile):
+            self.assertEqual(vote_queue.flush_votes(), 1)
+        story = Story.objects.get(pk=self.story.pk)
+        self.assertEqual(story.points, 2)
+        self.assertEqual(story.upvotes, 2)
+        self.assertEqual(CustomUser.objects.get(pk=self.author.pk).karma, 1)
+        self.assertEqual(Vote.objects.filter(item=self.story, user=self.user).count(), 1)
+
+
+class VoteStateNewsTest(TestCase):
+    """The vote arrows of a page are rendered without a query per item."""
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.author = CustomUser.objects.create_user(
+            username='author', email='a@hackergrows.com', password='top_secret')
+        self.user = CustomUser.objects.create_user(
+            username='test', email='hi@hackergrows.com', password='top_secret')
+
+    def _add_stories(self, count):
+        for i in range(count):
+            story = Story(original_url="https://hackergrows.com/%s" % (i),
+                          product_url="https://hackergrows.com/p/%s" % (i),
+                          title="Story", product_title="Product", user=self.author)
+            story.save()
+            if i % 2:
+                Vote(item=story, user=self.user).save()
+
+    def _queries(self, view, path):
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+        cache.clear()
+        # Every call builds its own front page snapshot
+        PublishedSnapshot.objects.all().delete()
+        request = self.factory.get(path)
+        request.user = self.user
+        with CaptureQueriesContext(connection) as context:
+            response = view(request)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_query_count_is_constant_per_page(self):
+        self._add_stories(3)
+        few = [self._queries(index, '/'), self._queries(newest, '/newest')]
+        self._add_stories(10)
+        many = [self._queries(index, '/'), self._queries(newest, '/newest')]
+        self.assertEqual(few, many)
+
+    def test_arrows_follow_votes(self):
+        self._add_stories(2)
+        request = self.factory.get('/newest')
+        request.user = self.user
+        response = newest(request)
+        # One story was upvoted already, the other one can be
+        self.assertContains(response, 'class="vote-form upvote"', count=1)
+
+
+class TitleServer:
+    """Local HTTP stand-in serving slow pages with a title."""
+
+    def __init__(self, delay=1):
+        import threading
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        server = self
+        self.requests = 0
+        self.hang_ups = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                time.sleep(delay)
+                if self.path.startswith('/missing'):
+                    self.send_error(404)
+                    return
+                if self.path.startswith('/large'):
+                    self._send_large(b"<title>Large page</title>" if 'title' in self.path else b"")
+                    return
+                body = b"<html><head><title>Slow &amp; steady</title></head><body></body></html>"
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_large(self, title, size=32*1024*1024):
+                # Head, then filler until the client hangs up
+                chunk = b"<p>" + b"x"*(64*1024 - 7) + b"</p>"
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(size))
+                self.end_headers()
+                try:
+                    head = b"<html><head>" + title
+                    self.wfile.write(head)
+                    sent = len(head)
+                    while sent + len(chunk) <= size:
+                        self.wfile.write(chunk)
+                        sent += len(chunk)
+                    self.wfile.write(b" "*(size - sent))
+                except (BrokenPipeError, ConnectionResetError):
+                    server.hang_ups += 1
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%s%s' % (self.httpd.server_address[1], path)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TitleFetchNewsTest(TransactionTestCase):
+    """Submissions do not wait for the titles of their links."""
+
+    def setUp(self):
+        import tempfile
+        self.factory = RequestFactory()
+        self.user = CustomUser.objects.create_user(
+            username='test', email='hi@hackergrows.com', password='top_secret')
+        self.server = TitleServer()
+        self.settings = override_settings(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'titles': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                       'LOCATION': tempfile.mkdtemp()},
+        })
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.server.close()
+
+    def _submit(self, original_url, product_url):
+        request = self.factory.post(
+            '/submit', {'original_url': original_url, 'product_url': product_url})
+        request.user = self.user
+        start = time.perf_counter()
+        response = submit(request)
+        elapsed = time.perf_counter() - start
+        self.assertEqual(response.status_code, 302)
+        return Story.objects.get(pk=response.url.split('/')[-1]), elapsed
+
+    def _wait_for(self, story, field, value, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if getattr(Story.objects.get(pk=story.pk), field) == value:
+                return
+            time.sleep(0.05)
+        self.fail("%s of %s was not back-filled" % (field, story))
+
+    def test_submit_latency_does_not_depend_on_fetch(self):
+        original_url, product_url = self.server.url('/discussion'), self.server.url('/product')
+        story, elapsed = self._submit(original_url, product_url)
+        self.assertLess(elapsed, 0.5)
+        # The URL is the title until the background fetch is done
+        self.assertEqual(story.title, original_url)
+        self._wait_for(story, 'title', 'Slow & steady')
+        self._wait_for(story, 'product_title', 'Slow & steady')
+        self.assertEqual(self.server.requests, 2)
+
+        # Known URLs are resolved from the cache right away
+        story, elapsed = self._submit(original_url, product_url)
+        self.assertEqual(story.title, 'Slow & steady')
+        self.assertEqual(self.server.requests, 2)
+
+    def test_failed_fetches_are_cached(self):
+        from .titles import get_title, cached_title, NO_TITLE
+        url = self.server.url('/missing')
+        self.assertEqual(get_title(url, back_up_title=url), url)
+        self.assertEqual(cached_title(url), NO_TITLE)
+        self.assertEqual(get_title(url, back_up_title=url), url)
+        self.assertEqual(self.server.requests, 1)
+
+
+class TitleExtractorNewsTest(TestCase):
+    """Only the head of a page is read to find its title."""
+
+    def test_title_split_across_chunks(self):
+        from .titles import extract_title
+        page = b"<html><head><title>\n  Split &amp; joined \n</title></head><body>"
+        for size in (1, 3, 7, 64):
+            chunks = [page[i:i + size] for i in range(0, len(page), size)]
+            self.assertEqual(extract_title(chunks), 'Split & joined')
+
+    def test_reading_stops_after_title(self):
+        from .titles import extract_title
+        read = []
+
+        def chunks():
+            for chunk in (b"<head><title>First</ti", b"tle>", b"<body>", b"never"):
+                read.append(chunk)
+                yield chunk
+        self.assertEqual(extract_title(chunks()), 'First')
+        self.assertEqual(len(read), 2)
+
+    def test_charset(self):
+        from .titles import extract_title
+        latin = "<title>Caf\u00e9</title>".encode('iso-8859-1')
+        self.assertEqual(extract_title([latin], content_type='text/html; charset=ISO-8859-1'), 'Caf\u00e9')
+        meta = b'<head><meta charset="windows-1252">' + latin
+        self.assertEqual(extract_title([meta]), 'Caf\u00e9')
+        meta = b'<head><meta http-equiv="Content-Type" content="text/html; charset=latin-1">' + latin
+        self.assertEqual(extract_title([meta]), 'Caf\u00e9')
+        # The header wins over the page, unknown charsets are skipped
+        self.assertEqual(extract_title(["<title>Caf\u00e9</title>".encode('utf-8')],
+                                       content_type='text/html; charset=utf-8'), 'Caf\u00e9')
+        self.assertEqual(extract_title([latin], content_type='text/html; charset=bogus'), 'Caf\ufffd')
+        self.assertEqual(extract_title([b'\xef\xbb\xbf' + "<title>Caf\u00e9</title>".encode('utf-8')]), 'Caf\u00e9')
+
+    def test_byte_cap(self):
+        from .titles import extract_title
+        read = []
+
+        def chunks():
+            while True:
+                read.append(1024)
+                yield b"x"*1024
+        self.assertIsNone(extract_title(chunks(), max_bytes=16*1024))
+        self.assertEqual(len(read), 16)
+        self.assertIsNone(extract_title([b"<html><head></head><title>Too late</title>"]))
+
+    def test_large_pages(self):
+        """Benchmark: 32MB pages served locally are fetched in bounded time and memory."""
+        import tracemalloc
+        from .titles import _fetch_title, MAX_HEAD_BYTES
+        server = TitleServer(delay=0)
+        try:
+            for path, title in (('/large-title', 'Large page'), ('/large', None)):
+                tracemalloc.start()
+                start = time.perf_counter()
+                self.assertEqual(_fetch_title(server.url(path)), title)
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                self.assertLess(elapsed, 2)
+                self.assertLess(peak, 4*MAX_HEAD_BYTES)
+            deadline = time.time() + 5
+            while server.hang_ups < 2 and time.time() < deadline:
+                time.sleep(0.05)
+            # The connection was dropped long before the end of the page
+            self.assertEqual(server.hang_ups, 2)
+        finally:
+            server.close()
+
+
+class CommentTreeNewsTest(TestCase):
+    """The item page loads its comment tree with one query."""
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.user = CustomUser.objects.create_user(
+            username='test', email='hi@hackergrows.com', password='top_secret')
+        self.story = Story(original_url="https://hackergrows.com", product_url="https://hackergrows.com/p",
+                           title="Story", product_title="Product", user=self.user)
+        self.story.save()
+
+    def _comment(self, parent=None, text="..."):
+        comment = Comment(to_story=self.story, text=text, user=self.user, parent=parent)
+        comment.save()
+        return comment
+
+    def _render(self, item):
+        request = self.factory.get(item.get_absolute_url())
+        request.user = self.user
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+        with CaptureQueriesContext(connection) as context:
+            response = globals()['item'](request, item.pk)
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode('utf-8'), len(context.captured_queries)
+
+    def test_tree(self):
+        from .comment_tree import load_comment_tree, INDENT
+        first = self._comment(text="first")
+        reply = self._comment(first, text="reply")
+        reply_to_reply = self._comment(reply, text="reply to reply")
+        second = self._comment(text="second")
+        story = Story.objects.get(pk=self.story.pk)
+
+        with self.assertNumQueries(1):
+            comments = load_comment_tree(story)
+            self.assertEqual([c.text for c in comments],
+                             ["first", "reply", "reply to reply", "second"])
+            self.assertEqual([c.depth for c in comments], [0, 1, 2, 0])
+            self.assertEqual([c.indent for c in comments], [0, INDENT, 2*INDENT, 0])
+            self.assertEqual(comments[0].replies, [comments[1]])
+            self.assertEqual(comments[1].user, self.user)
+
+        # The page of a comment shows its replies only
+        comments = load_comment_tree(Comment.objects.get(pk=first.pk))
+        self.assertEqual([c.pk for c in comments], [reply.pk, reply_to_reply.pk])
+        self.assertEqual([c.depth for c in comments], [0, 1])
+
+        content, _ = self._render(story)
+        positions = [content.index('id="%s"' % (c.pk)) for c in (first, reply, reply_to_reply, second)]
+        self.assertEqual(positions, sorted(positions))
+        content, _ = self._render(Comment.objects.get(pk=reply.pk))
+        self.assertIn('id="%s"' % (reply_to_reply.pk), content)
+        self.assertNotIn('id="%s"' % (second.pk), content)
+
+    def test_query_count_does_not_depend_on_thread_size(self):
+        """Benchmark fixture: a 2000 comment thread renders with as many queries as a small one."""
+        from .management.commands.benchmark_comments import build_thread
+        small = Story(original_url="https://hackergrows.com/small", product_url="https://hackergrows.com/small",
+                      title="Small", product_title="Product", user=self.user)
+        small.save()
+        build_thread(small, 10)
+        large = build_thread(self.story, 2000)
+        self.assertEqual(large.num_comments, 2000)
+        self.assertEqual(Comment.objects.filter(to_story=large).count(), 2000)
+
+        _, small_queries = self._render(small)
+        content, large_queries = self._render(large)
+        self.assertEqual(large_queries, small_queries)
+        comments = Comment.objects.filter(to_story=large).order_by('tree_id', 'lft')
+        positions = [content.index('id="%s"' % (pk)) for pk in comments.values_list('pk', flat=True)]
+        self.assertEqual(positions, sorted(positions))
+
+
+@override_settings(RATELIMIT_ENABLE=False)
+class CommentFragmentCacheNewsTest(TestCase):
+    """Comment subtrees are rendered once per version."""
+
+    def setUp(self):
+        from django.core.cache import caches
+        caches['comments'].clear()
+        self.factory = RequestFactory()
+        self.user = CustomUser.objects.create_user(
+            username='test', email='hi@hackergrows.com', password='top_secret')
+        self.other_user = CustomUser.objects.create_user(
+            username='test2', email='hi2@hackergrows.com', password='top_secret')
+        self.story = Story(original_url="https://hackergrows.com", product_url="https://hackergrows.com/p",
+                           title="Story", product_title="Product", user=self.user)
+        self.story.save()
+
+    def _comment(self, parent=None, text="...", user=None):
+        comment = Comment(to_story=self.story, text=text, user=user or self.user, parent=parent)
+        comment.save()
+        return comment
+
+    def _render(self, user, item=None):
+        """Returns the page and the texts of the comments rendered from scratch."""
+        from django.test.signals import template_rendered
+        rendered = []
+
+        def on_render(sender, template, context, **kwargs):
+            if template.name == 'news/_comment.html':
+                rendered.append(context['node'].text)
+        template_rendered.connect(on_render)
+        try:
+            item = item or self.story
+            request = self.factory.get(item.get_absolute_url())
+            request.user = user
+            response = globals()['item'](request, item.pk)
+        finally:
+            template_rendered.disconnect(on_render)
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode('utf-8'), rendered
+
+    def test_only_changed_branches_are_rendered(self):
+        first = self._comment(text="first")
+        reply = self._comment(first, text="reply")
+        second = self._comment(text="second")
+        second_reply = self._comment(second, text="second reply")
+
+        _, rendered = self._render(self.user)
+        self.assertEqual(rendered, ["first", "reply", "second", "second reply"])
+        _, rendered = self._render(self.user)
+        self.assertEqual(rendered, [])
+
+        # A new reply re-renders itself and its ancestors only
+        self._comment(reply, text="reply to reply")
+        content, rendered = self._render(self.user)
+        self.assertEqual(rendered, ["first", "reply", "reply to reply"])
+        self.assertIn("reply to reply", content)
+
+        edited = Comment.objects.get(pk=second_reply.pk)
+        edited.text = "second reply, edited"
+        edited.save()
+        content, rendered = self._render(self.user)
+        self.assertEqual(rendered, ["second", "second reply, edited"])
+        self.assertIn("second reply, edited", content)
+
+        Comment.objects.get(pk=second_reply.pk).delete()
+        content, rendered = self._render(self.user)
+        self.assertEqual(rendered, ["second"])
+        self.assertNotIn("second reply", content)
+
+        # The page of a comment is indented differently
+        _, rendered = self._render(self.user, Comment.objects.get(pk=first.pk))
+        self.assertEqual(rendered, ["reply", "reply to reply"])
+
+    def test_per_user_parts_are_not_cached(self):
+        comment = self._comment(text="hello", user=self.other_user)
+        upvote_url = reverse('upvote', kwargs={'pk': comment.pk})
+        edit_url = reverse('edit', kwargs={'pk': comment.pk})
+
+        content, rendered = self._render(self.user)
+        self.assertEqual(rendered, ["hello"])
+        self.assertIn(upvote_url, content)
+        self.assertNotIn(edit_url, content)
+        self.assertIn("1 point ", content)
+
+        Vote(user=self.user, item=comment, vote=1).save()
+        content, rendered = self._render(self.user)
+        self.assertEqual(rendered, [])
+        self.assertNotIn(upvote_url, content)
+        self.assertIn("2 points ", content)
+
+        content, rendered = self._render(self.other_user)
+        self.assertEqual(rendered, [])
+        self.assertNotIn(upvote_url, content)
+        self.assertIn(edit_url, content)
+        self.assertIn('class="self-item"', content)
+
+        content, _ = self._render(AnonymousUser())
+        self.assertNotIn(upvote_url, content)
+        self.assertNotIn(edit_url, content)
+        self.assertNotIn('<!--comment-', content)
+
+
+@override_settings(RATELIMIT_ENABLE=False)
+class TextHtmlNewsTest(TestCase):
+    """Markdown is rendered on save, not on page views."""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = CustomUser.objects.create_user(
+            username='test', email='hi@hackergrows.com', password='top_secret')
+        self.story = Story(original_url="https://hackergrows.com", product_url="https://hackergrows.com/p",
+                           title="Story", product_title="Product", user=self.user, text="Story *text*")
+        self.story.save()
+
+    def test_rendered_on_save(self):
+        from unittest import mock
+        from .markdown import RENDERER_VERSION
+        comment = Comment(to_story=self.story, text="# Title\n<b>x</b> **bold**", user=self.user)
+        comment.save()
+        comment = Comment.objects.get(pk=comment.pk)
+        self.assertIn("<strong>bold</strong>", comment.text_html)
+        self.assertIn("&lt;b&gt;", comment.text_html)
+        self.assertIn("<h3>", comment.text_html)
+        self.assertEqual(comment.text_html_version, RENDERER_VERSION)
+        self.assertIn("<em>text</em>", Story.objects.get(pk=self.story.pk).text_html)
+
+        comment.text = "edited _text_"
+        comment.save()
+        self.assertIn("<em>text</em>", Comment.objects.get(pk=comment.pk).text_html)
+
+        with mock.patch('news.markdown.markdown', side_effect=AssertionError("parsed at request time")):
+            request = self.factory.get(self.story.get_absolute_url())
+            request.user = self.user
+            content = item(request, self.story.pk).content.decode('utf-8')
+        self.assertIn("<em>text</em>", content)
+        self.assertIn("<p>edited <em>text</em></p>", content)
+
+    def test_command_renders_outdated_items(self):
+        from .markdown import RENDERER_VERSION
+        comment = Comment(to_story=self.story, text="*outdated*", user=self.user)
+        comment.save()
+        current = Comment(to_story=self.story, text="*current*", user=self.user)
+        current.save()
+        Comment.objects.filter(pk=comment.pk).update(text_html='', text_html_version=RENDERER_VERSION - 1)
+        Story.objects.filter(pk=self.story.pk).update(text_html='', text_html_version=RENDERER_VERSION - 1)
+        # Caches the fragment of the outdated comment
+        request = self.factory.get(self.story.get_absolute_url())
+        request.user = self.user
+        self.assertNotContains(item(request, self.story.pk), "<em>outdated</em>")
+
+        from django.core.management import call_command
+        out = StringIO()
+        call_command('render_markdown', batch_size=1, stdout=out)
+        self.assertIn("Rendered 1 stories", out.getvalue())
+        self.assertIn("Rendered 1 comments", out.getvalue())
+        comment = Comment.objects.get(pk=comment.pk)
+        self.assertEqual(comment.text_html, "<p><em>outdated</em></p>\n")
+        self.assertEqual(comment.text_html_version, RENDERER_VERSION)
+        self.assertIn("<em>text</em>", Story.objects.get(pk=self.story.pk).text_html)
+        # Served from a new fragment, in every process
+        self.assertContains(item(request, self.story.pk), "<em>outdated</em>")
+
+        out = StringIO()
+        call_command('render_markdown', '--all', stdout=out)
+        self.assertIn("Rendered 2 comments", out.getvalue())
+
+
+class RankingEngineNewsTest(TestCase):
+    """The ranking paths agree with each other."""
+
+    def setUp(self):
+        import random
+        self.user = CustomUser.objects.create_user(
+            username='test', email='hi@hackergrows.com', password='top_secret')
+        self.now = timezone.now()
+        rnd = random.Random(4)
+        for i in range(60):
+            story = Story(original_url="https://hackergrows.com/%s" % (i),
+                          product_url="https://hackergrows.com/p/%s" % (i),
+                          title="Story %s" % (i), product_title="Product", user=self.user)
+            story.save()
+            upvotes, downvotes = rnd.randint(1, 300), rnd.randint(0, 40)
+            # A few exact ties, broken by age
+            if i % 10 == 0:
+                upvotes, downvotes = 10, 2
+            Item.objects.filter(pk=story.pk).update(
+                upvotes=upvotes, downvotes=downvotes, points=upvotes - downvotes,
+                created_at=self.now - datetime.timedelta(minutes=rnd.randint(1, 60*24*10)))
+
+    def _ranked(self, strategy, path, offset=0, limit=100):
+        from .ranking import rank
+        stories = Story.objects.filter(points__gte=1)
+        return [s.pk for s in rank(stories, strategy, now=self.now, offset=offset, limit=limit, path=path)]
+
+    def test_paths_agree(self):
+        from .ranking import STRATEGIES, SQL, PYTHON, best_path
+        for name in STRATEGIES:
+            self.assertEqual(best_path(STRATEGIES[name]), SQL)
+            expected = self._ranked(name, PYTHON)
+            self.assertEqual(len(expected), Story.objects.filter(points__gte=1).count())
+            self.assertEqual(self._ranked(name, SQL), expected, name)
+            self.assertEqual(self._ranked(name, SQL, offset=7, limit=11), expected[7:18], name)
+            self.assertEqual(self._ranked(name, PYTHON, offset=7, limit=11), expected[7:18], name)
+
+    def test_numpy_path_agrees(self):
+        from .ranking import STRATEGIES, NUMPY, PYTHON, numpy
+        if numpy is None:
+            self.skipTest("NumPy is not installed")
+        for name in STRATEGIES:
+            self.assertEqual(self._ranked(name, NUMPY), self._ranked(name, PYTHON), name)
+
+    def test_scores(self):
+        from .ranking import STRATEGIES, rank_score
+        for story in Story.objects.all():
+            self.assertAlmostEqual(STRATEGIES['gravity'].score(story, self.now),
+                                   rank_score(story.points, story.created_at, self.now))
+            self.assertAlmostEqual(STRATEGIES['decay'].score(story, self.now),
+                                   (story.points - 1) * 0.5 ** ((self.now - story.created_at) / datetime.timedelta(days=1)))
+            self.assertTrue(0 <= STRATEGIES['wilson'].score(story, self.now) <= story.upvotes / (story.upvotes + story.downvotes))
+
+    def test_unsupported_backend(self):
+        from unittest import mock
+        from django.db import connections
+        from .ranking import STRATEGIES, SQL, best_path
+        expected = self._ranked('gravity', SQL, limit=30)
+        with mock.patch.object(connections['default'], 'vendor', 'oracle'):
+            self.assertNotEqual(best_path(STRATEGIES['gravity']), SQL)
+            stories = _front_page(as_of=self.now)
+        self.assertEqual([s.pk for s in stories], expected)
+        self.assertEqual([s.pk for s in _front_page(as_of=self.now, page=1, paging_size=10)], expected[10:20])
+
+    def test_window_matches_full_ranking(self):
+        from .ranking import rank, rank_recent, SQL, PYTHON
+        stories = Story.objects.filter(points__gte=1)
+        for strategy in ('gravity', 'decay', 'wilson'):
+            for path in (SQL, PYTHON):
+                for offset, limit in ((0, 10), (10, 10), (45, 10), (0, 60), (70, 10)):
+                    self.assertEqual(
+                        [s.pk for s in rank_recent(stories, strategy, now=self.now, offset=offset, limit=limit, path=path)],
+                        [s.pk for s in rank(stories, strategy, now=self.now, offset=offset, limit=limit, path=path)],
+                        (strategy, path, offset, limit))
+
+    def test_window_skips_old_stories(self):
+        from unittest import mock
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+        from .ranking import rank, rank_recent, HackerNewsGravity, Strategy, PYTHON
+
+        def queries():
+            with CaptureQueriesContext(connection) as context:
+                rank_recent(Story.objects.filter(points__gte=1), 'gravity', now=self.now, limit=30)
+            return len(context.captured_queries)
+        before = queries()
+
+        old = []
+        for i in range(40):
+            story = Story(original_url="https://hackergrows.com/old/%s" % (i),
+                          product_url="https://hackergrows.com/old/p/%s" % (i),
+                          title="Old %s" % (i), product_title="Product", user=self.user)
+            story.save()
+            old.append(story.pk)
+        Item.objects.filter(pk__in=old).update(points=100, upvotes=100,
+                                               created_at=self.now - datetime.timedelta(days=400))
+        stories = Story.objects.filter(points__gte=1)
+        expected = [s.pk for s in rank(stories, 'gravity', now=self.now, limit=30)]
+        self.assertFalse(set(expected) & set(old))
+
+        with mock.patch.object(HackerNewsGravity, 'score_many', autospec=True,
+                               side_effect=Strategy.score_many) as score_many:
+            ranked = rank_recent(stories, 'gravity', now=self.now, limit=30, path=PYTHON)
+        self.assertEqual([s.pk for s in ranked], expected)
+        for call in score_many.call_args_list:
+            self.assertFalse(set(call[0][1]['pk']) & set(old))
+
+        # The cost does not depend on the number of old stories
+        self.assertEqual(queries(), before)
+
+
+    def test_window_with_one_point_stories(self):
+        from unittest import mock
+        from .ranking import rank, rank_recent, HackerNewsGravity, Strategy, SQL, PYTHON
+        Item.objects.all().delete()
+
+        def add(name, points, hours_ago):
+            story = Story(original_url="https://hackergrows.com/%s" % (name),
+                          product_url="https://hackergrows.com/p/%s" % (name),
+                          title=name, product_title="Product", user=self.user)
+            story.save()
+            Item.objects.filter(pk=story.pk).update(
+                points=points, upvotes=points, downvotes=0,
+                created_at=self.now - datetime.timedelta(hours=hours_ago))
+            return story.pk
+        # A quiet day: the page is filled with one point stories
+        for i in range(20):
+            add("recent %s" % (i), 1, i)
+        old = [add("old %s" % (i), 1, 24*30 + i) for i in range(20)]
+        upvoted = add("old upvoted", 3, 24*60)
+        stories = Story.objects.filter(points__gte=1)
+        for path in (SQL, PYTHON):
+            expected = [s.pk for s in rank(stories, 'gravity', now=self.now, limit=10, path=path)]
+            self.assertEqual(expected[0], upvoted)
+            self.assertEqual([s.pk for s in rank_recent(stories, 'gravity', now=self.now, limit=10, path=path)],
+                             expected, path)
+            self.assertEqual([s.pk for s in rank_recent(stories, 'gravity', now=self.now, offset=10, limit=10, path=path)],
+                             [s.pk for s in rank(stories, 'gravity', now=self.now, offset=10, limit=10, path=path)])
+
+        with mock.patch.object(HackerNewsGravity, 'score_many', autospec=True,
+                               side_effect=Strategy.score_many) as score_many:
+            rank_recent(stories, 'gravity', now=self.now, limit=10, path=PYTHON)
+        for call in score_many.call_args_list:
+            self.assertFalse(set(call[0][1]['pk']) & set(old))
+
+
+@override_settings(RATELIMIT_ENABLE=False)
+class FrontPageHistoryNewsTest(TestCase):
+    """Past front pages are read from recorded snapshots."""
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.user = CustomUser.objects.create_user(
+            username='test', email='hi@hackergrows.com', password='top_secret')
+        self.stories = []
+        for points in (5, 50, 20):
+            story = Story(original_url="https://hackergrows.com/%s" % (points),
+                          product_url="https://hackergrows.com/p/%s" % (points),
+                          title="Story with %s points" % (points), product_title="Product", user=self.user)
+            story.save()
+            Item.objects.filter(pk=story.pk).update(points=points)
+            self.stories.append(story)
+        from django.core.management import call_command
+        call_command('rerank_stories', '--all', stdout=StringIO())
+
+    def _front(self, query):
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+        request = self.factory.get('/front', query)
+        request.user = AnonymousUser()
+        with CaptureQueriesContext(connection) as context:
+            try:
+                response = front(request)
+            except Http404:
+                response = None
+        return response, [q['sql'] for q in context.captured_queries]
+
+    def test_record_and_read(self):
+        from .snapshots import record_snapshot
+        yesterday = timezone.now() - datetime.timedelta(days=1)
+        snapshots = record_snapshot(now=yesterday)
+        self.assertEqual(sorted(s.listing for s in snapshots), ['ask', 'index', 'show'])
+        # Today's ranking changes, yesterday's front page does not
+        Item.objects.filter(pk=self.stories[0].pk).update(points=500)
+
+        day = timezone.localdate(yesterday).isoformat()
+        response, queries = self._front({'day': day})
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode('utf-8')
+        positions = [content.index('Story with %s points' % (points)) for points in (50, 20, 5)]
+        self.assertEqual(positions, sorted(positions))
+        self.assertEqual(len([q for q in queries if 'news_frontpagesnapshot' in q]), 1)
+        self.assertEqual(len(queries), 2)
+
+        # Yesterday is the default, a day without a record of its own is not found
+        response, _ = self._front({})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(self._front({'day': timezone.localdate().isoformat()})[0])
+        record_snapshot()
+        response, _ = self._front({'day': timezone.localdate().isoformat()})
+        self.assertEqual(response.status_code, 200)
+
+        before = (timezone.localdate(yesterday) - datetime.timedelta(days=1)).isoformat()
+        self.assertIsNone(self._front({'day': before})[0])
+        self.assertIsNone(self._front({'day': 'yesterday'})[0])
+        self.assertIsNone(self._front({'day': day, 'listing': 'nope'})[0])
+
+    def test_command(self):
+        from django.core.management import call_command
+        out = StringIO()
+        call_command('record_front_page', stdout=out)
+        self.assertIn("Recorded 3 listings", out.getvalue())
+        out = StringIO()
+        call_command('record_front_page', stdout=out)
+        self.assertIn("nothing to do", out.getvalue())
+        call_command('record_front_page', '--force', stdout=StringIO())
+        self.assertEqual(FrontPageSnapshot.objects.count(), 6)
+
+        as_of = timezone.now() + datetime.timedelta(minutes=1)
+        call_command('record_front_page', '--as-of', as_of.isoformat(), stdout=StringIO())
+        snapshot = FrontPageSnapshot.objects.get(listing='index', taken_at=as_of)
+        self.assertEqual(snapshot.ids, [self.stories[i].pk for i in (1, 2, 0)])
+
+
+@override_settings(RATELIMIT_ENABLE=False)
+class UpvotedListingNewsTest(TestCase):
+    """Tests the upvoted_by listings served from UpvotedItem."""
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.author = CustomUser.objects.create_user(
+            username='author', email='a@hackergrows.com', password='top_secret')
+        self.user = CustomUser.objects.create_user(
+            username='test', email='hi@hackergrows.com', password='top_secret')
+        created_at = timezone.now()
+        self.stories = []
+        for i in range(5):
+            story = Story(original_url="https://hackergrows.com/%s" % (i),
+                          product_url="https://hackergrows.com/p/%s" % (i),
+                          title="Story number %s" % (i), product_title="Product", user=self.author)
+            story.save()
+            Item.objects.filter(pk=story.pk).update(
+                created_at=created_at - datetime.timedelta(minutes=i))
+            self.stories.append(story)
+
+    def _get(self, view, path, params):
+        request = self.factory.get(path, params)
+        request.user = self.user
+        return view(request)
+
+    def test_index_follows_votes(self):
+        own = Story(original_url="https://hackergrows.com/own", product_url="https://hackergrows.com/p/own",
+                    title="Own story", product_title="Product", user=self.user)
+        own.save()
+        comment = Comment(to_story=self.stories[0], text="top", user=self.author)
+        comment.save()
+        reply = Comment(to_story=self.stories[0], parent=comment, text="reply", user=self.author)
+        reply.save()
+        own_comment = Comment(to_story=self.stories[0], text="own", user=self.user)
+        own_comment.save()
+        for item in (self.stories[1], self.stories[3], comment, reply):
+            Vote(item=item, user=self.user).save()
+        Vote(item=self.stories[2], user=self.user, vote=-1).save()
+
+        rows = UpvotedItem.objects.filter(user=self.user)
+        # Neither the self upvote of the own story, nor the reply or the
+        # downvote. The self upvote of the own comment is listed.
+        self.assertEqual({row.item_id: row.is_story for row in rows},
+                         {self.stories[1].pk: True, self.stories[3].pk: True, comment.pk: False,
+                          own_comment.pk: False})
+
+        Vote.objects.filter(item=self.stories[1], user=self.user).delete()
+        self.assertFalse(UpvotedItem.objects.filter(user=self.user, item=self.stories[1]).exists())
+
+    @override_settings(VOTE_QUEUE=True)
+    def test_queued_votes_are_indexed(self):
+        from .vote_queue import enqueue_vote, flush_votes
+        enqueue_vote(self.stories[0], self.user, 1)
+        enqueue_vote(self.stories[0], self.author, 1)
+        flush_votes()
+        self.assertEqual(list(UpvotedItem.objects.values_list('user', 'item')),
+                         [(self.user.pk, self.stories[0].pk)])
+
+    def test_listings(self):
+        from .upvotes import upvoted_items
+        from .pagination import item_cursor
+        for story in self.stories[:4]:
+            Vote(item=story, user=self.user).save()
+        Story.objects.filter(pk=self.stories[2].pk).update(duplicate_of=self.stories[0])
+
+        response = self._get(newest, '/newest', {'upvoted_by': 'test'})
+        self.assertContains(response, 'Story number 1')
+        self.assertNotContains(response, 'Story number 2')
+        self.assertNotContains(response, 'Story number 4')
+        self.assertEqual(self._get(newest, '/newest', {'upvoted_by': 'author'}).status_code, 403)
+
+        not_duplicate = {'duplicate_of__isnull': True}
+        first = upvoted_items(self.user, Story.objects.all(), paging_size=2, add_filter=not_duplicate)
+        self.assertEqual([s.pk for s in first], [self.stories[0].pk, self.stories[1].pk])
+        rest = upvoted_items(self.user, Story.objects.all(), paging_size=2, add_filter=not_duplicate,
+                             after=decode_cursor(item_cursor(first[-1])))
+        self.assertEqual([s.pk for s in rest], [self.stories[3].pk])
+
+        comment = Comment(to_story=self.stories[0], text="Upvoted comment", user=self.author)
+        comment.save()
+        Comment(to_story=self.stories[0], text="Other comment", user=self.author).save()
+        Vote(item=comment, user=self.user).save()
+        Comment(to_story=self.stories[0], text="Own comment", user=self.user).save()
+        response = self._get(comments, '/comments', {'upvoted_by': 'test'})
+        self.assertContains(response, 'Upvoted comment')
+        self.assertContains(response, 'Own comment')
+        self.assertNotContains(response, 'Other comment')
+
+    def test_listing_with_site(self):
+        from .pagination import item_cursor
+        for story in self.stories:
+            Vote(item=story, user=self.user).save()
+        on_site = []
+        for i in range(3):
+            story = Story(original_url="https://site.example.org/%s" % (i),
+                          product_url="https://hackergrows.com/p/site/%s" % (i),
+                          title="On site %s" % (i), product_title="Product", user=self.author)
+            story.save()
+            Item.objects.filter(pk=story.pk).update(
+                created_at=timezone.now() - datetime.timedelta(minutes=10 + i))
+            Vote(item=story, user=self.user).save()
+            on_site.append(story)
+        from .upvotes import upvoted_items
+        site = {'duplicate_of__isnull': True, 'original_url_domain': 'site.example.org'}
+        # The newer upvotes on other sites do not take the page
+        first = upvoted_items(self.user, Story.objects.all(), paging_size=2, add_filter=site)
+        self.assertEqual(first, on_site[:2])
+        rest = upvoted_items(self.user, Story.objects.all(), paging_size=2, add_filter=site,
+                             after=decode_cursor(item_cursor(first[-1])))
+        self.assertEqual(rest, on_site[2:])
+
+        with override_settings(RATELIMIT_ENABLE=False):
+            response = self._get(newest, '/newest', {'upvoted_by': 'test', 'site': 'site.example.org'})
+        self.assertContains(response, 'On site 0')
+        self.assertContains(response, 'On site 1')
+        self.assertNotContains(response, 'Story number')
+
+    def test_listing_does_not_scan_votes(self):
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+        Vote(item=self.stories[0], user=self.user).save()
+        with CaptureQueriesContext(connection) as context:
+            self._get(newest, '/newest', {'upvoted_by': 'test'})
+        self.assertFalse([q for q in context.captured_queries if 'IN (SELECT' in q['sql']])
+        self.assertEqual(len([q for q in context.captured_queries
+                              if 'news_upvoteditem' in q['sql']]), 1)
+
+
+@override_settings(RATELIMIT_ENABLE=False)
+class ListingCacheNewsTest(TestCase):
+    """Tests the filter-aware cache of the newest listing."""
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.author = CustomUser.objects.create_user(
+            username='author', email='a@hackergrows.com', password='top_secret')
+        self.user = CustomUser.objects.create_user(
+            username='test', email='hi@hackergrows.com', password='top_secret')
+        self._story("https://one.example.org/a", "Story on one")
+
+    def _story(self, url, title, user=None):
+        story = Story(original_url=url, product_url="https://product.example.com/",
+                      title=title, product_title="Product", user=user or self.author)
+        story.save()
+        return story
+
+    def _newest(self, params):
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+        request = self.factory.get('/newest', params)
+        request.user = self.user
+        with CaptureQueriesContext(connection) as context:
+            response = newest(request)
+        stories = [q for q in context.captured_queries if 'FROM "news_story"' in q['sql']]
+        return response, len(stories)
+
+    def test_keys(self):
+        from .listing_cache import page_key
+        self.assertEqual(page_key('newest', {'site': 'a', 'product': 'b'}),
+                         page_key('newest', {'product': 'b', 'site': 'a'}))
+        self.assertNotEqual(page_key('newest', {'site': 'a'}), page_key('newest', {'product': 'a'}))
+        self.assertNotEqual(page_key('newest', {}), page_key('newest', {}, page=1))
+        self.assertIn('-user-%s' % (self.user.pk), page_key('newest', {'upvoted_by': self.user.pk}))
+
+    def test_filters_are_not_mixed_up(self):
+        self._story("https://two.example.org/a", "Story on two")
+        response, _ = self._newest({'site': 'one.example.org'})
+        self.assertContains(response, 'Story on one')
+        self.assertNotContains(response, 'Story on two')
+        response, _ = self._newest({})
+        self.assertContains(response, 'Story on two')
+        response, _ = self._newest({'site': 'two.example.org'})
+        self.assertNotContains(response, 'Story on one')
+
+    def test_new_story_invalidates_matching_pages(self):
+        self.assertEqual(self._newest({'site': 'one.example.org'})[1], 1)
+        self.assertEqual(self._newest({'site': 'one.example.org'})[1], 0)
+
+        # Does not show up there, the page stays cached
+        self._story("https://two.example.org/a", "Story on two")
+        self.assertEqual(self._newest({'site': 'one.example.org'})[1], 0)
+
+        self._story("https://one.example.org/b", "Another story on one")
+        response, queries = self._newest({'site': 'one.example.org'})
+        self.assertEqual(queries, 1)
+        self.assertContains(response, 'Another story on one')
+
+    def test_private_pages_follow_votes(self):
+        story = self._story("https://two.example.org/a", "Story on two")
+        response, _ = self._newest({'upvoted_by': 'test'})
+        self.assertNotContains(response, 'Story on two')
+        Vote(item=story, user=self.user).save()
+        response, _ = self._newest({'upvoted_by': 'test'})
+        self.assertContains(response, 'Story on two')
+        Vote.objects.filter(item=story, user=self.user).delete()
+        response, _ = self._newest({'upvoted_by': 'test'})
+        self.assertNotContains(response, 'Story on two')
+
+
+@override_settings(RATELIMIT_ENABLE=False)
+class DomainStatsNewsTest(TestCase):
+    """Tests the per-domain listings and DomainStats."""
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.author = CustomUser.objects.create_user(
+            username='author', email='a@hackergrows.com', password='top_secret')
+        self.user = CustomUser.objects.create_user(
+            username='test', email='hi@hackergrows.com', password='top_secret')
+
+    def _story(self, url, product="https://product.example.com/"):
+        story = Story(original_url=url, product_url=product,
+                      title="Story %s" % (url), product_title="Product", user=self.author)
+        story.save()
+        return story
+
+    def _stats(self):
+        return {(s.kind, s.domain): (s.story_count, s.total_points)
+                for s in DomainStats.objects.all()}
+
+    def test_stats_are_maintained(self):
+        from .domains import rebuild_domain_stats
+        from .vote_queue import enqueue_vote, flush_votes
+        first = self._story("https://one.example.org/a")
+        self._story("https://one.example.org/b")
+        third = self._story("https://two.example.org/a", product="https://other.example.com/")
+        Vote(item=first, user=self.user).save()
+        enqueue_vote(third, self.user, 1)
+        flush_votes()
+        self.assertEqual(self._stats(), {
+            ('site', 'one.example.org'): (2, 3), ('site', 'two.example.org'): (1, 2),
+            ('product', 'product.example.com'): (2, 3), ('product', 'other.example.com'): (1, 2)})
+        self.assertEqual(Story.objects.get(pk=first.pk).submitted_at,
+                         Item.objects.get(pk=first.pk).created_at)
+
+        Vote.objects.filter(item=first, user=self.user).delete()
+        Story.objects.get(pk=third.pk).delete()
+        stats = self._stats()
+        self.assertEqual(stats[('site', 'one.example.org')], (2, 2))
+        self.assertEqual(stats[('site', 'two.example.org')], (0, 0))
+
+        rebuild_domain_stats()
+        del stats[('site', 'two.example.org')], stats[('product', 'other.example.com')]
+        self.assertEqual(self._stats(), stats)
+
+    def test_domain_listing_reads_submitted_at(self):
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+        from .views import _newest, _next_cursor
+        for i in range(5):
+            self._story("https://one.example.org/%s" % (i))
+        self._story("https://two.example.org/a")
+        with CaptureQueriesContext(connection) as context:
+            first = _newest(paging_size=3, add_filter={'original_url_domain': 'one.example.org'})
+        self.assertIn('ORDER BY "news_story"."submitted_at" DESC', context.captured_queries[0]['sql'])
+        rest = _newest(paging_size=3, add_filter={'original_url_domain': 'one.example.org'},
+                       after=decode_cursor(_next_cursor(first)))
+        self.assertEqual([s.original_url for s in first + rest],
+                         ["https://one.example.org/%s" % (i) for i in (4, 3, 2, 1, 0)])
+
+    def test_top_pages(self):
+        for i in range(3):
+            self._story("https://one.example.org/%s" % (i))
+        self._story("https://two.example.org/a", product="https://other.example.com/")
+        request = self.factory.get('/sites')
+        request.user = self.user
+        content = sites(request).content.decode('utf-8')
+        self.assertLess(content.index('one.example.org'), content.index('two.example.org'))
+        self.assertIn('?site=one.example.org', content)
+
+        request = self.factory.get('/products', {'order': 'total_points'})
+        request.user = self.user
+        self.assertContains(products(request), '?product=other.example.com')
+        request = self.factory.get('/products', {'order': 'nope'})
+        request.user = self.user
+        with self.assertRaises(Http404):
+            products(request)
+
+
+class FingerprintNewsTest(TestCase):
+    """Tests the URL normalization and the duplicate detection built on it."""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='test', email='hi@hackergrows.com', password='top_secret')
+        self.other_user = CustomUser.objects.create_user(
+            username='other', email='o@hackergrows.com', password='top_secret')
+
+    def test_normalize_url(self):
+        from .fingerprints import normalize_url
+        canonical = normalize_url("https://example.org/post?id=1&page=2")
+        for url in ["HTTP://WWW.Example.org/post/?page=2&id=1",
+                    "https://example.org:443/post?id=1&utm_source=x&page=2#comments",
+                    "https://www.example.org/post/?fbclid=abc&id=1&page=2"]:
+            self.assertEqual(normalize_url(url), canonical)
+        self.assertNotEqual(normalize_url("https://example.org/post?id=2&page=2"), canonical)
+        self.assertNotEqual(normalize_url("https://example.org:8080/post?id=1&page=2"), canonical)
+        self.assertEqual(normalize_url("https://example.org/"), normalize_url("https://example.org"))
+        self.assertNotEqual(normalize_url("https://github.com/org/repo?ref=v1"),
+                            normalize_url("https://github.com/org/repo?ref=v2"))
+
+    def test_duplicates_are_resolved_before_insert(self):
+        from django.db.models.signals import post_save
+        story = Story(original_url="https://www.example.org/thread/",
+                      product_url="https://product.example.com", user=self.user)
+        story.save()
+        saves = []
+
+        def count(sender, instance, **kwargs):
+            if isinstance(instance, Story):
+                saves.append(instance.pk)
+        post_save.connect(count)
+        try:
+            duplicate = Story(original_url="http://example.org/thread?utm_medium=social",
+                              product_url="https://PRODUCT.example.com/", user=self.other_user)
+            duplicate.save()
+        finally:
+            post_save.disconnect(count)
+        self.assertEqual(saves, [duplicate.pk])
+
+        duplicate = Story.objects.get(pk=duplicate.pk)
+        self.assertEqual(duplicate.duplicate_of_id, story.pk)
+        self.assertIsNone(duplicate.url_fingerprint)
+        self.assertEqual(Story.objects.get(pk=story.pk).points, 2)
+
+        # Another product is another story
+        other = Story(original_url="https://example.org/thread",
+                      product_url="https://other.example.com", user=self.other_user)
+        other.save()
+        self.assertIsNone(Story.objects.get(pk=other.pk).duplicate_of_id)
+
+
+    @override_settings(RATELIMIT_ENABLE=False)
+    def test_simultaneous_submissions(self):
+        from unittest import mock
+        original = Story(original_url="https://example.org/thread",
+                         product_url="https://product.example.com", user=self.user)
+        original.save()
+        stories_filter = Story.objects.filter
+        missed = []
+
+        def miss_once(*args, **kwargs):
+            # The other submission commits between the lookup and the insert
+            if 'url_fingerprint' in kwargs and not missed:
+                missed.append(kwargs['url_fingerprint'])
+                return Story.objects.none()
+            return stories_filter(*args, **kwargs)
+
+        request = RequestFactory().post('/submit', {
+            'original_url': 'https://www.example.org/thread/',
+            'product_url': 'https://product.example.com/'})
+        request.user = self.other_user
+        with mock.patch.object(Story.objects, 'filter', miss_once):
+            response = submit(request)
+        self.assertEqual(missed, [original.url_fingerprint])
+        self.assertEqual(response.status_code, 302)
+        duplicate = Story.objects.get(user=self.other_user)
+        self.assertEqual(duplicate.duplicate_of_id, original.pk)
+        self.assertIsNone(duplicate.url_fingerprint)
+
+    def test_edited_links_are_fingerprinted(self):
+        from .fingerprints import url_fingerprint
+        story = Story(original_url="https://example.org/thread",
+                      product_url="https://product.example.com", user=self.user)
+        story.save()
+        story.original_url = "https://example.org/other-thread"
+        story.save()
+        self.assertEqual(Story.objects.get(pk=story.pk).url_fingerprint,
+                         url_fingerprint(story.original_url, story.product_url))
+        # Now free, the old links make a new original
+        again = Story(original_url="https://example.org/thread",
+                      product_url="https://product.example.com", user=self.other_user)
+        again.save()
+        self.assertIsNone(again.duplicate_of_id)
+
+        # Edited into the links of another original: keeps being an original
+        story.original_url = "https://example.org/thread"
+        story.save()
+        self.assertIsNone(Story.objects.get(pk=story.pk).url_fingerprint)
+        self.assertIsNone(Story.objects.get(pk=story.pk).duplicate_of_id)
+
+
+class SignalDispatchNewsTest(TestCase):
+    """Receivers are connected to their senders only."""
+
+    def test_unrelated_models_have_no_receivers(self):
+        from django.contrib.sessions.models import Session
+        from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+        for model in (Session, Item, QueuedVote, FrontPageSnapshot, UpvotedItem, DomainStats):
+            for signal in (pre_save, post_save, pre_delete, post_delete):
+                self.assertEqual(signal._live_receivers(model), [], (model, signal))
+
+    def test_item_receivers_are_connected_to_every_item_model(self):
+        from django.db.models.signals import pre_save, post_save
+        from .receivers import ITEM_MODELS, publish_item_created, render_text_html
+        for model in ITEM_MODELS:
+            self.assertIn(publish_item_created, post_save._live_receivers(model))
+            self.assertIn(render_text_html, pre_save._live_receivers(model))
+
+
+@override_settings(DOMAIN_EVENTS_ASYNC=True)
+class DomainEventNewsTest(TestCase):
+    """Tests the outbox of domain events."""
+
+    def setUp(self):
+        self.author = CustomUser.objects.create_user(
+            username='author', email='a@hackergrows.com', password='top_secret')
+        self.user = CustomUser.objects.create_user(
+            username='test', email='hi@hackergrows.com', password='top_secret')
+
+    def _story(self, user=None):
+        story = Story(original_url="https://one.example.org/a", product_url="https://product.example.com",
+                      title="Story", product_title="Product", user=user or self.author)
+        story.save()
+        return story
+
+    def _drain(self):
+        from .events import process_events
+        total = 0
+        while True:
+            count = process_events()
+            if not count:
+                return total
+            total += count
+
+    def test_effects_are_applied_by_the_processor(self):
+        story = self._story()
+        comment = Comment(to_story=story, text="A comment", user=self.user)
+        comment.save()
+        self.assertEqual(DomainEvent.objects.count(), 2)
+        self.assertEqual(Vote.objects.count(), 0)
+        self.assertEqual(Item.objects.get(pk=story.pk).points, 0)
+
+        self.assertEqual(self._drain(), 2)
+        self.assertEqual(Item.objects.get(pk=story.pk).points, 1)
+        self.assertEqual(Item.objects.get(pk=comment.pk).points, 1)
+        self.assertEqual(DomainStats.objects.get(kind='site', domain='one.example.org').total_points, 1)
+
+        Vote(item=story, user=self.user).save()
+        Vote(item=comment, user=self.author).save()
+        self.assertEqual(self._drain(), 2)
+        story = Story.objects.get(pk=story.pk)
+        self.assertEqual((story.points, story.upvotes), (2, 2))
+        self.assertGreater(story.rank_score, 0)
+        self.assertEqual(CustomUser.objects.get(pk=self.author.pk).karma, 1)
+        self.assertEqual(CustomUser.objects.get(pk=self.user.pk).karma, 1)
+        self.assertTrue(UpvotedItem.objects.filter(user=self.user, item=story).exists())
+
+        # Cast and retracted before the processor runs
+        other = CustomUser.objects.create_user(
+            username='other', email='o@hackergrows.com', password='top_secret')
+        Vote(item=story, user=other).save()
+        Vote.objects.filter(item=story, user=other).delete()
+        self._drain()
+        self.assertEqual(Item.objects.get(pk=story.pk).points, 2)
+        self.assertEqual(CustomUser.objects.get(pk=self.author.pk).karma, 1)
+        self.assertFalse(UpvotedItem.objects.filter(user=other).exists())
+
+    def test_duplicate_upvotes_the_original(self):
+        original = self._story()
+        self._story(user=self.user)
+        # The upvote of the original is an event of its own
+        self.assertEqual(self._drain(), 3)
+        self.assertEqual(Item.objects.get(pk=original.pk).points, 2)
+
+    def test_failed_batch_is_applied_once(self):
+        from unittest import mock
+        from django.db import transaction
+        from .events import process_events
+        story = self._story()
+        Vote(item=story, user=self.user).save()
+        with mock.patch('news.events.rescore_stories', side_effect=RuntimeError("crash")):
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    process_events()
+        self.assertEqual(DomainEvent.objects.count(), 2)
+        self.assertEqual(Vote.objects.count(), 1)
+
+        self.assertEqual(process_events(), 2)
+        self.assertEqual(process_events(), 0)
+        self.assertEqual(Vote.objects.count(), 2)
+        self.assertEqual(Item.objects.get(pk=story.pk).points, 2)
+        self.assertEqual(CustomUser.objects.get(pk=self.author.pk).karma, 1)
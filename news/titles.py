@@ -0,0 +1,207 @@
+"""Title resolution for submitted links.
+
+Titles are fetched in a background thread after the story is committed,
+the story keeps its URL as placeholder title until then. Fetched titles,
+and failures, are cached on disk in the "titles" cache."""
+import codecs
+import hashlib
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+
+import requests
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+
+
+FETCH_TIMEOUT = 4  # seconds
+# The page is read in chunks until </title> or </head>, but never more than
+# MAX_HEAD_BYTES or for longer than FETCH_DEADLINE.
+CHUNK_SIZE = 8*1024
+MAX_HEAD_BYTES = 256*1024
+FETCH_DEADLINE = 8  # seconds
+NEGATIVE_CACHE_TIMEOUT = 60*60  # one hour
+# Stored for URLs whose title could not be fetched
+NO_TITLE = ''
+
+_local = threading.local()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _session():
+    # One session per thread keeps connections to the same host alive
+    if not hasattr(_local, 'session'):
+        session = requests.Session()
+        session.headers.update({
+            'User-Agent': 'Hackergrows',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET',
+            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Max-Age': '3600',
+        })
+        _local.session = session
+    return _local.session
+
+
+def _executor_instance():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.TITLE_FETCH_WORKERS, thread_name_prefix='title-fetch')
+        return _executor
+
+
+def show_and_ask_flags(title):
+    flags = {}
+    if title.lower().startswith('ask'):
+        flags['is_ask'] = True
+    if title.lower().startswith('show'):
+        flags['is_show'] = True
+    return flags
+
+
+def _cache_key(url):
+    return "news-title-%s" % (hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+
+def cached_title(url):
+    """The cached title of url, NO_TITLE if fetching failed recently and
+    None if the URL was not fetched yet."""
+    return caches['titles'].get(_cache_key(url))
+
+
+def get_title(url, back_up_title):
+    """Fetches the title of url through the cache."""
+    title = cached_title(url)
+    if title is None:
+        title = _fetch_title(url)
+        if title:
+            caches['titles'].set(_cache_key(url), title)
+        else:
+            caches['titles'].set(_cache_key(url), NO_TITLE,
+                                 timeout=NEGATIVE_CACHE_TIMEOUT)
+    return title or back_up_title
+
+
+def _fetch_title(url):
+    try:
+        response = _session().get(url, timeout=FETCH_TIMEOUT, stream=True)
+        try:
+            response.raise_for_status()
+            return extract_title(response.iter_content(CHUNK_SIZE),
+                                 content_type=response.headers.get('Content-Type'))
+        finally:
+            # Drops the connection if the body was not read to the end
+            response.close()
+    except Exception as e:
+        print("Exception: {}".format(type(e).__name__))
+        print("Exception message: {}".format(e))
+        print(url)
+        return None
+
+
+_END_OF_TITLE = re.compile(rb'</title\s*>|</head\s*>', re.IGNORECASE)
+_META_CHARSET = re.compile(
+    rb'<meta[^>]+charset\s*=\s*["\']?\s*([a-z0-9_.:-]+)', re.IGNORECASE)
+_HEADER_CHARSET = re.compile(r'charset\s*=\s*["\']?([a-z0-9_.:-]+)', re.IGNORECASE)
+
+
+class _TitleParser(HTMLParser):
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.in_title = False
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title' and not self.done:
+            self.in_title = True
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self.in_title:
+            self.in_title = False
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.parts.append(data)
+
+    @property
+    def title(self):
+        return ' '.join(''.join(self.parts).split()) or None
+
+
+def read_head(chunks, max_bytes=MAX_HEAD_BYTES, deadline=FETCH_DEADLINE):
+    """Reads chunks until the end of the title or of the head, at most
+    max_bytes and for at most deadline seconds."""
+    head = bytearray()
+    stop_at = time.monotonic() + deadline
+    for chunk in chunks:
+        # The closing tag may span two chunks
+        start = max(0, len(head) - len(b'</title >'))
+        head += chunk
+        match = _END_OF_TITLE.search(head, start)
+        if match:
+            return bytes(head[:match.end()])
+        if len(head) >= max_bytes:
+            return bytes(head[:max_bytes])
+        if time.monotonic() > stop_at:
+            break
+    return bytes(head)
+
+
+def _encoding(content_type, head):
+    """Charset of the page: byte order mark, HTTP header, <meta> tag, in this order."""
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    candidates = []
+    if content_type:
+        match = _HEADER_CHARSET.search(content_type)
+        if match:
+            candidates.append(match.group(1))
+    match = _META_CHARSET.search(head)
+    if match:
+        candidates.append(match.group(1).decode('ascii'))
+    for candidate in candidates:
+        try:
+            return codecs.lookup(candidate).name
+        except LookupError:
+            continue
+    return 'utf-8'
+
+
+def extract_title(chunks, content_type=None, max_bytes=MAX_HEAD_BYTES):
+    """Title of the HTML page read from an iterable of byte chunks, None if there is none."""
+    head = read_head(chunks, max_bytes=max_bytes)
+    parser = _TitleParser()
+    parser.feed(head.decode(_encoding(content_type, head), errors='replace'))
+    parser.close()
+    return parser.title
+
+
+def fetch_later(story_pk, field, url, placeholder):
+    """Back-fills field of the story with the title of url once the current
+    transaction is committed, unless it was changed from placeholder meanwhile."""
+    def schedule():
+        _executor_instance().submit(_back_fill, story_pk, field, url, placeholder)
+    transaction.on_commit(schedule)
+
+
+def _back_fill(story_pk, field, url, placeholder):
+    from .models import Story
+    try:
+        title = get_title(url, back_up_title=placeholder)
+        if title == placeholder:
+            return
+        values = {field: title}
+        if field == 'title':
+            values.update(show_and_ask_flags(title))
+        Story.objects.filter(pk=story_pk, **{field: placeholder}).update(**values)
+    finally:
+        connection.close()
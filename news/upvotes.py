@@ -0,0 +1,66 @@
+"""Per-user index of upvoted stories and top level comments.
+
+The upvoted_by listings used to select the items with an IN subquery over
+the whole Vote table. UpvotedItem keeps one row per upvote instead, with the
+creation time of the item, so a page is a range of the (user, is_story,
+item_created_at, item) index."""
+from django.conf import settings
+
+from .listing_cache import invalidate_private
+from .models import Item, UpvotedItem
+from .pagination import after_cursor
+
+
+def record_upvotes(votes):
+    """Adds the upvotes among votes to UpvotedItem.
+
+    Votes on replies are not listed anywhere and left out, as are the self
+    upvotes of stories: newest?upvoted_by= leaves out the user's own stories,
+    while comments?upvoted_by= lists their own comments. One query for the
+    items and one insert."""
+    votes = [vote for vote in votes if vote.vote > 0]
+    if not votes:
+        return
+    items = {pk: (user_id, created_at, story is not None)
+             for pk, user_id, created_at, story in Item.objects.filter(
+                 pk__in={vote.item_id for vote in votes}, parent=None
+             ).values_list('pk', 'user_id', 'created_at', 'story')}
+    rows = [UpvotedItem(user_id=vote.user_id, item_id=vote.item_id,
+                        is_story=items[vote.item_id][2], item_created_at=items[vote.item_id][1])
+            for vote in votes
+            if vote.item_id in items
+            and not (items[vote.item_id][2] and items[vote.item_id][0] == vote.user_id)]
+    UpvotedItem.objects.bulk_create(rows, ignore_conflicts=True)
+    for user_id in {row.user_id for row in rows if row.is_story}:
+        invalidate_private('newest', 'upvoted_by', user_id)
+
+
+def forget_upvote(vote):
+    if UpvotedItem.objects.filter(user_id=vote.user_id, item_id=vote.item_id).delete()[0]:
+        invalidate_private('newest', 'upvoted_by', vote.user_id)
+
+
+def upvoted_items(user, queryset, page=0, after=None, paging_size=settings.PAGING_SIZE, descending=True,
+                  add_filter={}):
+    """One page of the items of queryset (stories or comments) upvoted by user,
+    ordered by created_at and pk like _paginate.
+
+    add_filter holds the filters of the listing, on the fields of the story
+    or comment. They are applied to the index with a join, so the page is
+    cut from the matching items only. The page is then loaded with one
+    query."""
+    model_name = queryset.model._meta.model_name
+    rows = UpvotedItem.objects.filter(user=user, is_story=model_name == 'story')
+    rows = rows.filter(**{'item__%s__%s' % (model_name, key): value for key, value in add_filter.items()})
+    if descending:
+        rows = rows.order_by('-item_created_at', '-item_id')
+    else:
+        rows = rows.order_by('item_created_at', 'item_id')
+    rows = rows.values_list('item_id', flat=True)
+    if after is not None:
+        ids = list(after_cursor(rows, after, descending=descending,
+                                field='item_created_at', pk_field='item_id')[:paging_size])
+    else:
+        ids = list(rows[(page*paging_size):(page+1)*(paging_size)])
+    items = queryset.in_bulk(ids)
+    return [items[pk] for pk in ids if pk in items]
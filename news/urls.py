@@ -13,6 +13,9 @@ urlpatterns = [
     path('comments', views.comments, name="comments"),
     path('show', views.show, name="show"),
     path('ask', views.ask, name="ask"),
+    path('front', views.front, name="front"),
+    path('sites', views.sites, name="sites"),
+    path('products', views.products, name="products"),
     path('zen', views.zen, name="zen"),
     path('item/<uuid:pk>', views.item, name="item"),
     path('item/<uuid:pk>/upvote', views.upvote, name="upvote"),  # TODO
@@ -1,23 +1,27 @@
-from django.db.models.functions import Power, Now, Cast, Extract  # , Min
-from django.db import connection
 from django.views.decorators.cache import cache_page
 from django.views.decorators.vary import vary_on_cookie
-from django.core.cache import cache
 import datetime
 from django.utils import timezone
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.db.models import OuterRef, Subquery
-from django.db.models import Value, F, Func, ExpressionWrapper, fields, Q, Min
+from django.db.models import Q, Min
 from django.shortcuts import render
 from django.shortcuts import get_object_or_404
 from django.http import HttpResponseRedirect, HttpResponse, Http404, HttpResponseForbidden
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.urls import reverse
 
-from .models import Item, Story, Comment, Vote
+from .models import Item, Story, Comment, Vote, DomainStats
 from accounts.models import CustomUser
 from .forms import CommentForm, AddStoryForm, StoryForm
+from .ranking import rank_recent
+from .snapshots import LISTINGS, front_page_stories, historical_snapshot
+from .pagination import decode_cursor, item_cursor, after_cursor
+from .vote_queue import enqueue_vote
+from .comment_tree import load_comment_tree
+from .upvotes import upvoted_items
+from .listing_cache import cached_page
+from .domains import top_domains
 
 from ratelimit.decorators import ratelimit
 
@@ -35,7 +39,6 @@ DEFAULT_VOTES_RATE = "10/m"
 DEFAULT_POST_RATE = "5/m"
 
 
-TIMEOUT_MEDIUM = 0  # 1*60 # one minute
 TIMEOUT_SHORT = 0  # 1*2 # two seconds
 
 
@@ -51,119 +54,160 @@ def _one_page_back(request):
     return HttpResponseRedirect(_more_link)
 
 
-def _front_page(paging_size=settings.PAGING_SIZE, page=0, add_filter={}, add_q=[], as_of=None, days_back=5000):
+def _after(request):
+    """Decoded ?after= cursor of the request, None for page-number pagination."""
+    if 'after' not in request.GET.keys():
+        return None
+    try:
+        return decode_cursor(request.GET['after'])
+    except ValueError:
+        raise Http404()
+
+
+def _paginate(queryset, page=0, after=None, paging_size=settings.PAGING_SIZE, descending=True, field='created_at'):
+    """One page of a queryset ordered by field (created_at or a copy of it) and pk.
+
+    With a cursor the page is read with a keyset range instead of an OFFSET."""
+    if after is not None:
+        return list(after_cursor(queryset, after, descending=descending, field=field)[:paging_size])
+    return list(queryset[(page*paging_size):(page+1)*(paging_size)])
+
+
+def _next_cursor(stories):
+    if stories:
+        return item_cursor(stories[-1])
+    return None
+
+
+def _voted_item_ids(user, items_q):
+    """IDs of the displayed items the user voted on, one query for the whole page.
+
+    Passed to the templates as voted_item_ids, so the vote arrows need no
+    query per item."""
+    if not user.is_authenticated:
+        return set()
+    return set(Vote.objects.filter(items_q, user=user).values_list('item_id', flat=True))
+
+
+def _listed_items(stories):
+    return Q(item__in=[story.pk for story in stories])
+
+
+def _front_page(paging_size=settings.PAGING_SIZE, page=0, add_filter={}, add_q=[], as_of=None, days_back=None):
     # TODO: weighting https://medium.com/hacking-and-gonzo/how-hacker-news-ranking-algorithm-works-1d9b0cf2c08d
     # (P-1) / (T+2)^G
     if as_of is None:
-        now = timezone.now()
-    else:
-        now = as_of
-    if connection.vendor == 'postgresql':
-        now_value = Value(now, output_field=fields.DateTimeField())
-        submission_age_float = ExpressionWrapper(
-            (now_value - F('created_at')), output_field=fields.DurationField())
-        submission_age_hours = ExpressionWrapper(
-            Extract(F('tf'), 'epoch') / 60 / 60 + 2.1, output_field=fields.FloatField())
-        real_p = ExpressionWrapper(
-            F('points') - 1, output_field=fields.FloatField())
-        formula = ExpressionWrapper(
-            F('p') / (Power(F('tfh'), F('g')) + 0.001), output_field=fields.FloatField())
-        return Story.objects.select_related('user')\
-            .filter(duplicate_of__isnull=True)\
-            .filter(points__gte=1) \
-            .filter(created_at__gte=now - datetime.timedelta(days=days_back)) \
-            .filter(created_at__lte=now) \
-            .filter(**add_filter) \
-            .annotate(tf=submission_age_float) \
-            .annotate(tfh=submission_age_hours) \
-            .annotate(p=real_p) \
-            .annotate(g=Value(1.8, output_field=fields.FloatField())) \
-            .annotate(formula=formula) \
-            .order_by('-formula')[(page*paging_size):(page+1)*(paging_size)]
-    elif connection.vendor == 'sqlite':
-        now_value = Value(now, output_field=fields.DateTimeField())
-        submission_age_float = ExpressionWrapper(
-            (now_value - F('created_at')), output_field=fields.FloatField())
-        submission_age_hours = ExpressionWrapper(
-            F('tf') / 60 / 60 / 1000000 + 2.1, output_field=fields.FloatField())
-        real_p = ExpressionWrapper(
-            F('points') - 1, output_field=fields.FloatField())
-        formula = ExpressionWrapper(
-            F('p') / (Power(F('tfh'), F('g')) + 0.001), output_field=fields.FloatField())
+        # Live listings are served from the stored score, see news.ranking.
+        # rank_score >= 0 is the same as points >= 1.
         return Story.objects.select_related('user')\
             .filter(duplicate_of__isnull=True)\
-            .filter(points__gte=1) \
-            .filter(created_at__gte=now - datetime.timedelta(days=days_back)) \
-            .filter(created_at__lte=now) \
+            .filter(rank_score__gte=0) \
             .filter(**add_filter) \
-            .annotate(tf=submission_age_float) \
-            .annotate(tfh=submission_age_hours) \
-            .annotate(p=real_p) \
-            .annotate(g=Value(1.8, output_field=fields.FloatField())) \
-            .annotate(formula=formula) \
-            .order_by('-formula')[(page*paging_size):(page+1)*(paging_size)]
+            .filter(*add_q) \
+            .order_by('-rank_score')[(page*paging_size):(page+1)*(paging_size)]
+    # Only the stories that can still make it to the page are ranked, see
+    # news.ranking.rank_recent. days_back is an additional hard limit.
+    stories = Story.objects.select_related('user')\
+        .filter(duplicate_of__isnull=True)\
+        .filter(points__gte=1) \
+        .filter(created_at__lte=as_of) \
+        .filter(**add_filter) \
+        .filter(*add_q)
+    if days_back is not None:
+        stories = stories.filter(created_at__gte=as_of - datetime.timedelta(days=days_back))
+    return rank_recent(stories, 'gravity', now=as_of, offset=page*paging_size, limit=paging_size)
+
+
+def _newest(paging_size=settings.PAGING_SIZE, page=0, add_filter={}, add_q=[], after=None):
+    # A domain filter reads the (domain, submitted_at) index of Story,
+    # created_at is in the Item table
+    if 'original_url_domain' in add_filter or 'product_url_domain' in add_filter:
+        field = 'submitted_at'
     else:
-        raise NotImplementedError(
-            "No frontpage magic for database engine %s implemented" % (connection.vendor))
-
-
-def _newest(paging_size=settings.PAGING_SIZE, page=0, add_filter={}, add_q=[]):
-    return Story.objects \
+        field = 'created_at'
+    stories = Story.objects \
                 .select_related('user') \
                 .filter(duplicate_of__isnull=True) \
                 .filter(**add_filter) \
                 .filter(*add_q) \
-                .order_by('-created_at')[(page*paging_size):(page+1)*(paging_size)]
+                .order_by('-' + field, '-pk')
+    return _paginate(stories, page=page, after=after, paging_size=paging_size, field=field)
 
 
-@ratelimit(key="user_or_ip", group="news-get", rate=DEFAULT_GET_RATE, block=True)
-def index(request):
+def _ranked_listing(request, listing):
     page = int(request.GET.get('p', 0))
-    stories = cache.get_or_set("news-index-%s" % (page), lambda: list(
-        _front_page(page=page)), timeout=TIMEOUT_MEDIUM)  # one minute
+    stories = front_page_stories(listing, page=page)
     if len(stories) < 1 and page != 0:
         back = _one_page_back(request)
         if back:
             return back
-    return render(request, 'news/index.html', {'stories': stories, 'hide_text': True, 'page': page, 'rank_start': page*settings.PAGING_SIZE})
+    return render(request, 'news/index.html', {'stories': stories, 'hide_text': True, 'page': page, 'rank_start': page*settings.PAGING_SIZE, 'voted_item_ids': _voted_item_ids(request.user, _listed_items(stories))})
+
+
+@ratelimit(key="user_or_ip", group="news-get", rate=DEFAULT_GET_RATE, block=True)
+def index(request):
+    return _ranked_listing(request, 'index')
 
 
 @ratelimit(key="user_or_ip", group="news-get", rate=DEFAULT_GET_RATE, block=True)
 def show(request):
-    page = int(request.GET.get('p', 0))
-    stories = cache.get_or_set("news-show-%s" % (page), lambda: list(_front_page(
-        page=page, add_filter={'is_show': True})), timeout=TIMEOUT_MEDIUM)  # one minute
-    if len(stories) < 1 and page != 0:
-        back = _one_page_back(request)
-        if back:
-            return back
-    return render(request, 'news/index.html', {'stories': stories, 'hide_text': True, 'page': page, 'rank_start': page*settings.PAGING_SIZE})
+    return _ranked_listing(request, 'show')
 
 
 @ratelimit(key="user_or_ip", group="news-get", rate=DEFAULT_GET_RATE, block=True)
 def ask(request):
-    page = int(request.GET.get('p', 0))
-    def stories(): return list(_front_page(
-        page=page, add_filter={'is_ask': True}))
-    stories = cache.get_or_set(
-        "news-ask-%s" % (page), stories, timeout=TIMEOUT_MEDIUM)  # one minute
-    if len(stories) < 1 and page != 0:
-        back = _one_page_back(request)
-        if back:
-            return back
-    return render(request, 'news/index.html', {'stories': stories, 'hide_text': True, 'page': page, 'rank_start': page*settings.PAGING_SIZE})
+    return _ranked_listing(request, 'ask')
+
+
+@ratelimit(key="user_or_ip", group="news-get", rate=DEFAULT_GET_RATE, block=True)
+def front(request):
+    """Past front page of ?day=YYYY-MM-DD (yesterday by default), as last
+    recorded by the record_front_page command on that day."""
+    listing = request.GET.get('listing', 'index')
+    if listing not in LISTINGS:
+        raise Http404
+    try:
+        if 'day' in request.GET:
+            day = datetime.date.fromisoformat(request.GET['day'])
+        else:
+            day = timezone.localdate() - datetime.timedelta(days=1)
+        page = int(request.GET.get('p', 0))
+    except ValueError:
+        raise Http404
+    start_of_day = timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+    end_of_day = timezone.make_aware(datetime.datetime.combine(
+        day + datetime.timedelta(days=1), datetime.time.min))
+    # A day without a record is not shown with the front page of an earlier one
+    snapshot = historical_snapshot(listing, before=end_of_day, since=start_of_day)
+    if snapshot is None:
+        raise Http404("No front page recorded on %s" % (day))
+    ids = snapshot.ids[page*settings.PAGING_SIZE:(page+1)*settings.PAGING_SIZE]
+    stories = Story.objects.select_related('user').in_bulk(ids)
+    stories = [stories[pk] for pk in ids if pk in stories]
+    next_day = day + datetime.timedelta(days=1)
+    return render(request, 'news/index.html', {
+        'stories': stories, 'hide_text': True, 'page': page, 'rank_start': page*settings.PAGING_SIZE,
+        'front_day': day, 'front_taken_at': snapshot.taken_at,
+        'previous_day': day - datetime.timedelta(days=1),
+        'next_day': next_day if next_day <= timezone.localdate() else None,
+        'voted_item_ids': _voted_item_ids(request.user, _listed_items(stories))})
 
 
 @ratelimit(key="user_or_ip", group="news-get", rate=DEFAULT_GET_RATE, block=True)
 def newest(request):  # Done
     page = int(request.GET.get('p', 0))
+    after = _after(request)
     add_filter = {}
     add_q = []
+    upvoted_by = None
+    # Canonical form of the filters, for the cache key
+    filters = {}
     if 'submitted_by' in request.GET.keys():
         try:
             submitted_by = CustomUser.objects.get_by_natural_key(
                 request.GET['submitted_by'])
             add_filter['user'] = submitted_by
+            filters['submitted_by'] = submitted_by.pk
         except CustomUser.DoesNotExist:
             raise Http404()
     if 'upvoted_by' in request.GET.keys():
@@ -172,22 +216,27 @@ def newest(request):  # Done
             assert request.user.username == request.GET['upvoted_by']
         except AssertionError:
             return HttpResponseForbidden()
-        add_filter['pk__in'] = Vote.objects.filter(
-            vote=1, user=request.user).values('item')
-        add_q.append(~Q(user=request.user))
+        upvoted_by = request.user
+        filters['upvoted_by'] = request.user.pk
     if 'site' in request.GET.keys():
         add_filter['original_url_domain'] = request.GET['site']
+        filters['site'] = request.GET['site']
     if 'product' in request.GET.keys():
         add_filter['product_url_domain'] = request.GET['product']
-
-    def stories(): return list(_newest(page=page, add_filter=add_filter, add_q=add_q))
-    stories = cache.get_or_set(
-        "news-newest-%s" % (page), stories, timeout=TIMEOUT_SHORT)  # two seconds
-    if len(stories) < 1 and page != 0:
+        filters['product'] = request.GET['product']
+
+    def stories():
+        if upvoted_by is not None:
+            return upvoted_items(upvoted_by, Story.objects.select_related('user'), page=page, after=after,
+                                 add_filter=dict(add_filter, duplicate_of__isnull=True))
+        return _newest(page=page, add_filter=add_filter, add_q=add_q, after=after)
+    stories = cached_page('newest', filters, stories, page=page, after=after,
+                          timeout=settings.NEWEST_CACHE_TIMEOUT)
+    if len(stories) < 1 and page != 0 and after is None:
         back = _one_page_back(request)
         if back:
             return back
-    return render(request, 'news/index.html', {'stories': stories, 'hide_text': True, 'page': page, 'rank_start': page*settings.PAGING_SIZE})
+    return render(request, 'news/index.html', {'stories': stories, 'hide_text': True, 'page': page, 'rank_start': page*settings.PAGING_SIZE, 'next_cursor': _next_cursor(stories), 'voted_item_ids': _voted_item_ids(request.user, _listed_items(stories))})
 
 
 @login_required
@@ -196,7 +245,7 @@ def newest(request):  # Done
 @vary_on_cookie
 def threads(request):
     page = int(request.GET.get('p', 0))
-    paging_size = settings.PAGING_SIZE
+    after = _after(request)
     tree = Comment.objects.filter(tree_id=OuterRef('tree_id'), user=OuterRef(
         'user')).values('tree_id', 'user__pk').annotate(min_level=Min('level')).order_by()
     stories = Comment.objects.filter(
@@ -208,13 +257,17 @@ def threads(request):
     ).select_related(
         'user', 'parent', 'to_story'
     ).order_by(
-        '-created_at'
-    )[(page*paging_size):(page+1)*(paging_size)]
-    if len(stories) < 1 and page != 0:
+        '-created_at', '-pk'
+    )
+    stories = _paginate(stories, page=page, after=after)
+    if len(stories) < 1 and page != 0 and after is None:
         back = _one_page_back(request)
         if back:
             return back
-    return render(request, 'news/index.html', {'stories': stories, 'hide_text': False, 'page': page, 'rank_start': None, 'show_children': True})
+    # The replies below each comment are shown too, they share its tree_id
+    voted_item_ids = _voted_item_ids(request.user, Q(
+        item__tree_id__in={story.tree_id for story in stories}))
+    return render(request, 'news/index.html', {'stories': stories, 'hide_text': False, 'page': page, 'rank_start': None, 'show_children': True, 'next_cursor': _next_cursor(stories), 'voted_item_ids': voted_item_ids})
 
 
 @ratelimit(key="user_or_ip", group="news-get", rate=DEFAULT_GET_RATE, block=True)
@@ -222,8 +275,10 @@ def threads(request):
 @vary_on_cookie
 def comments(request):  # TODO
     page = int(request.GET.get('p', 0))
+    after = _after(request)
     paging_size = settings.PAGING_SIZE
     add_filter = {}
+    upvoted_by = None
     if 'submitted_by' in request.GET.keys():
         try:
             submitted_by = CustomUser.objects.get_by_natural_key(
@@ -237,8 +292,7 @@ def comments(request):  # TODO
             assert request.user.username == request.GET['upvoted_by']
         except AssertionError:
             return HttpResponseForbidden()
-        add_filter['pk__in'] = Vote.objects.filter(
-            vote=1, user=request.user).values('item')
+        upvoted_by = request.user
     stories = Comment.objects.filter(
         parent=None
     ).filter(
@@ -246,13 +300,38 @@ def comments(request):  # TODO
     ).select_related(
         'user', 'parent', 'to_story'
     ).order_by(
-        'created_at'
-    )[(page*paging_size):(page+1)*(paging_size)]
-    if len(stories) < 1 and page != 0:
+        'created_at', 'pk'
+    )
+    if upvoted_by is not None:
+        stories = upvoted_items(upvoted_by, stories, page=page, after=after,
+                                paging_size=paging_size, descending=False, add_filter=add_filter)
+    else:
+        stories = _paginate(stories, page=page, after=after,
+                            paging_size=paging_size, descending=False)
+    if len(stories) < 1 and page != 0 and after is None:
         back = _one_page_back(request)
         if back:
             return back
-    return render(request, 'news/index.html', {'stories': stories, 'hide_text': False, 'page': page, 'rank_start': page*paging_size})
+    return render(request, 'news/index.html', {'stories': stories, 'hide_text': False, 'page': page, 'rank_start': page*paging_size, 'next_cursor': _next_cursor(stories), 'voted_item_ids': _voted_item_ids(request.user, _listed_items(stories))})
+
+
+def _top_domains(request, kind):
+    order = request.GET.get('order', 'story_count')
+    if order not in ('story_count', 'total_points'):
+        raise Http404
+    return render(request, 'news/domains.html', {
+        'domains': top_domains(kind, order=order, limit=settings.TOP_DOMAINS_SIZE),
+        'kind': kind, 'order': order})
+
+
+@ratelimit(key="user_or_ip", group="news-get", rate=DEFAULT_GET_RATE, block=True)
+def sites(request):
+    return _top_domains(request, DomainStats.SITE)
+
+
+@ratelimit(key="user_or_ip", group="news-get", rate=DEFAULT_GET_RATE, block=True)
+def products(request):
+    return _top_domains(request, DomainStats.PRODUCT)
 
 
 @ratelimit(key="user_or_ip", group="news-get", rate=DEFAULT_GET_RATE, block=True)
@@ -264,16 +343,25 @@ def _vote(request, pk, vote=None, unvote=False):
     assert not unvote and vote is not None or unvote and vote is None
     item = get_object_or_404(Item, pk=pk)
     if (not unvote) and (vote is not None):
-        votes = Vote.objects.filter(item=item, user=request.user)
+        if request.method == "POST" and settings.VOTE_QUEUE:
+            # Only the checks that need no query, flush_votes enforces all
+            # the rules again when the vote is applied.
+            if item.user_id == request.user.pk or (vote < 0 and not request.user.karma > 1):
+                return HttpResponseForbidden()
+            queued = enqueue_vote(item, request.user, vote)
+            return HttpResponse("OK %s" % (queued.pk))
         if request.method == "POST":
+            # Whether the user voted already is left to the unique
+            # constraint, checked by save_if_new.
             if vote > 0:
-                if not item.can_be_upvoted_by(request.user):
+                if not item.can_be_upvoted_by(request.user, voted_item_ids=()):
                     return HttpResponseForbidden()
             else:
-                if not item.can_be_downvoted_by(request.user):
+                if not item.can_be_downvoted_by(request.user, voted_item_ids=()):
                     return HttpResponseForbidden()
             vote = Vote(vote=vote, item=item, user=request.user)
-            vote.save()
+            if not vote.save_if_new():
+                return HttpResponseForbidden()
             return HttpResponse("OK %s" % (vote.pk))
     if unvote:
         if request.method == "POST":
@@ -311,7 +399,7 @@ def _item_story_comment(pk):
     try:
         # .prefetch_related('children', 'parent')
         item = Item.objects.select_related(
-            'story', 'comment', 'user', 'parent').prefetch_related('children').get(pk=pk)
+            'story', 'comment', 'user', 'parent').get(pk=pk)
     except Exception as e:
         raise e
     try:
@@ -350,7 +438,10 @@ def item(request, pk):  # DONE
                 return HttpResponseRedirect(story.get_absolute_url() + '#' + str(comment.pk))
     else:
         comment_form = None
-    return render(request, 'news/item.html', {'item': item, 'comment_form': comment_form})
+    voted_item_ids = _voted_item_ids(request.user, Q(
+        item=item) | Q(item__comment__to_story=story))
+    comments = load_comment_tree(item)
+    return render(request, 'news/item.html', {'item': item, 'comments': comments, 'comment_form': comment_form, 'voted_item_ids': voted_item_ids})
 
 
 @login_required
@@ -404,7 +495,13 @@ def submit(request):  # DONE
     }, instance=instance)
     if request.method == "POST":
         if form.is_valid():
-            instance = form.save()
+            try:
+                with transaction.atomic():
+                    instance = form.save()
+            except IntegrityError:
+                # The same links were submitted at the same moment and the
+                # other story took the fingerprint, this one is its duplicate
+                instance = form.save()
             return HttpResponseRedirect(instance.get_absolute_url())
     return render(request, 'news/submit.html', {'form': form})
 
@@ -0,0 +1,57 @@
+from django.db import transaction
+
+from accounts.models import CustomUser
+from .models import Item, Vote, QueuedVote
+from .events import apply_votes
+
+
+def enqueue_vote(item, user, vote):
+    """Accepts a vote for later processing by flush_votes."""
+    return QueuedVote.objects.create(item=item, user=user, vote=vote)
+
+
+def flush_votes(batch_size=500):
+    """Applies one batch of queued votes.
+
+    The rules of the synchronous path are enforced again here: no self vote,
+    one vote per user and item, and downvotes only above the karma threshold.
+    Votes are written with one bulk insert and their effects applied by
+    news.events.apply_votes. Returns the number of queued votes handled."""
+    with transaction.atomic():
+        queued = list(QueuedVote.objects
+                      .select_for_update(skip_locked=True)
+                      .order_by('created_at')[:batch_size])
+        if not queued:
+            return 0
+        authors = dict(Item.objects.filter(
+            pk__in={q.item_id for q in queued}).values_list('pk', 'user_id'))
+        votes = _accepted_votes(queued, authors)
+        # A vote cast on the synchronous path meanwhile must not fail the
+        # batch, and must not be counted twice: only the votes that were
+        # inserted are applied
+        Vote.objects.bulk_create(votes, ignore_conflicts=True)
+        votes = Vote.objects.filter(pk__in=[vote.pk for vote in votes])
+        apply_votes([(vote.item_id, vote.user_id, vote.vote, 1) for vote in votes])
+        QueuedVote.objects.filter(pk__in=[q.pk for q in queued]).delete()
+    return len(queued)
+
+
+def _accepted_votes(queued, authors):
+    item_ids = {q.item_id for q in queued}
+    user_ids = {q.user_id for q in queued}
+    karma = dict(CustomUser.objects.filter(
+        pk__in=user_ids).values_list('pk', 'karma'))
+    seen = set(Vote.objects.filter(item_id__in=item_ids, user_id__in=user_ids)
+               .values_list('user_id', 'item_id'))
+    votes = []
+    for q in queued:
+        key = (q.user_id, q.item_id)
+        if key in seen:
+            continue
+        if q.item_id not in authors or authors[q.item_id] == q.user_id:
+            continue
+        if q.vote < 0 and not karma.get(q.user_id, 0) > 1:
+            continue
+        seen.add(key)
+        votes.append(Vote(item_id=q.item_id, user_id=q.user_id, vote=q.vote))
+    return votes